@@ -14,9 +14,15 @@ from tqdm import tqdm
 
 from collections import Counter
 from collections import defaultdict
+from collections import deque
+from collections.abc import Sequence
+
+import numpy as np
+from scipy.sparse import csr_matrix
 
 from guesser import add_guesser_params
-from features import LengthFeature
+from features import GuessCache, LengthFeature, guess_only
+from feature_store import ColumnarFeaturizer, FeatureDicts, prefix_block
 from params import add_buzzer_params, add_question_params, load_guesser, load_buzzer, load_questions, add_general_params, setup_logging
 
 def normalize_answer(answer):
@@ -60,26 +66,33 @@ def rough_compare(guess, page):
     else:
         return False
     
-def runs(text, run_length):
+def run_ends(text, run_length):
     """
-    Given a quiz bowl questions, generate runs---subsegments that simulate
-    reading the question out loud.
-
-    These are then fed into the rest of the system.
-
+    Generate the character offsets where the runs of a question (see runs)
+    end.
     """
     words = text.split()
     assert len(words) > 0
-    current_word = 0
     last_run = 0
 
     for idx in range(run_length, len(text), run_length):
         current_run = text.find(" ", idx)
         if current_run > last_run and current_run < idx + run_length:
-            yield text[:current_run]
+            yield current_run
             last_run = current_run
 
-    yield text
+    yield len(text)
+
+def runs(text, run_length):
+    """
+    Given a quiz bowl questions, generate runs---subsegments that simulate
+    reading the question out loud.
+
+    These are then fed into the rest of the system.
+
+    """
+    for end in run_ends(text, run_length):
+        yield text[:end]
 
 def sentence_runs(sentences, run_length):
     """
@@ -93,24 +106,182 @@ def sentence_runs(sentences, run_length):
         previous += sentence
         previous += "  "
     
+class QuestionRuns(Sequence):
+    """
+    The runs of one question, as prefixes of its text (created on access).
+    """
+
+    def __init__(self, text, ends):
+        self.text = text
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.text[:x] for x in self.ends[index]]
+        return self.text[:self.ends[index]]
+
+
+class RunTable(Sequence):
+    """
+    Every run of every question added to a buzzer.  Rather than storing
+    each prefix as its own string (quadratic in question length), keep each
+    question's text once and, for each run, which question it comes from and
+    where it ends.  Run text is only created when it is accessed.
+    """
+
+    def __init__(self):
+        self.texts = []
+        # The runs of each question are contiguous: (start, stop) into the table
+        self.spans = []
+        self._question = np.zeros(1024, dtype=np.int64)
+        self._end = np.zeros(1024, dtype=np.int64)
+        self._size = 0
+
+    def add(self, text, run_length):
+        """
+        Add the runs of a question's text, returning their (start, stop)
+        positions in the table.
+        """
+        ends = list(run_ends(text, run_length))
+        start, stop = self._size, self._size + len(ends)
+        if stop > len(self._end):
+            capacity = max(stop, 2 * len(self._end))
+            self._question = np.resize(self._question, capacity)
+            self._end = np.resize(self._end, capacity)
+
+        self._question[start:stop] = len(self.texts)
+        self._end[start:stop] = ends
+        self._size = stop
+        self.texts.append(text)
+        self.spans.append((start, stop))
+        return start, stop
+
+    @property
+    def question_index(self):
+        return self._question[:self._size]
+
+    @property
+    def ends(self):
+        return self._end[:self._size]
+
+    def question(self, index):
+        """
+        The runs of the index-th question that was added.
+        """
+        start, stop = self.spans[index]
+        return QuestionRuns(self.texts[index], self._end[start:stop])
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[x] for x in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < self._size:
+            raise IndexError("Run %i out of range" % index)
+        return self.texts[self._question[index]][:self._end[index]]
+
+
+class RunMetadata(Sequence):
+    """
+    The metadata (guess, answer, id, and text) of each featurized run,
+    assembled when it is accessed so that the run text is not stored.
+    """
+
+    def __init__(self, runs, questions, answers, guesses):
+        self.runs = runs
+        self.questions = questions
+        self.answers = answers
+        self.guesses = guesses
+
+    def __len__(self):
+        return len(self.guesses)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[x] for x in range(*index.indices(len(self)))]
+        return {"guess": self.guesses[index], "answer": self.answers[index],
+                "id": self.questions[index]["qanta_id"], "text": self.runs[index]}
+
+
+class GuessHistory:
+    """
+    The guesses each guesser made for the most recent runs of one question
+    (oldest first), keeping at most length runs and the top depth guesses of
+    each run.  Create a new one for every question so that history never
+    crosses question boundaries.
+    """
+
+    def __init__(self, length, depth):
+        self.length = length
+        self.depth = depth
+        self._history = defaultdict(lambda: deque(maxlen=max(length, 0)))
+
+    def add(self, guesses):
+        """
+        Record the guesses (a dictionary from guesser name to the list of
+        guesses) of the run that was just featurized.
+        """
+        if self.length <= 0:
+            return
+        for guesser in guesses:
+            self._history[guesser].append(list(guesses[guesser])[:self.depth])
+
+    def copy(self):
+        """
+        A snapshot of the history that later calls to add do not change.
+        """
+        snapshot = GuessHistory(self.length, self.depth)
+        for guesser in self._history:
+            snapshot._history[guesser].extend(self._history[guesser])
+        return snapshot
+
+    def __getitem__(self, guesser):
+        return list(self._history[guesser]) if guesser in self._history else []
+
+    def __iter__(self):
+        return iter(self._history)
+
+    def __len__(self):
+        return max((len(x) for x in self._history.values()), default=0)
+
+
 class Buzzer:
     """
     Base class for any system that can decide if a guess is correct or not.
     """
     
-    def __init__(self, filename, run_length, num_guesses=1):
+    def __init__(self, filename, run_length, num_guesses=1, history_length=0, history_depth=0):
+        """
+        history_length -- How many previous runs of a question features can see
+        history_depth -- How many guesses of each previous run to keep
+        """
         self.filename = filename
         self.num_guesses = num_guesses
         self.run_length=run_length
+        self.history_length = history_length
+        self.history_depth = history_depth
         
-        self._runs = []
+        self._runs = RunTable()
         self._questions = []
         self._answers = []
         self._training = []
         self._correct = []
-        self._features = []
-        self._metadata = []
+        # Features are stored as blocks of named columns (see feature_store),
+        # _features is a view of them as one dictionary per run
+        self._feature_blocks = []
+        self._features = FeatureDicts(self._feature_blocks)
+        # The top guess for each run (the rest of the metadata is in other members)
+        self._guesses = []
+        self._metadata = RunMetadata(self._runs, self._questions, self._answers, self._guesses)
         self._feature_generators = []
+        # Features that only depend on the guess are computed once per guess
+        self._guess_caches = {}
         self._guessers = {}
 
         logging.info("Buzzer using run length %i" % self.run_length)
@@ -146,24 +317,49 @@ class Buzzer:
         assert feature_extractor.name not in [x.name for x in self._feature_generators]
         assert feature_extractor.name not in self._guessers
         self._feature_generators.append(feature_extractor)
+        if guess_only(feature_extractor):
+            self._guess_caches[feature_extractor.name] = GuessCache(feature_extractor)
         logging.info("Adding feature %s" % feature_extractor.name)
         
-    def featurize(self, question, run_text, guess_history, guesses=None):
+    def featurize(self, question, run_text, guess_history=None, guesses=None):
         """
         Turn a question's run into features.
 
+        guess_history -- A GuessHistory of this question's previous runs
+          (passed to features that set uses_history)
         guesses -- A dictionary of all the guesses.  If None, will regenerate the guesses.
         """
         
-        features = {}
-        guess = None
-
         # If we didn't cache the guesses, compute them now
         if guesses is None:
             guesses = {}            
             for gg in self._guessers:
                 guesses[gg] = self._guessers[gg](run_text)
 
+        guess, features = self._guess_features(guesses)
+
+        if guess_history is None:
+            guess_history = GuessHistory(0, 0)
+
+        for ff in self._feature_generators:
+            if ff.name in self._guess_caches:
+                values = self._guess_caches[ff.name](question, run_text, guess)
+            elif getattr(ff, "uses_history", False):
+                values = ff(question, run_text, guess, guess_history=guess_history)
+            else:
+                values = ff(question, run_text, guess)
+            for feat, val in values:
+                features["%s_%s" % (ff.name, feat)] = val
+
+        return guess, features
+
+    def _guess_features(self, guesses):
+        """
+        Given the guesses of every guesser for a run, return the primary
+        guesser's guess and the confidence features of each guesser.
+        """
+        features = {}
+        guess = None
         for gg in self._guessers:
             assert gg in guesses, "Missing guess result from %s" % gg
             result = list(guesses[gg])[0]
@@ -173,13 +369,6 @@ class Buzzer:
             # This feature could be useful, but makes the formatting messy
             # features["%s_guess" % gg] = result["guess"]
             features["%s_confidence" % gg] = result["confidence"]
-
-
-
-        for ff in self._feature_generators:
-            for feat, val in ff(question, run_text, guess):
-                features["%s_%s" % (ff.name, feat)] = val
-
         return guess, features
 
     def finalize(self):
@@ -211,55 +400,73 @@ class Buzzer:
                 del qq["page"]
             del qq["first_sentence"]
             del qq["text"]
-            
-            for rr in runs(text, self.run_length):
+
+            start, stop = self._runs.add(text, self.run_length)
+            for rr in range(start, stop):
                 self._answers.append(answer)
-                self._runs.append(rr)
                 self._questions.append(qq)
 
-    def build_features(self, history_length=0, history_depth=0):
+    def build_features(self, history_length=None, history_depth=None):
         """
         After all of the data has been added, build features from the guesses and questions.
+
+        history_length, history_depth -- Override the buzzer's guess history settings
         """
+        if history_length is None:
+            history_length = self.history_length
+        if history_depth is None:
+            history_depth = self.history_depth
         
         all_guesses = {}
         for guesser in self._guessers:
-            all_guesses[guesser] = self._guessers[guesser].batch_guess(self._runs, self.num_guesses)
+            question_runs = [self._runs.question(x) for x in range(len(self._runs.spans))]
+            all_guesses[guesser] = self._guessers[guesser].batch_prefix_guess(question_runs, self.num_guesses)
             logging.info("%10i guesses from %s" % (len(all_guesses[guesser]), guesser))
             assert len(all_guesses[guesser]) == len(self._runs), "Guesser %s wrong size" % guesser
             
         assert len(self._questions) == len(self._answers)
         assert len(self._questions) == len(self._runs)        
             
-        num_runs = len(self._runs)
+        # Features are built for every run added so far; start over if they
+        # were built before (e.g., more data was added since)
+        del self._guesses[:]
+        del self._correct[:]
+        del self._feature_blocks[:]
+
+        uses_history = any(getattr(ff, "uses_history", False) for ff in self._feature_generators)
+        guess_histories = [] if uses_history else None
+        confidences = np.zeros((len(self._runs), len(self._guessers)))
+
+        logging.info("Finding guesses for all runs")
+        for start, stop in tqdm(self._runs.spans):
+            # Each question starts with an empty history
+            guess_history = GuessHistory(history_length, history_depth)
+            for question_index in range(start, stop):
+                question_guesses = dict((x, all_guesses[x][question_index]) for x in self._guessers)
+                guess, guess_features = self._guess_features(question_guesses)
+                confidences[question_index] = [guess_features["%s_confidence" % x] for x in self._guessers]
+                if uses_history:
+                    guess_histories.append(guess_history.copy())
+                    guess_history.add(question_guesses)
+
+                answer = self._answers[question_index]
+                correct = rough_compare(guess, answer)
+                logging.debug(str((correct, guess, answer)))
+
+                self._guesses.append(guess)
+                self._correct.append(correct)
 
         logging.info("Generating all features")
-        for question_index in tqdm(range(num_runs)):
-            question_guesses = dict((x, all_guesses[x][question_index]) for x in self._guessers)
-            guess_history = defaultdict(dict)
-            for guesser in question_guesses:
-                guess_history[guesser] = dict((time, guess[:history_depth]) for time, guess in enumerate(all_guesses[guesser]) if time < question_index and time > question_index - history_length)
-
-            # print(guess_history)
-            question = self._questions[question_index]
-            run = self._runs[question_index]
-            answer = self._answers[question_index]
-            guess, features = self.featurize(question, run, question_guesses)
-            
-            self._features.append(features)
-            self._metadata.append({"guess": guess, "answer": answer, "id": question["qanta_id"], "text": run})
-
-            correct = rough_compare(guess, answer)
-            logging.debug(str((correct, guess, answer)))
-                
-            self._correct.append(correct)
+        self._feature_blocks.append((["%s_confidence" % x for x in self._guessers],
+                                     csr_matrix(confidences)))
+        for ff in self._feature_generators:
+            generator = self._guess_caches.get(ff.name, ff)
+            block = generator.batch(self._questions, self._runs, self._guesses, guess_histories)
+            self._feature_blocks.append(prefix_block(ff.name, block))
 
-                
-            assert len(self._correct) == len(self._features)
-            assert len(self._correct) == len(self._metadata)
-        
         assert len(self._answers) == len(self._correct), \
-            "Answers (%i) does not match correct (%i)" % (len(self._answers), len(self._features))
+            "Answers (%i) does not match correct (%i)" % (len(self._answers), len(self._correct))
+        assert len(self._correct) == len(self._metadata)
         assert len(self._answers) == len(self._features)        
 
         if "GprGuesser" in self._guessers:
@@ -291,7 +498,11 @@ class Buzzer:
         assert self._classifier, "Classifier not trained"
         assert self._featurizer, "Featurizer not defined"
         assert len(self._features) == len(self._questions), "Features not built.  Did you run build_features?"
-        X = self._featurizer.transform(self._features)
+        if isinstance(self._featurizer, DictVectorizer):
+            # Buzzers saved before features were stored as columns
+            X = self._featurizer.transform(list(self._features))
+        else:
+            X = self._featurizer.transform(self._feature_blocks)
 
         return self._classifier.predict(X), X, self._features, self._correct, self._metadata
     
@@ -319,8 +530,8 @@ class Buzzer:
         """
 
         assert len(self._features) == len(self._correct)        
-        self._featurizer = DictVectorizer(sparse=True)
-        X = self._featurizer.fit_transform(self._features)
+        self._featurizer = ColumnarFeaturizer()
+        X = self._featurizer.fit_transform(self._feature_blocks)
         return X
 
 if __name__ == "__main__":
@@ -336,7 +547,7 @@ if __name__ == "__main__":
 
     guesser = load_guesser(flags)    
     buzzer = load_buzzer(flags)
-    questions = load_questions(flags)
+    questions = load_questions(flags, lazy=True)
 
     buzzer.add_data(questions)
     buzzer.build_features()
@@ -344,8 +555,5 @@ if __name__ == "__main__":
     buzzer.train()
     buzzer.save()
 
-    if flags.limit == -1:
-        print("Ran on %i questions" % len(questions))
-    else:
-        print("Ran on %i questions of %i" % (flags.limit, len(questions)))
+    print("Ran on %i questions" % len(buzzer._runs.spans))
     
@@ -0,0 +1,144 @@
+import unittest
+
+from guesser import Guesser
+from buzzer import Buzzer, GuessHistory, RunTable, runs
+from features import Feature, GuessBlankFeature, GuessCapitals, LengthFeature
+
+
+class LastWordGuesser(Guesser):
+    """
+    Guesses the last word of the run, so every run has a different guess.
+    """
+    def __call__(self, question, n_guesses=1):
+        return [{"guess": question.split()[-1], "confidence": 1.0}]
+
+
+class HistoryRecorder(Feature):
+    uses_history = True
+
+    def __init__(self, name):
+        self.name = name
+        self.seen = []
+
+    def __call__(self, question, run, guess, guess_history=None):
+        self.seen.append((question["qanta_id"], [x[0]["guess"] for x in guess_history["Last"]]))
+        yield ("history", len(guess_history))
+
+
+class CountingCapitals(GuessCapitals):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+
+    def __call__(self, question, run, guess):
+        self.calls += 1
+        yield from super().__call__(question, run, guess)
+
+
+class BuzzerTest(unittest.TestCase):
+    def setUp(self):
+        self.questions = [{"qanta_id": 1, "page": "Maine", "first_sentence": "",
+                           "text": "one two three four five six seven eight nine ten"},
+                          {"qanta_id": 2, "page": "Boston", "first_sentence": "",
+                           "text": "alpha beta gamma delta epsilon zeta eta theta"}]
+        self.questions_text = [x["text"] for x in self.questions]
+        self.recorder = HistoryRecorder("Recorder")
+
+        self.buzzer = Buzzer("data/test_buzzer", 10, history_length=2, history_depth=1)
+        self.buzzer.add_guesser("Last", LastWordGuesser(), primary_guesser=True)
+        self.buzzer.add_feature(LengthFeature("Length"))
+        self.buzzer.add_feature(self.recorder)
+        self.buzzer.add_data(self.questions)
+
+    def test_history(self):
+        history = GuessHistory(2, 1)
+        self.assertEqual(len(history), 0)
+        for word in ["a", "b", "c"]:
+            history.add({"Last": [{"guess": word}, {"guess": "other"}]})
+        self.assertEqual(len(history), 2)
+        self.assertEqual(history["Last"], [[{"guess": "b"}], [{"guess": "c"}]])
+        self.assertEqual(history["Missing"], [])
+
+    def test_run_table(self):
+        table = RunTable()
+        expected = []
+        for ii in range(300):
+            text = " ".join("word%i" % x for x in range(ii % 40 + 1))
+            start, stop = table.add(text, 25)
+            self.assertEqual(start, len(expected))
+            expected += list(runs(text, 25))
+            self.assertEqual(stop, len(expected))
+            self.assertEqual(list(table.question(ii)), list(runs(text, 25)))
+
+        self.assertEqual(len(table), len(expected))
+        self.assertEqual(list(table), expected)
+        self.assertEqual(table[-1], expected[-1])
+        self.assertEqual(table[5:9], expected[5:9])
+
+    def test_build_features(self):
+        features = self.buzzer.build_features()
+        self.assertEqual(len(features), len(self.buzzer._runs))
+        self.assertEqual(len(self.recorder.seen), len(self.buzzer._runs))
+
+        earlier = {}
+        for (qid, history), meta in zip(self.recorder.seen, self.buzzer._metadata):
+            # Only this question's two most recent runs, never another question's
+            self.assertEqual(history, earlier.get(qid, [])[-2:])
+            earlier.setdefault(qid, []).append(meta["guess"])
+        self.assertEqual(set(earlier), {1, 2})
+
+        self.assertEqual([x["text"] for x in self.buzzer._metadata],
+                         list(runs(self.questions_text[0], 10)) + list(runs(self.questions_text[1], 10)))
+
+    def test_rebuild_features(self):
+        first = [dict(x) for x in self.buzzer.build_features()]
+        self.buzzer.add_data([{"qanta_id": 3, "page": "Lima", "first_sentence": "", "text": "uno dos tres"}])
+        features = self.buzzer.build_features()
+
+        # Rebuilt for every run, including the new ones
+        self.assertEqual(len(features), len(self.buzzer._runs))
+        self.assertEqual(len(self.buzzer._correct), len(self.buzzer._runs))
+        self.assertEqual([dict(x) for x in features][:len(first)], first)
+        self.assertEqual(self.buzzer._metadata[-1]["guess"], "tres")
+
+    def test_columnar_features(self):
+        from sklearn.feature_extraction import DictVectorizer
+
+        self.buzzer.build_features()
+        X = self.buzzer.train()
+        rows = [dict(x) for x in self.buzzer._features]
+        reference = DictVectorizer(sparse=True)
+        expected = reference.fit_transform(rows)
+
+        self.assertEqual(self.buzzer._featurizer.feature_names_, list(reference.feature_names_))
+        self.assertEqual(abs(X - expected).sum(), 0.0)
+        # A single example still goes through the dictionary path
+        single = self.buzzer._featurizer.transform([rows[3]])
+        self.assertEqual(abs(single - expected[3]).sum(), 0.0)
+
+    def test_guess_cache(self):
+        capitals = CountingCapitals("Capitals")
+        buzzer = Buzzer("data/test_buzzer", 10)
+        buzzer.add_guesser("Last", LastWordGuesser(), primary_guesser=True)
+        buzzer.add_feature(capitals)
+        buzzer.add_feature(GuessBlankFeature("Blank"))
+        buzzer.add_feature(LengthFeature("Length"))
+        self.assertEqual(sorted(buzzer._guess_caches), ["Blank", "Capitals"])
+
+        buzzer.add_data([{"qanta_id": ii, "page": "Maine", "first_sentence": "", "text": text.title()}
+                         for ii, text in enumerate(self.questions_text)])
+        features = buzzer.build_features()
+        distinct = set(buzzer._guesses)
+        self.assertEqual(capitals.calls, len(distinct))
+        for guess, row in zip(buzzer._guesses, features):
+            expected = dict(GuessCapitals("Capitals")(None, None, guess))
+            self.assertEqual(row.get("Capitals_true", 0.0), expected["true"])
+
+        # Featurizing a single run reuses the cached values
+        guess = buzzer._guesses[0]
+        buzzer.featurize({"qanta_id": 1}, "One Two", guesses={"Last": [{"guess": guess, "confidence": 1.0}]})
+        self.assertEqual(capitals.calls, len(distinct))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,282 @@
+# Jordan Boyd-Graber
+# 2023
+#
+# Fill GprGuesser cache misses from a completion service: an asyncio client
+# that sends many requests at once (with a cap on concurrency, a rate limit,
+# retries, and one request per distinct question), and a local stand-in
+# server so that it can be run without an API key.
+
+import json
+import time
+import random
+import asyncio
+import logging
+import threading
+
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+kRETRY_STATUS = [429, 500, 502, 503, 504]
+
+
+class CompletionError(Exception):
+    pass
+
+
+class TokenBucket:
+    """
+    Allows rate requests per second on average, with bursts of up to
+    capacity requests.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self.tokens) / self.rate)
+
+
+def http_request(url, body):
+    """
+    The bytes of an HTTP/1.1 POST of a json body to url.
+    """
+    parts = urlsplit(url)
+    host = parts.hostname
+    if parts.port is not None and parts.port != (443 if parts.scheme == "https" else 80):
+        host = "%s:%i" % (host, parts.port)
+    return ("POST %s HTTP/1.1\r\nHost: %s\r\nContent-Type: application/json\r\n"
+            "Content-Length: %i\r\nConnection: close\r\n\r\n" %
+            (parts.path if parts.path else "/", host, len(body))).encode("ascii") + body
+
+
+def decode_chunked(content):
+    """
+    The body of a response sent with Transfer-Encoding: chunked.
+    """
+    body = []
+    position = 0
+    while True:
+        line_end = content.index(b"\r\n", position)
+        # The size is hex, possibly followed by ";extensions"
+        size = int(content[position:line_end].split(b";")[0], 16)
+        if size == 0:
+            return b"".join(body)
+        start = line_end + 2
+        body.append(content[start:start + size])
+        position = start + size + 2
+
+
+def parse_response(response):
+    """
+    Split the raw bytes of an HTTP response into (status, body bytes).
+    """
+    header, _, content = response.partition(b"\r\n\r\n")
+    lines = header.split(b"\r\n")
+    status = int(lines[0].split(b" ", 2)[1])
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(b":")
+        headers[name.strip().lower()] = value.strip()
+
+    if b"chunked" in headers.get(b"transfer-encoding", b"").lower():
+        content = decode_chunked(content)
+    elif b"content-length" in headers:
+        content = content[:int(headers[b"content-length"])]
+    return status, content
+
+
+async def post_json(url, payload, timeout=30.0):
+    """
+    POST a json payload and return (status, decoded json body or None).
+    """
+    parts = urlsplit(url)
+    port = parts.port if parts.port else (443 if parts.scheme == "https" else 80)
+    request = http_request(url, json.dumps(payload).encode("utf-8"))
+
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(parts.hostname, port, ssl=(parts.scheme == "https")), timeout)
+    try:
+        writer.write(request)
+        await writer.drain()
+        # The request asks the server to close the connection when it is done
+        response = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+
+    status, content = parse_response(response)
+    try:
+        return status, json.loads(content.decode("utf-8"))
+    except ValueError:
+        return status, None
+
+
+class CompletionClient:
+    """
+    Gets a {"guess": ..., "confidence": ...} result for each question from a
+    completion service that takes {"question": ...} as a json POST.
+    """
+
+    def __init__(self, url, concurrency=8, rate=0.0, retries=3, backoff=0.5, timeout=30.0):
+        """
+        url -- Where to POST questions
+        concurrency -- How many requests can be in flight at once
+        rate -- How many requests to start per second (0 for no limit)
+        retries -- How many times to retry a request that failed
+        backoff -- Seconds to wait before the first retry (doubles each time)
+        """
+        self.url = url
+        self.concurrency = concurrency
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.num_requests = 0
+        # Every call runs on the same event loop (rather than asyncio.run
+        # starting a new one each time, which is most of the cost of
+        # completing a single question), so the rate limit also holds
+        # across calls
+        self.loop = None
+        self.bucket = TokenBucket(rate)
+
+    async def _request(self, question, semaphore):
+        for attempt in range(self.retries + 1):
+            await self.bucket.acquire()
+            async with semaphore:
+                self.num_requests += 1
+                try:
+                    status, result = await post_json(self.url, {"question": question}, self.timeout)
+                except (OSError, asyncio.TimeoutError) as e:
+                    status, result = None, None
+                    logging.debug("Request failed: %s" % str(e))
+                except (ValueError, IndexError) as e:
+                    # A response cut short or garbled on the way
+                    status, result = None, None
+                    logging.debug("Could not parse response: %s" % str(e))
+
+            if status == 200 and result is not None:
+                return result
+            if status is not None and status not in kRETRY_STATUS:
+                raise CompletionError("Status %i for |%s|" % (status, question))
+            await asyncio.sleep(self.backoff * (2 ** attempt) * (0.5 + random.random()))
+        raise CompletionError("Gave up after %i attempts for |%s|" % (self.retries + 1, question))
+
+    async def _complete_all(self, questions):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        # Duplicate questions share one request
+        unique = list(dict.fromkeys(questions))
+        results = await asyncio.gather(*[self._request(x, semaphore) for x in unique],
+                                       return_exceptions=True)
+
+        completed = {}
+        for question, result in zip(unique, results):
+            if isinstance(result, Exception):
+                logging.warning(str(result))
+            else:
+                completed[question] = result
+        return completed
+
+    def complete_all(self, questions):
+        """
+        Return a dictionary from question to result for the questions that
+        could be completed.
+        """
+        if not questions:
+            return {}
+        start = time.time()
+        if self.loop is None or self.loop.is_closed():
+            self.loop = asyncio.new_event_loop()
+        completed = self.loop.run_until_complete(self._complete_all(questions))
+        logging.info("Completed %i of %i questions in %0.2f seconds" %
+                     (len(completed), len(set(questions)), time.time() - start))
+        return completed
+
+    def close(self):
+        if self.loop is not None:
+            self.loop.close()
+            self.loop = None
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Answers a question with its last capitalized word, after waiting the
+    server's latency.  Every fail_every-th request gets a 503.
+    """
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        question = json.loads(self.rfile.read(length).decode("utf-8"))["question"]
+
+        with self.server.lock:
+            self.server.num_requests += 1
+            fail = self.server.fail_every > 0 and self.server.num_requests % self.server.fail_every == 0
+        time.sleep(self.server.latency)
+
+        if fail:
+            self.send_response(503)
+            body = b"{}"
+        else:
+            capitalized = [x for x in question.split() if x[:1].isupper()]
+            guess = capitalized[-1].strip(".,;?!") if capitalized else ""
+            self.send_response(200)
+            body = json.dumps({"guess": guess, "confidence": 0.5}).encode("utf-8")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops connections from a concurrent client
+    request_queue_size = 128
+
+
+def stand_in_server(port=0, latency=0.0, fail_every=0, handler=StandInHandler):
+    """
+    Start a stand-in completion server in a background thread and return it
+    (its url is server.url; stop it with server.shutdown()).
+    """
+    server = StandInServer(("127.0.0.1", port), handler)
+    server.latency = latency
+    server.fail_every = fail_every
+    server.num_requests = 0
+    server.lock = threading.Lock()
+    server.url = "http://127.0.0.1:%i/" % server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--fail_every', type=int, default=0)
+    flags = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = stand_in_server(flags.port, flags.latency, flags.fail_every)
+    logging.info("Serving stand-in completions at %s" % server.url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,86 @@
+import time
+import unittest
+
+from completion import CompletionClient, StandInHandler, http_request, parse_response, \
+    stand_in_server
+
+
+class GarbledHandler(StandInHandler):
+    """
+    Sends a response that can't be parsed to every other request.
+    """
+
+    def do_POST(self):
+        with self.server.lock:
+            garble = self.server.num_requests % 2 == 0
+            if garble:
+                self.server.num_requests += 1
+        if not garble:
+            return StandInHandler.do_POST(self)
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.wfile.write(b"garbled\r\n\r\n")
+
+
+class CompletionTest(unittest.TestCase):
+    def setUp(self):
+        self.server = stand_in_server(latency=0.1, fail_every=4)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_concurrent(self):
+        questions = ["This capital of England is %i miles from London" % x for x in range(16)]
+        client = CompletionClient(self.server.url, concurrency=16, backoff=0.01)
+
+        start = time.time()
+        results = client.complete_all(questions + questions)
+        elapsed = time.time() - start
+
+        self.assertEqual(set(results), set(questions))
+        self.assertEqual(results[questions[0]]["guess"], "London")
+        # Duplicates are coalesced, failures (every fourth request) retried
+        self.assertGreater(client.num_requests, len(questions))
+        self.assertEqual(client.num_requests, self.server.num_requests)
+        # Much less than 16 sequential requests of 0.1 seconds
+        self.assertLess(elapsed, 1.0)
+
+    def test_rate_limit(self):
+        client = CompletionClient(self.server.url, concurrency=8, rate=20.0, retries=0)
+        start = time.time()
+        client.complete_all(["Question %i about Paris" % x for x in range(30)])
+        # 20 requests can go out in the first burst, the rest at 20 per second
+        self.assertGreater(time.time() - start, 0.45)
+        # Without retries, the failed requests are just missing
+        self.assertEqual(client.num_requests, 30)
+
+    def test_garbled(self):
+        server = stand_in_server(handler=GarbledHandler)
+        try:
+            client = CompletionClient(server.url, backoff=0.01)
+            first = client.complete_all(["Where is the Eiffel Tower? In Paris"])
+            self.assertEqual(first["Where is the Eiffel Tower? In Paris"]["guess"], "Paris")
+            loop = client.loop
+            second = client.complete_all(["What is the capital of Italy? Rome"])
+            self.assertEqual(second["What is the capital of Italy? Rome"]["guess"], "Rome")
+            # Each garbled response was retried, on the same event loop
+            self.assertEqual(client.num_requests, 4)
+            self.assertIs(client.loop, loop)
+            client.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_http(self):
+        self.assertIn(b"\r\nHost: example.com:8765\r\n", http_request("http://example.com:8765/guess", b"{}"))
+        self.assertIn(b"\r\nHost: example.com\r\n", http_request("https://example.com:443/", b"{}"))
+
+        chunked = (b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                   b"a\r\n{\"guess\": \r\na;name=x\r\n\"London\"}\n\r\n0\r\n\r\n")
+        self.assertEqual(parse_response(chunked), (200, b'{"guess": "London"}\n'))
+        plain = b"HTTP/1.1 503 Unavailable\r\nContent-Length: 2\r\n\r\n{}trailing"
+        self.assertEqual(parse_response(plain), (503, b"{}"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -105,8 +105,11 @@ def eval_buzzer(buzzer, questions, dump_buzze_predictions=True):
     
     predict, feature_matrix, feature_dict, correct, metadata = buzzer.predict(questions)
     if dump_buzze_predictions:
-        pickle.dump([predict, feature_matrix, feature_dict, correct, metadata], 
-                                    open('models/buzzer_predict.pkl', 'wb'))
+        # Features and metadata are views of the buzzer's columns; dump them
+        # as plain lists of dictionaries
+        pickle.dump([predict, feature_matrix, [dict(x) for x in feature_dict], correct,
+                     [dict(x) for x in metadata]],
+                    open('models/buzzer_predict.pkl', 'wb'))
 
     # Keep track of how much of the question you needed to see before
     # answering correctly
@@ -176,11 +179,12 @@ if __name__ == "__main__":
 
     questions = load_questions(flags)
     questions = questions['questions']
-    guesser = load_guesser(flags, load=True)    
     if flags.evaluate == "buzzer":
+        # The buzzer loads (and shares) its own guessers
         buzzer = load_buzzer(flags, load=True)
         outcomes, examples, unseen = eval_buzzer(buzzer, questions)
     elif flags.evaluate == "guesser":
+        guesser = load_guesser(flags, load=True)
         if flags.cutoff >= 0:
             outcomes, examples = eval_retrieval(guesser, questions, flags.num_guesses, flags.cutoff)
         else:
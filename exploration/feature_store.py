@@ -0,0 +1,146 @@
+# Jordan Boyd-Graber
+# 2023
+#
+# Columnar storage of buzzer features: features are computed for all runs at
+# once as blocks of named sparse columns, and assembled into the matrix the
+# classifier sees without building a dictionary for every run.
+
+from collections.abc import Sequence
+
+import numpy as np
+from scipy.sparse import csr_matrix, coo_matrix
+
+
+def block_from_dicts(rows):
+    """
+    Turn a list of {name: value} dictionaries (one per run) into a block of
+    named columns: (names, csr matrix).  Like DictVectorizer, a string value
+    becomes a "name=value" indicator column.
+    """
+    names = {}
+    row_ids, column_ids, values = [], [], []
+    for row, features in enumerate(rows):
+        for name, value in features.items():
+            if isinstance(value, str):
+                name = "%s=%s" % (name, value)
+                value = 1.0
+            row_ids.append(row)
+            column_ids.append(names.setdefault(name, len(names)))
+            values.append(float(value))
+
+    matrix = coo_matrix((values, (row_ids, column_ids)), shape=(len(rows), len(names)))
+    return list(names), matrix.tocsr()
+
+
+def block_from_calls(feature, questions, runs, guesses, guess_histories=None):
+    """
+    Compute a feature's block by calling it on each run.  This is how
+    features that do not have a vectorized batch implementation are run.
+    """
+    rows = []
+    for index, (question, run, guess) in enumerate(zip(questions, runs, guesses)):
+        if getattr(feature, "uses_history", False):
+            values = feature(question, run, guess, guess_history=guess_histories[index])
+        else:
+            values = feature(question, run, guess)
+        rows.append(dict(values))
+    return block_from_dicts(rows)
+
+
+def stack_blocks(blocks):
+    """
+    Stack blocks for consecutive runs into one block (the union of their
+    columns).
+    """
+    names = {}
+    row_ids, column_ids, values = [], [], []
+    num_rows = 0
+    for block_names, matrix in blocks:
+        columns = np.array([names.setdefault(x, len(names)) for x in block_names], dtype=np.int64)
+        matrix = coo_matrix(matrix)
+        row_ids.append(matrix.row + num_rows)
+        column_ids.append(columns[matrix.col])
+        values.append(matrix.data)
+        num_rows += matrix.shape[0]
+
+    if not blocks:
+        return [], csr_matrix((0, 0))
+    matrix = coo_matrix((np.concatenate(values), (np.concatenate(row_ids), np.concatenate(column_ids))),
+                        shape=(num_rows, len(names)))
+    return list(names), matrix.tocsr()
+
+
+def prefix_block(prefix, block):
+    names, matrix = block
+    return ["%s_%s" % (prefix, x) for x in names], matrix
+
+
+class ColumnarFeaturizer:
+    """
+    Maps named feature columns to a fixed set of matrix columns, in place of
+    DictVectorizer.  fit/transform take a list of (names, matrix) blocks
+    that all have one row per run; transform also accepts a list of feature
+    dictionaries so that single examples can still be featurized one at a
+    time.
+    """
+
+    def __init__(self):
+        self.feature_names_ = []
+        self.vocabulary_ = {}
+
+    @staticmethod
+    def _blocks(data):
+        if len(data) > 0 and isinstance(data[0], dict):
+            return [block_from_dicts(data)]
+        return data
+
+    def fit(self, data):
+        names = set()
+        for block_names, matrix in self._blocks(data):
+            names.update(block_names)
+        self.feature_names_ = sorted(names)
+        self.vocabulary_ = dict((name, column) for column, name in enumerate(self.feature_names_))
+        return self
+
+    def transform(self, data):
+        blocks = self._blocks(data)
+        num_rows = blocks[0][1].shape[0] if blocks else 0
+        result = csr_matrix((num_rows, len(self.feature_names_)))
+        for names, matrix in blocks:
+            assert matrix.shape[0] == num_rows, "Feature blocks have different numbers of rows"
+            columns = np.array([self.vocabulary_.get(x, -1) for x in names], dtype=np.int64)
+            known = np.flatnonzero(columns >= 0)
+            if len(known) == 0:
+                continue
+            # Multiplying by a 0/1 matrix moves each block column to its
+            # place in the full matrix
+            placement = csr_matrix((np.ones(len(known)), (np.arange(len(known)), columns[known])),
+                                   shape=(len(known), len(self.feature_names_)))
+            result = result + csr_matrix(matrix)[:, known] @ placement
+        return result.tocsr()
+
+    def fit_transform(self, data):
+        return self.fit(data).transform(data)
+
+
+class FeatureDicts(Sequence):
+    """
+    A read-only view of feature blocks as one {name: value} dictionary per
+    run (only non-zero values), for code that still expects dictionaries.
+    """
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+
+    def __len__(self):
+        return self.blocks[0][1].shape[0] if self.blocks else 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[x] for x in range(*index.indices(len(self)))]
+        features = {}
+        for names, matrix in self.blocks:
+            row = matrix.getrow(index)
+            for column, value in zip(row.indices, row.data):
+                features[names[column]] = float(value)
+        return features
@@ -4,18 +4,33 @@
 # Feature extractors to improve classification to determine if an answer is
 # correct.
 
-from collections import Counter
+from collections import Counter, OrderedDict
 from math import log
+from scipy.sparse import hstack
 from sklearn.metrics.pairwise import linear_kernel
 import gzip
 import json
+import numpy as np
+
+from feature_store import block_from_calls, block_from_dicts, stack_blocks
+from topk import top_k_similar
 
 class Feature:
     """
     Base feature class.  Needs to be instantiated in params.py and then called
     by buzzer.py
+
+    Features that set uses_history are also passed the guess_history keyword:
+    a GuessHistory with the guesses of the question's previous runs.
+
+    depends_on declares which of the arguments a feature's values depend on;
+    a feature that only depends on the guess can be computed once per
+    distinct guess (see GuessCache).
     """
 
+    uses_history = False
+    depends_on = ("question", "run", "guess")
+
     def __init__(self, name):
         self.name = name
 
@@ -23,6 +38,103 @@ class Feature:
         raise NotImplementedError(
             "Subclasses of Feature must implement this function")
 
+    def batch(self, questions, runs, guesses, guess_histories=None):
+        """
+        Compute the feature for many runs at once (questions, runs, guesses
+        and, if uses_history, guess_histories have one entry per run).
+        Returns named columns: a list of names and a sparse matrix with a
+        row for each run and a column for each name.
+
+        By default this calls the feature on each run; override it when the
+        feature can be computed for all runs at once.
+        """
+        return block_from_calls(self, questions, runs, guesses, guess_histories)
+
+
+def guess_only(feature):
+    return tuple(getattr(feature, "depends_on", ())) == ("guess",)
+
+
+class GuessCache:
+    """
+    Computes a feature that only depends on the guess (see depends_on) once
+    per distinct guess.  Remembers the values of up to size guesses, dropping
+    the least recently used.
+    """
+
+    def __init__(self, feature, size=10000):
+        assert guess_only(feature), "%s depends on more than the guess" % feature.name
+        self.feature = feature
+        self.name = feature.name
+        self.size = size
+        self.values = OrderedDict()
+        self.hits = 0
+
+    def __call__(self, question, run, guess):
+        if guess in self.values:
+            self.hits += 1
+            self.values.move_to_end(guess)
+            return self.values[guess]
+
+        values = list(self.feature(question, run, guess))
+        self.values[guess] = values
+        if len(self.values) > self.size:
+            self.values.popitem(last=False)
+        return values
+
+    def batch(self, questions, runs, guesses, guess_histories=None):
+        """
+        Compute the feature for each distinct guess and copy its row to
+        every run with that guess.
+        """
+        distinct = OrderedDict()
+        for index, guess in enumerate(guesses):
+            distinct.setdefault(guess, index)
+        rows = [dict(self(questions[x], runs[x], guess)) for guess, x in distinct.items()]
+        names, matrix = block_from_dicts(rows)
+        lookup = dict((guess, row) for row, guess in enumerate(distinct))
+        return names, matrix[[lookup[x] for x in guesses]]
+
+class QuestionMemo:
+    """
+    Remembers values that only depend on the question (and possibly the
+    guess), so that they are computed once per question rather than once
+    per run.  Questions are identified by qanta_id (or their first sentence
+    if they do not have one); the least recently used values are dropped
+    once there are more than size of them.
+    """
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.values = OrderedDict()
+        self.hits = 0
+
+    @staticmethod
+    def question_key(question):
+        if "qanta_id" in question:
+            return question["qanta_id"]
+        return question.get("first_sentence")
+
+    def remember(self, value, question, *extra):
+        self.values[(self.question_key(question),) + extra] = value
+        if len(self.values) > self.size:
+            self.values.popitem(last=False)
+
+    def __call__(self, compute, question, *extra):
+        """
+        Return compute(question, *extra), computing it only if it is not
+        remembered for this question and extra arguments.
+        """
+        key = (self.question_key(question),) + extra
+        if key in self.values:
+            self.hits += 1
+            self.values.move_to_end(key)
+            return self.values[key]
+
+        value = compute(question, *extra)
+        self.remember(value, question, *extra)
+        return value
+
 """
 Given features (Length, Frequency)
 """
@@ -44,7 +156,24 @@ class LengthFeature(Feature):
         else:
             yield ("guess", log(1 + len(guess)))
 
-class FrequencyFeature:
+class GuessHistoryFeature(Feature):
+    """
+    How many of the question's previous runs had the same top guess (for
+    each guesser)?  A guess that has been stable for a while is more likely
+    to be right.
+    """
+
+    uses_history = True
+    depends_on = ("guess", "guess_history")
+
+    def __call__(self, question, run, guess, guess_history=None):
+        for guesser in guess_history:
+            previous = [x[0]["guess"] for x in guess_history[guesser] if len(x) > 0]
+            yield ("%s_repeat" % guesser, sum(1 for x in previous if x == guess))
+
+class FrequencyFeature(Feature):
+    depends_on = ("guess",)
+
     def __init__(self, name):
         from buzzer import normalize_answer
         self.name = name
@@ -69,6 +198,8 @@ class GuessBlankFeature(Feature):
     """
     Is guess blank?
     """
+    depends_on = ("guess",)
+
     def __call__(self, question, run, guess):
         yield ('true', len(guess) == 0)
 
@@ -77,6 +208,8 @@ class GuessCapitals(Feature):
     """
     Capital letters in guess
     """
+    depends_on = ("guess",)
+
     def __call__(self, question, run, guess):
         yield ('true', log(sum(i.isupper() for i in guess) + 1))
 
@@ -86,68 +219,194 @@ def clean(s):
             .replace('\r', '') \
             .replace('_', ' ')
 
+def page_index(wiki_filename, wiki, normalize):
+    """
+    The normalized title of each wiki page (in order) and a dictionary from
+    normalized title to the first row with that title.
+
+    Normalizing every title is slow for a large dump, so the titles are
+    saved next to the wiki file and reused while the wiki file is unchanged.
+    """
+    import os
+    index_filename = "%s.titles.json" % wiki_filename
+    stat = os.stat(wiki_filename)
+    signature = [stat.st_size, stat.st_mtime_ns, len(wiki)]
+
+    doc_names = None
+    if os.path.exists(index_filename):
+        with open(index_filename) as infile:
+            saved = json.load(infile)
+        if saved["signature"] == signature:
+            doc_names = saved["titles"]
+
+    if doc_names is None:
+        doc_names = [normalize(clean(p['page'])) for p in wiki]
+        try:
+            with open(index_filename, 'w') as outfile:
+                json.dump({"signature": signature, "titles": doc_names}, outfile)
+        except IOError:
+            pass
+
+    rows = {}
+    for row, title in enumerate(doc_names):
+        rows.setdefault(title, row)
+    return doc_names, rows
+
+class SimilarityFeature(Feature):
+    """
+    Base class for features that compare a question's first sentence to a
+    collection of documents.  Subclasses provide vectorize (texts to a
+    matrix), documents (a matrix with a row per document), label (a
+    document's name), matches (how many documents to keep), sentence_memo
+    (a QuestionMemo of each question's matches) and memo (a QuestionMemo of
+    per-guess values, kept apart so that many guesses cannot evict the
+    matches).
+
+    In batch, the first sentences of many questions are matched against the
+    documents together, and only the best matches of each are selected
+    rather than sorting every document.
+    """
+
+    def vectorize(self, texts):
+        raise NotImplementedError
+
+    def documents(self):
+        raise NotImplementedError
+
+    def label(self, row):
+        raise NotImplementedError
+
+    def match_questions(self, questions):
+        """
+        For each question, its first sentence's vector, and the similarities
+        and labels of the most similar documents (best first).
+        """
+        vectors = self.vectorize([x['first_sentence'] for x in questions])
+        matches = []
+        for row, (best, similarity) in enumerate(top_k_similar(vectors, self.documents(), self.matches)):
+            matches.append((vectors[row], similarity, [self.label(x) for x in best]))
+        return matches
+
+    def first_sentence_matches(self, question):
+        return self.match_questions([question])[0]
+
+    def prime(self, questions):
+        """
+        Match the first sentences of the questions that are not already
+        remembered, all at once.
+        """
+        missing = {}
+        for question in questions:
+            key = self.sentence_memo.question_key(question)
+            if (key,) not in self.sentence_memo.values:
+                missing.setdefault(key, question)
+        missing = list(missing.values())
+        for question, value in zip(missing, self.match_questions(missing)):
+            self.sentence_memo.remember(value, question)
+
+    def batch(self, questions, runs, guesses, guess_histories=None):
+        # Runs are grouped by question; take as many questions at a time as
+        # the memo of matches can hold
+        limit = max(1, self.sentence_memo.size)
+        blocks = []
+        start = 0
+        seen = set()
+        for index, question in enumerate(questions):
+            key = self.sentence_memo.question_key(question)
+            if key not in seen and len(seen) == limit:
+                self.prime(questions[start:index])
+                blocks.append(block_from_calls(self, questions[start:index], runs[start:index], guesses[start:index]))
+                start = index
+                seen = set()
+            seen.add(key)
+        self.prime(questions[start:])
+        blocks.append(block_from_calls(self, questions[start:], runs[start:len(questions)], guesses[start:]))
+        return stack_blocks(blocks)
+
+class WikiTitleFeature(Feature):
+    """
+    Is the guess the title of a wiki page?
+    """
+    depends_on = ("guess",)
+
+    def __init__(self, name, normalize, doc_rows):
+        self.name = name
+        self.normalize = normalize
+        self.doc_rows = doc_rows
+
+    def __call__(self, question, run, guess):
+        yield ('in_wiki', int(self.normalize(guess) in self.doc_rows))
+
 """
 Feature set based on Wikipedia info
 """
-class WikipediaFeature(Feature):
-    def __init__(self, name):
+class WikipediaFeature(SimilarityFeature):
+    def __init__(self, name, wiki_filename='./data/wiki_page_text.json'):
         from buzzer import normalize_answer
         self.normalize = normalize_answer
         self.name = name
         from sklearn.feature_extraction.text import TfidfVectorizer
-        with open('./data/wiki_page_text.json', 'r') as f:
+        with open(wiki_filename, 'r') as f:
         # with open('/home/neal/nlp-hw/feateng/data/wiki_page_text.json', 'r') as f:
             wiki = json.load(f)
         self.vec = TfidfVectorizer()
         wiki = [p for p in wiki if p is not None and p['page'] is not None and p['text'] is not None]
-        self.doc_names = [self.normalize(clean(p['page'])) for p in wiki]
-        # self.docs = self.vec.fit_transform([clean(p['text']) for p in wiki])
+        # Row of each (normalized) page title, so looking up a guess does not
+        # scan every title
+        self.doc_names, self.doc_rows = page_index(wiki_filename, wiki, self.normalize)
+        self.docs = self.vec.fit_transform([clean(p['text']) for p in wiki])
 
-        # self.matches = 10
+        self.matches = 10
+        self.sentence_memo = QuestionMemo()
+        self.memo = QuestionMemo()
+        self.in_wiki = GuessCache(WikiTitleFeature(name, self.normalize, self.doc_rows))
 
-    def __call__(self, question, run, guess):
-        norm_guess = self.normalize(guess)
+    def vectorize(self, texts):
+        return self.vec.transform(texts)
 
-        # is guess in wiki
-        in_wiki = int(norm_guess in self.doc_names)
-        yield ('in_wiki', int(norm_guess in self.doc_names))
-        
-        tf_q = self.vec.transform([question['first_sentence']])
-        if in_wiki:
+    def documents(self):
+        return self.docs
+
+    def label(self, row):
+        return self.doc_names[row]
+
+    def guess_matches(self, question, guess):
+        """
+        Features of how the guess's page relates to the first sentence.
+        """
+        norm_guess = self.normalize(guess)
+        tf_q, related_sim, related_labels = self.sentence_memo(self.first_sentence_matches, question)
+        features = []
+        if norm_guess in self.doc_rows:
             # similarity between guess and wiki page
-            idx = self.doc_names.index(norm_guess)
-            a = tf_q
-            b = self.docs[idx]
+            idx = self.doc_rows[norm_guess]
             sim = linear_kernel(tf_q, self.docs[idx])[0][0]
-            yield ('sim', sim)
+            features.append(('sim', sim))
         else:
-            yield ('sim', 0)
-        # get question first sentence
-        tf_q = self.vec.transform([question['first_sentence']])
-
-        # get similar Wikipedia sentences by tfidf
-        cos_sim = linear_kernel(tf_q, self.docs).flatten()
-        best_match_idx = cos_sim.argsort()[:-self.matches:-1]
+            features.append(('sim', 0))
 
-        related_sim = cos_sim[best_match_idx]
-        related_labels = [self.doc_names[i] for i in best_match_idx]
         guess_in_rel = [norm_guess in s for s in related_labels]
         if any(guess_in_rel) and len(guess) > 0:
             guess_idx = guess_in_rel.index(True)
 
             # tfidf rank and similarity of doc from guess in relation to first sentence, 0 if guess did not appear
-            yield('guess_rank_rel_fs', guess_idx)
+            features.append(('guess_rank_rel_fs', guess_idx))
 
-            yield('guess_sim_rel_fs', related_sim[guess_idx])
+            features.append(('guess_sim_rel_fs', related_sim[guess_idx]))
         else:
-            yield('guess_rank_rel_fs', 100)
-            yield('guess_sim_rel_fs', 0)
-        pass
+            features.append(('guess_rank_rel_fs', 100))
+            features.append(('guess_sim_rel_fs', 0))
+        return features
+
+    def __call__(self, question, run, guess):
+        # is guess in wiki
+        yield from self.in_wiki(question, run, guess)
+        yield from self.memo(self.guess_matches, question, guess)
 
 """
 TFIDF-based features
 """
-class TfidfFeature(Feature):
+class TfidfFeature(SimilarityFeature):
     def __init__(self, name):
         import pickle
         self.name = name
@@ -159,33 +418,36 @@ class TfidfFeature(Feature):
             self.wiki_summaries = pickle.load(infile)
 
         self.matches = 20
+        self.sentence_memo = QuestionMemo()
+        self.memo = QuestionMemo()
 
-    def __call__(self, question, run, guess):
-        # get question first sentence
-        tf_q = self.featurizer.transform([question['first_sentence']])
+    def vectorize(self, texts):
+        return self.featurizer.transform(texts)
 
-        # get similar Wikipedia sentences by tfidf
-        cos_sim = linear_kernel(tf_q, self.wiki_sentences['tfidf']).flatten()
-        best_match_sentences_idx = cos_sim.argsort()[:-self.matches:-1]
+    def documents(self):
+        return self.wiki_sentences['tfidf']
 
-        related_sentences_sim = cos_sim[best_match_sentences_idx]
-        related_sentences_labels = [self.wiki_sentences['labels'][i] for i in best_match_sentences_idx]
+    def label(self, row):
+        return self.wiki_sentences['labels'][row]
+
+    def guess_rank(self, question, guess):
+        tf_q, related_sentences_sim, related_sentences_labels = self.sentence_memo(self.first_sentence_matches, question)
         guess_in_rel = [guess in s for s in related_sentences_labels]
         if any(guess_in_rel) and len(guess) > 0:
-            guess_idx = guess_in_rel.index(True)
-
             # tfidf rank and similarity of sentence from guess in relation to first sentence, 0 if guess did not appear
-            yield('guess_rank_rel_fs', guess_idx)
-
-            #yield('guess_sim_rel_fs', related_sentences_sim[guess_idx])
+            return guess_in_rel.index(True)
         else:
-            yield('guess_rank_rel_fs', 0)
-            # yield('guess_sim_rel_fs', 0)
-        pass
+            return 0
+
+    def __call__(self, question, run, guess):
+        yield('guess_rank_rel_fs', self.memo(self.guess_rank, question, guess))
+        #yield('guess_sim_rel_fs', related_sentences_sim[guess_idx])
 
-# enumerate numpy array
-def enum_arr(arr, name):
-    return [("%s_%d" % (name, i), e) for i, e in enumerate(arr)]
+# enumerate the nonzero entries of a sparse row
+def enum_sparse(row, name):
+    row = row.tocsr()
+    row.sort_indices()
+    return [("%s_%d" % (name, i), e) for i, e in zip(row.indices, row.data) if e != 0]
 
 """
 Text vectorizer features
@@ -193,8 +455,13 @@ Text vectorizer features
 class TextVectorizerFeature(Feature):
     """
     Abstract class for feature that produces an (SKLearn) vectorization of text
+
+    Only the nonzero entries of the vectorization are features.
     """
 
+    # The texts of a run that are vectorized
+    fields = ["first_sentence", "run", "guess"]
+
     def __init__(self, name):
         self.name = name
 
@@ -204,7 +471,43 @@ class TextVectorizerFeature(Feature):
         self.fit_vec = vectorizer.fit(corpus)
 
     def vectorize(self, text, text_name):
-        return enum_arr(self.fit_vec.transform([text]).toarray()[0], text_name)
+        return enum_sparse(self.fit_vec.transform([text]), text_name)
+
+    def __call__(self, question, run, guess):
+        yield from self.vectorize(question['first_sentence'], "first_sentence")
+        yield from self.vectorize(run, "run")
+        yield from self.vectorize(guess, "guess")
+
+    def _distinct_rows(self, values):
+        """
+        Vectorize each distinct text once; return the matrix indexed so it
+        has a row for every value.
+        """
+        index = {}
+        rows = [index.setdefault(x, len(index)) for x in values]
+        return self.fit_vec.transform(list(index))[rows]
+
+    def batch(self, questions, runs, guesses, guess_histories=None):
+        """
+        Vectorize all first sentences (once per question), runs and guesses
+        with one call each, and keep the columns that have a nonzero value.
+        """
+        vocabulary_size = len(self.fit_vec.vocabulary_)
+        first_sentences = OrderedDict()
+        question_ids = [QuestionMemo.question_key(x) for x in questions]
+        for key, question in zip(question_ids, questions):
+            first_sentences.setdefault(key, question['first_sentence'])
+        lookup = dict((x, ii) for ii, x in enumerate(first_sentences))
+        first_sentence_rows = self.fit_vec.transform(list(first_sentences.values()))[[lookup[x] for x in question_ids]]
+
+        matrix = hstack([first_sentence_rows,
+                         self.fit_vec.transform([runs[x] for x in range(len(questions))]),
+                         self._distinct_rows(guesses)]).tocsr()
+        matrix.eliminate_zeros()
+
+        names = ["%s_%d" % (field, x) for field in self.fields for x in range(vocabulary_size)]
+        used = np.flatnonzero(matrix.getnnz(axis=0))
+        return [names[x] for x in used], matrix[:, used]
 
 class CountsVecFeature(TextVectorizerFeature):
     """
@@ -214,11 +517,6 @@ class CountsVecFeature(TextVectorizerFeature):
         from sklearn.feature_extraction.text import CountVectorizer
         super().add_training(question_source, CountVectorizer(max_features=100))
 
-    def __call__(self, question, run, guess):
-        yield from super().vectorize(question['first_sentence'], "first_sentence")
-        yield from super().vectorize(run, "run")
-        yield from super().vectorize(guess, "guess")
-
 class TfidfVecFeature(TextVectorizerFeature):
     """
     Feature that gets TF-IDF vectorized question text
@@ -227,11 +525,6 @@ class TfidfVecFeature(TextVectorizerFeature):
         from sklearn.feature_extraction.text import TfidfVectorizer
         super().add_training(question_source, TfidfVectorizer(max_features=100))
 
-    def __call__(self, question, run, guess):
-        yield from super().vectorize(question['first_sentence'], "first_sentence")
-        yield from super().vectorize(run, "run")
-        yield from super().vectorize(guess, "guess")
-
 """
 Whether guess is an English phrase (i.e., not a name or foreign phrase)
 """
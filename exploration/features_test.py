@@ -0,0 +1,153 @@
+import os
+import json
+import tempfile
+import unittest
+
+import numpy as np
+from scipy.sparse import random as sparse_random
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from features import CountsVecFeature, QuestionMemo, TfidfFeature, TfidfVecFeature, page_index
+from topk import top_k_similar
+
+
+class FeaturesTest(unittest.TestCase):
+    def setUp(self):
+        sentences = ["the capital of england is london", "london is on the thames",
+                     "paris is the capital of france", "the seine flows through paris",
+                     "madrid is the capital of spain"]
+        labels = ["London", "London", "Paris", "Paris", "Madrid"]
+
+        # Skip reading the pickles from data/
+        self.tfidf = TfidfFeature.__new__(TfidfFeature)
+        self.tfidf.name = "Tfidf"
+        self.tfidf.featurizer = TfidfVectorizer().fit(sentences)
+        self.tfidf.wiki_sentences = {"tfidf": self.tfidf.featurizer.transform(sentences), "labels": labels}
+        self.tfidf.matches = 4
+        self.tfidf.sentence_memo = QuestionMemo()
+        self.tfidf.memo = QuestionMemo()
+
+        self.question = {"qanta_id": 7, "first_sentence": "this city on the seine is the capital of france"}
+
+    def test_memo(self):
+        calls = []
+        memo = QuestionMemo(size=2)
+        square = lambda question, x: calls.append(x) or x * x
+        self.assertEqual(memo(square, {"qanta_id": 1}, 3), 9)
+        self.assertEqual(memo(square, {"qanta_id": 1}, 3), 9)
+        self.assertEqual(calls, [3])
+        self.assertEqual(memo.hits, 1)
+
+        memo(square, {"qanta_id": 2}, 3)
+        memo(square, {"qanta_id": 3}, 3)
+        self.assertEqual(len(memo.values), 2)
+        memo(square, {"qanta_id": 1}, 3)
+        self.assertEqual(calls, [3, 3, 3, 3])
+
+    def test_first_sentence_once(self):
+        runs = ["this city", "this city on the seine", "this city on the seine is the capital"]
+        expected = {"Paris": 0, "London": 1, "Madrid": 3}
+        for guess in ["Paris", "London", "Paris", "Madrid"]:
+            for run in runs:
+                features = dict(self.tfidf(self.question, run, guess))
+                self.assertEqual(features["guess_rank_rel_fs"], expected[guess])
+
+        # One similarity computation for the question, one rank per distinct guess
+        self.assertEqual(len(self.tfidf.sentence_memo.values), 1)
+        self.assertEqual(len(self.tfidf.memo.values), 3)
+
+    def test_top_k_similar(self):
+        queries = sparse_random(30, 50, density=0.1, format="csr", random_state=3)
+        documents = sparse_random(200, 50, density=0.1, format="csr", random_state=4)
+        dense = (queries @ documents.T).toarray()
+        for k in [1, 5, 300]:
+            for (sparse_best, sparse_scores), (dense_best, dense_scores), row in \
+                    zip(top_k_similar(queries, documents, k, block_size=7),
+                        top_k_similar(queries.toarray(), documents.toarray(), k), dense):
+                # The sparse version only returns documents with a nonzero score
+                nonzero = np.count_nonzero(row)
+                self.assertEqual(len(sparse_best), min(k, nonzero))
+                self.assertEqual(len(dense_best), min(k, len(row)))
+                self.assertTrue(np.allclose(sparse_scores, np.sort(row)[::-1][:len(sparse_best)]))
+                self.assertTrue(np.allclose(dense_scores[:len(sparse_scores)], sparse_scores))
+
+    def test_batch(self):
+        questions = [{"qanta_id": x, "first_sentence": sentence} for x, sentence in
+                     enumerate(["the capital of france", "the river thames in london", "the capital of spain"])]
+        question_runs = [x for x in questions for _ in range(3)]
+        runs = ["run"] * len(question_runs)
+        guesses = ["Paris", "London", "Madrid"] * 3
+
+        self.tfidf.sentence_memo = QuestionMemo(size=2)
+        self.tfidf.memo = QuestionMemo(size=2)
+        names, matrix = self.tfidf.batch(question_runs, runs, guesses)
+        self.tfidf.sentence_memo = QuestionMemo()
+        self.tfidf.memo = QuestionMemo()
+        expected = [dict(self.tfidf(x, y, z)) for x, y, z in zip(question_runs, runs, guesses)]
+        self.assertEqual([dict((names[x], matrix[row, x]) for x in range(len(names)))
+                          for row in range(len(runs))], expected)
+
+    def test_batch_many_guesses(self):
+        matched = []
+        match_questions = self.tfidf.match_questions
+        self.tfidf.match_questions = lambda questions: matched.append(len(questions)) or match_questions(questions)
+
+        questions = [{"qanta_id": x, "first_sentence": "the capital of france %i" % x} for x in range(4)]
+        guesses = ["Paris", "London", "Madrid", "Rome", "Berlin", "Oslo"]
+        question_runs = [x for x in questions for _ in guesses]
+        self.tfidf.sentence_memo = QuestionMemo(size=2)
+        self.tfidf.memo = QuestionMemo(size=4)
+        self.tfidf.batch(question_runs, ["run"] * len(question_runs), guesses * len(questions))
+
+        # The guesses never push a question's matches out, so every first
+        # sentence is matched once, in batches of two
+        self.assertEqual(matched, [2, 2])
+
+    def test_text_vectorizer_batch(self):
+        from sklearn.feature_extraction.text import CountVectorizer
+        from feature_store import block_from_calls
+
+        corpus = ["the capital of england is london", "paris is the capital of france",
+                  "the seine flows through paris"]
+        questions = [{"qanta_id": 1, "first_sentence": "the capital of england"},
+                     {"qanta_id": 2, "first_sentence": "a river in paris"}]
+        question_runs = [questions[0], questions[0], questions[1]]
+        runs = ["the capital", "the capital of england is", "a river"]
+        guesses = ["London", "London", "Seine"]
+
+        for feature_class, vectorizer in [(CountsVecFeature, CountVectorizer()),
+                                          (TfidfVecFeature, TfidfVectorizer())]:
+            feature = feature_class("Vec")
+            feature.fit_vec = vectorizer.fit(corpus)
+
+            # Only nonzero entries are features
+            features = list(feature(questions[0], runs[1], guesses[1]))
+            self.assertTrue(all(value != 0 for name, value in features))
+            self.assertIn("guess_%i" % feature.fit_vec.vocabulary_["london"], dict(features))
+
+            names, matrix = feature.batch(question_runs, runs, guesses)
+            expected_names, expected = block_from_calls(feature, question_runs, runs, guesses)
+            self.assertEqual(sorted(names), sorted(expected_names))
+            order = [expected_names.index(x) for x in names]
+            self.assertAlmostEqual(abs(matrix - expected[:, order]).sum(), 0.0)
+
+    def test_page_index(self):
+        wiki = [{"page": "London", "text": "capital"}, {"page": "Jane_Austen", "text": "author"},
+                {"page": "london", "text": "duplicate"}]
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "wiki_page_text.json")
+            with open(filename, 'w') as outfile:
+                json.dump(wiki, outfile)
+
+            names, rows = page_index(filename, wiki, str.lower)
+            self.assertEqual(names, ["london", "jane austen", "london"])
+            self.assertEqual(rows, {"london": 0, "jane austen": 1})
+
+            # The saved titles are reused without normalizing again
+            def fail(title):
+                raise AssertionError("Normalized %s again" % title)
+            self.assertEqual(page_index(filename, wiki, fail), (names, rows))
+
+
+if __name__ == '__main__':
+    unittest.main()
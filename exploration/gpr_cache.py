@@ -0,0 +1,571 @@
+# Jordan Boyd-Graber
+# 2023
+#
+# Storage backends for the GprGuesser's cache of API results.
+
+import os
+import glob
+import json
+import sqlite3
+import logging
+import tarfile
+import time
+import queue
+import threading
+
+from collections import OrderedDict, defaultdict
+from json import JSONDecodeError
+
+
+def normalize_question(question):
+    """
+    The form of a question that is used as a cache key.
+    """
+    # Remove non-breaking spaces
+    return question.replace("\xa0", " ")
+
+
+def collapse_whitespace(text):
+    return " ".join(text.split())
+
+
+class PrefixIndex:
+    """
+    Finds the longest cached question that is a prefix of a query (ending
+    at a word boundary and ignoring differences in whitespace).  Runs of a
+    question are prefixes of each other, so this can answer a query from a
+    slightly shorter run that is in the cache.
+    """
+
+    def __init__(self, keys=()):
+        self._keys = {}
+        for key in keys:
+            self.add(key)
+
+    def add(self, key):
+        self._keys.setdefault(collapse_whitespace(key), key)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def longest_prefix(self, question, max_words):
+        """
+        Return the cached key for the longest prefix of the question that
+        drops at most max_words trailing words, or None.
+        """
+        for prefix in word_prefixes(question, max_words):
+            if prefix in self._keys:
+                return self._keys[prefix]
+        return None
+
+
+def word_prefixes(question, max_words):
+    """
+    The prefixes of a question (with collapsed whitespace) that drop at
+    most max_words trailing words, longest first.
+    """
+    collapsed = collapse_whitespace(question)
+    ends = [ii for ii, character in enumerate(collapsed) if character == " "] + [len(collapsed)]
+    return [collapsed[:end] for end in reversed(ends[-(max_words + 1):])]
+
+
+def decode_member(member):
+    """
+    Decode one (name, raw bytes) tar member into (name, dictionary with
+    normalized keys), or (name, None) if it is not valid json.
+    """
+    name, raw = member
+    try:
+        entries = json.loads(raw.decode('utf-8', errors='ignore'))
+    except JSONDecodeError as e:
+        logging.warning("Failed to load cache from %s: %s" % (name, str(e)))
+        return name, None
+    if not isinstance(entries, dict):
+        logging.warning("Cache member %s is not a dictionary" % name)
+        return name, None
+
+    # Only the few keys that need it are renamed, rather than copying the
+    # whole dictionary
+    for key in [x for x in entries if "\xa0" in x]:
+        entries[normalize_question(key)] = entries.pop(key)
+    return name, entries
+
+
+def tar_members(filename):
+    """
+    Stream the (name, raw bytes) of each json member of a gzipped tarball,
+    reading it front to back once.
+    """
+    with tarfile.open(filename, 'r|gz') as tar:
+        for member in tar:
+            if member.name.endswith(".pkl") or "/._" in member.name or not member.isfile():
+                logging.debug("Skipping %s" % member)
+                continue
+            logging.debug("Reading from %s" % member)
+            try:
+                with tar.extractfile(member) as infile:
+                    raw = infile.read()
+            except IOError as e:
+                logging.warning("Failed to load cache from %s: %s" % (member.name, str(e)))
+                continue
+            yield member.name, raw
+
+
+def prefetch(iterator, size):
+    """
+    Run an iterator in a background thread, keeping up to size of its items
+    ready, and generate them.
+    """
+    ready = queue.Queue(size)
+    finished = object()
+
+    def produce():
+        try:
+            for item in iterator:
+                ready.put((item, None))
+        except Exception as e:
+            ready.put((None, e))
+        ready.put((finished, None))
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item, error = ready.get()
+        if error is not None:
+            raise error
+        if item is finished:
+            return
+        yield item
+
+
+def _decoded(filename, workers):
+    members = tar_members(filename)
+    if workers > 1:
+        # Decompression (which releases the GIL) overlaps with decoding.
+        # Decoding stays in this process: a decoded member is a large
+        # dictionary, and sending it back from another process costs about
+        # as much as decoding it.
+        members = prefetch(members, 4 * workers)
+    for member in members:
+        yield decode_member(member)
+
+
+def read_tar_cache(filename, workers=1):
+    """
+    Generate (member name, dictionary) pairs for each json member of a
+    gzipped tarball of cache shards, with normalized keys.  With more than
+    one worker, the tarball is decompressed in a background thread while
+    members are decoded.
+    """
+    start = time.time()
+    num_entries = 0
+    num_members = 0
+    for name, entries in _decoded(filename, workers):
+        if entries is None:
+            continue
+        num_entries += len(entries)
+        num_members += 1
+        yield name, entries
+
+    elapsed = max(time.time() - start, 1e-6)
+    logging.info("Read %i entries from %i members of %s in %0.1f seconds (%0.0f entries/sec)" %
+                 (num_entries, num_members, filename, elapsed, num_entries / elapsed))
+
+
+class WriteAheadLog:
+    """
+    An append-only file of new cache entries (one compact json line per
+    entry), so results are on disk as soon as they arrive and saving does
+    not have to rewrite the cache.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._outfile = None
+
+    def append(self, question, result):
+        if self._outfile is None:
+            self._outfile = open(self.filename, 'a')
+        self._outfile.write(json.dumps([question, result]) + "\n")
+        self._outfile.flush()
+
+    def replay(self):
+        """
+        Generate the (question, result) pairs in the log, skipping a
+        partially written last line.
+        """
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename) as infile:
+            for line in infile:
+                try:
+                    question, result = json.loads(line)
+                except (ValueError, JSONDecodeError):
+                    logging.warning("Skipping unreadable line in %s" % self.filename)
+                    continue
+                yield question, result
+
+    def clear(self):
+        if self._outfile is not None:
+            self._outfile.close()
+            self._outfile = None
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+def shard_files(prefix):
+    """
+    The loose shard files ("prefix" followed by a five digit shard id)
+    written when a cache is compacted.
+    """
+    return sorted(glob.glob(glob.escape(prefix) + "[0-9]" * 5))
+
+
+def merge_shard_file(filename, entries):
+    """
+    Add entries to a shard file (creating it if needed), written compactly
+    and atomically.
+    """
+    merged = {}
+    if os.path.exists(filename):
+        with open(filename) as infile:
+            merged = json.load(infile)
+    merged.update(entries)
+    with open("%s.tmp" % filename, 'w') as outfile:
+        json.dump(merged, outfile, separators=(',', ':'))
+    os.replace("%s.tmp" % filename, filename)
+    return len(merged)
+
+
+def source_files(filename):
+    """
+    The files a cache's results can come from: the tarball, the shard
+    files compacted since it was made, and the write-ahead log of results
+    that were not compacted yet.
+    """
+    return [filename] + shard_files(filename) + ["%s.wal" % filename]
+
+
+def source_signature(filename):
+    """
+    The names, sizes and modification times of a cache's source files, so
+    a backend built from them can tell when it is out of date.
+    """
+    signature = []
+    for name in source_files(filename):
+        if os.path.exists(name):
+            stat = os.stat(name)
+            signature.append([name, stat.st_size, stat.st_mtime_ns])
+    return json.dumps(signature)
+
+
+def read_cache_sources(filename, workers=1):
+    """
+    Generate (name, dictionary) pairs of every source of a cache's results,
+    oldest first, so later results replace earlier ones.
+    """
+    if os.path.exists(filename):
+        yield from read_tar_cache(filename, workers)
+    for shard in shard_files(filename):
+        with open(shard) as infile:
+            yield shard, json.load(infile)
+    log = WriteAheadLog("%s.wal" % filename)
+    logged = dict((normalize_question(x), y) for x, y in log.replay())
+    if logged:
+        yield log.filename, logged
+
+
+class SqliteCache:
+    """
+    A cache of API results in a sqlite database keyed by normalized
+    question, so lookups read one row from disk instead of needing the whole
+    cache in memory.  The most recently used lookups (including misses) are
+    kept in a bounded in-memory LRU.
+
+    Behaves like a dictionary from question to result.
+    """
+
+    kMISSING = object()
+
+    def __init__(self, filename, lru_size=10000):
+        self.filename = filename
+        self.lru_size = lru_size
+        self._lru = OrderedDict()
+        self._connection = sqlite3.connect(filename)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS cache "
+                                 "(question TEXT PRIMARY KEY, result TEXT NOT NULL, collapsed TEXT)")
+        columns = [x[1] for x in self._connection.execute("PRAGMA table_info(cache)")]
+        if "collapsed" not in columns:
+            # Databases made before prefix lookups were indexed
+            self._connection.create_function("collapse", 1, collapse_whitespace)
+            self._connection.execute("ALTER TABLE cache ADD COLUMN collapsed TEXT")
+            self._connection.execute("UPDATE cache SET collapsed = collapse(question)")
+        # Prefix lookups (see longest_prefix) search the collapsed questions
+        self._connection.execute("CREATE INDEX IF NOT EXISTS cache_collapsed ON cache (collapsed)")
+        # The signature of the sources last imported (see import_cache)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS imported (signature TEXT NOT NULL)")
+        self._connection.commit()
+
+    def _remember(self, question, result):
+        self._lru[question] = result
+        self._lru.move_to_end(question)
+        if len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def get(self, question, default=None):
+        question = normalize_question(question)
+        if question in self._lru:
+            self._lru.move_to_end(question)
+            result = self._lru[question]
+        else:
+            row = self._connection.execute("SELECT result FROM cache WHERE question = ?",
+                                           (question,)).fetchone()
+            result = self.kMISSING if row is None else json.loads(row[0])
+            self._remember(question, result)
+        return default if result is self.kMISSING else result
+
+    def __contains__(self, question):
+        return self.get(question, self.kMISSING) is not self.kMISSING
+
+    def __getitem__(self, question):
+        result = self.get(question, self.kMISSING)
+        if result is self.kMISSING:
+            raise KeyError(question)
+        return result
+
+    def __setitem__(self, question, result):
+        question = normalize_question(question)
+        self._connection.execute("INSERT OR REPLACE INTO cache (question, result, collapsed) VALUES (?, ?, ?)",
+                                 (question, json.dumps(result), collapse_whitespace(question)))
+        self._remember(question, result)
+
+    def update(self, entries):
+        """
+        Add many entries at once (in one transaction).
+        """
+        rows = []
+        for question, result in entries.items():
+            question = normalize_question(question)
+            rows.append((question, json.dumps(result), collapse_whitespace(question)))
+        self._connection.executemany("INSERT OR REPLACE INTO cache (question, result, collapsed) "
+                                     "VALUES (?, ?, ?)", rows)
+        self._connection.commit()
+        for question, _, _ in rows:
+            self._lru.pop(question, None)
+
+    def longest_prefix(self, question, max_words):
+        """
+        The cached question that is the longest prefix of this one (see
+        PrefixIndex): each candidate prefix is an exact lookup in the index
+        of collapsed questions, so no keys are read into memory.
+        """
+        prefixes = word_prefixes(normalize_question(question), max_words)
+        row = self._connection.execute(
+            "SELECT question FROM cache WHERE collapsed IN (%s) ORDER BY length(collapsed) DESC LIMIT 1" %
+            ", ".join("?" * len(prefixes)), prefixes).fetchone()
+        return None if row is None else row[0]
+
+    def __len__(self):
+        return self._connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def __iter__(self):
+        for row in self._connection.execute("SELECT question FROM cache"):
+            yield row[0]
+
+    def items(self):
+        for question, result in self._connection.execute("SELECT question, result FROM cache"):
+            yield question, json.loads(result)
+
+    def commit(self):
+        self._connection.commit()
+
+    def close(self):
+        self._connection.commit()
+        self._connection.close()
+
+    def imported(self, filename):
+        """
+        Whether the sources of the cache at filename have not changed since
+        they were last imported.
+        """
+        row = self._connection.execute("SELECT signature FROM imported").fetchone()
+        return row is not None and row[0] == source_signature(filename)
+
+    def import_cache(self, filename, workers=1):
+        """
+        Import (or import again, if they have changed) the tarball of json
+        cache shards at filename, its compacted shard files and its log.
+        Results added to the database since are kept unless a source has a
+        result for the same question.
+        """
+        logging.info("Importing %s into %s" % (filename, self.filename))
+        signature = source_signature(filename)
+        for name, entries in read_cache_sources(filename, workers):
+            self.update(entries)
+            logging.debug("Imported %i entries from %s" % (len(entries), name))
+        # Recorded last, so an interrupted import is done again
+        self._connection.execute("DELETE FROM imported")
+        self._connection.execute("INSERT INTO imported (signature) VALUES (?)", (signature,))
+        self._connection.commit()
+        logging.info("%i entries in %s" % (len(self), self.filename))
+
+
+class LazyShardCache:
+    """
+    A cache of API results split into shard files (one json file per shard
+    id, as computed by a shard function on the question) that only loads a
+    shard when a question that maps to it is looked up.  At most max_shards
+    shards are kept in memory; the least recently used is dropped (after
+    being written back if it has new entries).
+
+    Behaves like a dictionary from question to result.
+    """
+
+    def __init__(self, directory, shard_function, max_shards=64):
+        self.directory = directory
+        self.shard_function = shard_function
+        self.max_shards = max_shards
+        self._shards = OrderedDict()
+        self._prefixes = {}
+        self._dirty = set()
+        self.shards_read = 0
+
+    def shard_filename(self, shard):
+        return os.path.join(self.directory, "%05i.json" % shard)
+
+    def signature_filename(self):
+        return os.path.join(self.directory, "imported.signature")
+
+    def imported(self, filename):
+        """
+        Whether the sources of the cache at filename have not changed since
+        they were last split into shards.
+        """
+        if not os.path.exists(self.signature_filename()):
+            return False
+        with open(self.signature_filename()) as infile:
+            return infile.read() == source_signature(filename)
+
+    def import_cache(self, filename, workers=1):
+        """
+        Split (or split again, if they have changed) the tarball of cache
+        shards at filename, its compacted shard files and its log into one
+        file per shard id, merging them into the shard files that are
+        already there.
+        """
+        logging.info("Splitting %s into shards in %s" % (filename, self.directory))
+        self.commit()
+        signature = source_signature(filename)
+        shards = defaultdict(dict)
+        for name, entries in read_cache_sources(filename, workers):
+            for question, result in entries.items():
+                question = normalize_question(question)
+                shards[self.shard_function(question)][question] = result
+
+        os.makedirs(self.directory, exist_ok=True)
+        for shard, entries in shards.items():
+            merge_shard_file(self.shard_filename(shard), entries)
+        self._shards.clear()
+        self._prefixes.clear()
+
+        # Written last, so an interrupted split is done again
+        with open(self.signature_filename(), 'w') as outfile:
+            outfile.write(signature)
+        logging.info("Wrote %i shards to %s" % (len(shards), self.directory))
+
+    def _shard(self, question):
+        """
+        The (loaded) dictionary of the shard a normalized question maps to.
+        """
+        shard = self.shard_function(question)
+        if shard in self._shards:
+            self._shards.move_to_end(shard)
+            return shard, self._shards[shard]
+
+        filename = self.shard_filename(shard)
+        entries = {}
+        if os.path.exists(filename):
+            with open(filename) as infile:
+                entries = json.load(infile)
+            self.shards_read += 1
+            logging.debug("Loaded %i entries from shard %i" % (len(entries), shard))
+
+        self._shards[shard] = entries
+        while len(self._shards) > self.max_shards:
+            evicted, evicted_entries = self._shards.popitem(last=False)
+            self._prefixes.pop(evicted, None)
+            if evicted in self._dirty:
+                self._write(evicted, evicted_entries)
+        return shard, entries
+
+    def _write(self, shard, entries):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.shard_filename(shard), 'w') as outfile:
+            json.dump(entries, outfile)
+        self._dirty.discard(shard)
+
+    def get(self, question, default=None):
+        question = normalize_question(question)
+        return self._shard(question)[1].get(question, default)
+
+    def __contains__(self, question):
+        question = normalize_question(question)
+        return question in self._shard(question)[1]
+
+    def __getitem__(self, question):
+        question = normalize_question(question)
+        return self._shard(question)[1][question]
+
+    def __setitem__(self, question, result):
+        question = normalize_question(question)
+        shard, entries = self._shard(question)
+        entries[question] = result
+        self._dirty.add(shard)
+        if shard in self._prefixes:
+            self._prefixes[shard].add(question)
+
+    def longest_prefix(self, question, max_words):
+        """
+        The cached question that is the longest prefix of this one (see
+        PrefixIndex).  Each candidate prefix is looked up in its own shard:
+        a prefix is usually in the query's shard, but not always (e.g. the
+        GprGuesser pads questions too short to fill its shard prefix).
+        """
+        for prefix in word_prefixes(normalize_question(question), max_words):
+            shard, entries = self._shard(prefix)
+            if shard not in self._prefixes:
+                self._prefixes[shard] = PrefixIndex(entries)
+            found = self._prefixes[shard].longest_prefix(prefix, 0)
+            if found is not None:
+                return found
+        return None
+
+    def _shard_ids(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(int(x.split(".")[0]) for x in os.listdir(self.directory) if x.endswith(".json"))
+
+    def items(self):
+        """
+        Every entry (this reads every shard, so avoid it for large caches).
+        """
+        for shard in sorted(set(self._shard_ids()) | set(self._shards)):
+            if shard in self._shards:
+                entries = self._shards[shard]
+            else:
+                with open(self.shard_filename(shard)) as infile:
+                    entries = json.load(infile)
+            yield from entries.items()
+
+    def __iter__(self):
+        for question, _ in self.items():
+            yield question
+
+    def __len__(self):
+        return sum(1 for _ in self.items())
+
+    def commit(self):
+        """
+        Write the shards with new entries back to disk.
+        """
+        for shard in list(self._dirty):
+            self._write(shard, self._shards[shard])
@@ -0,0 +1,205 @@
+import io
+import os
+import json
+import tarfile
+import tempfile
+import unittest
+
+from gpr_cache import LazyShardCache, PrefixIndex, SqliteCache, WriteAheadLog, \
+    decode_member, merge_shard_file, prefetch, read_tar_cache, shard_files
+
+kSHARDS = {"gpt_cache00001": {"This capital of England": {"guess": "London", "confidence": 0.9},
+                              "The author of Pride\xa0and Prejudice": {"guess": "Jane_Austen", "confidence": 0.8}},
+           "gpt_cache00042": {"The composer of the Magic Flute": {"guess": "Mozart", "confidence": 0.7}}}
+
+
+def write_tarball(filename, shards):
+    with tarfile.open(filename, 'w:gz') as tar:
+        for name, entries in shards.items():
+            raw = json.dumps(entries).encode('utf-8')
+            info = tarfile.TarInfo(name)
+            info.size = len(raw)
+            tar.addfile(info, io.BytesIO(raw))
+
+
+class GprCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.tarball = os.path.join(self.directory.name, "gpt_cache.tar.gz")
+        write_tarball(self.tarball, kSHARDS)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_read_tar(self):
+        entries = {}
+        for name, shard in read_tar_cache(self.tarball):
+            entries.update(shard)
+        self.assertEqual(len(entries), 3)
+        self.assertIn("The author of Pride and Prejudice", entries)
+
+    def test_parallel_read(self):
+        shards = dict(("gpt_cache%05i" % x, {"Question %i about Paris\xa0France" % x: {"guess": "Paris"}})
+                      for x in range(40))
+        write_tarball(self.tarball, shards)
+
+        serial = list(read_tar_cache(self.tarball))
+        parallel = list(read_tar_cache(self.tarball, workers=3))
+        self.assertEqual(serial, parallel)
+        self.assertEqual(len(parallel), 40)
+        self.assertIn("Question 3 about Paris France", dict(parallel)["gpt_cache00003"])
+
+        def failing():
+            yield 1
+            raise IOError("truncated")
+        with self.assertRaises(IOError):
+            list(prefetch(failing(), 2))
+        self.assertEqual(list(prefetch(iter(range(10)), 2)), list(range(10)))
+
+        self.assertEqual(decode_member(("broken", b'{"Question": ')), ("broken", None))
+        self.assertEqual(decode_member(("list", b'[1, 2]')), ("list", None))
+
+    def test_sqlite(self):
+        cache = SqliteCache(os.path.join(self.directory.name, "cache.sqlite"), lru_size=2)
+        cache.import_cache(self.tarball)
+        self.assertEqual(len(cache), 3)
+
+        self.assertEqual(cache["This capital of England"]["guess"], "London")
+        self.assertEqual(cache["The author of Pride\xa0and Prejudice"]["guess"], "Jane_Austen")
+        self.assertNotIn("The capital of France", cache)
+        self.assertLessEqual(len(cache._lru), 2)
+        with self.assertRaises(KeyError):
+            cache["The capital of France"]
+
+        cache["The capital of France"] = {"guess": "Paris", "confidence": 1.0}
+        cache.close()
+
+        reopened = SqliteCache(cache.filename)
+        self.assertEqual(reopened.get("The capital of France")["guess"], "Paris")
+        self.assertEqual(sorted(reopened), sorted(dict(reopened.items())))
+
+    def test_lazy_shards(self):
+        shard_function = lambda question: len(question) % 7
+        cache = LazyShardCache(os.path.join(self.directory.name, "shards"), shard_function, max_shards=1)
+        cache.import_cache(self.tarball)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.shards_read, 0)
+
+        # Each lookup only reads the shard the question maps to
+        self.assertEqual(cache["This capital of England"]["guess"], "London")
+        self.assertEqual(cache.shards_read, 1)
+        self.assertEqual(cache.get("This capital of England")["guess"], "London")
+        self.assertEqual(cache.shards_read, 1)
+        self.assertEqual(cache["The author of Pride\xa0and Prejudice"]["guess"], "Jane_Austen")
+        self.assertEqual(len(cache._shards), 1)
+        self.assertNotIn("The capital of France", cache)
+
+        # New entries survive eviction and reopening
+        cache["The capital of France"] = {"guess": "Paris", "confidence": 1.0}
+        cache.get("The composer of the Magic Flute")
+        cache.commit()
+        reopened = LazyShardCache(cache.directory, shard_function)
+        self.assertEqual(reopened["The capital of France"]["guess"], "Paris")
+        self.assertEqual(len(reopened), 4)
+
+    def test_import_sources(self):
+        # Results the memory backend compacted or only logged
+        merge_shard_file("%s%05i" % (self.tarball, 3), {"The capital of France": {"guess": "Paris"}})
+        WriteAheadLog("%s.wal" % self.tarball).append("The capital of\xa0Spain", {"guess": "Madrid"})
+
+        sqlite = SqliteCache(os.path.join(self.directory.name, "cache.sqlite"))
+        shards = LazyShardCache(os.path.join(self.directory.name, "shards"), lambda x: len(x) % 5)
+        for cache in [sqlite, shards]:
+            self.assertFalse(cache.imported(self.tarball))
+            cache.import_cache(self.tarball)
+            self.assertTrue(cache.imported(self.tarball))
+            self.assertEqual(len(cache), 5)
+            self.assertEqual(cache["The capital of France"]["guess"], "Paris")
+            self.assertEqual(cache["The capital of Spain"]["guess"], "Madrid")
+
+            # Added with this backend, then the tarball changes
+            cache["The capital of Peru"] = {"guess": "Lima"}
+            cache.commit()
+        write_tarball(self.tarball, {"gpt_cache00001": {"The capital of Italy": {"guess": "Rome"}}})
+        for cache in [sqlite, shards]:
+            self.assertFalse(cache.imported(self.tarball))
+            cache.import_cache(self.tarball)
+            self.assertEqual(cache["The capital of Italy"]["guess"], "Rome")
+            self.assertEqual(cache["The capital of Peru"]["guess"], "Lima")
+
+    def test_prefix_index(self):
+        index = PrefixIndex(["This capital", "This capital of  England", "The composer"])
+        self.assertEqual(index.longest_prefix("This capital of England", 0), "This capital of  England")
+        self.assertEqual(index.longest_prefix("This capital of England is", 1), "This capital of  England")
+        self.assertEqual(index.longest_prefix("This capital of Engl", 2), "This capital")
+        self.assertIsNone(index.longest_prefix("This capital of Engl", 1))
+        # Prefixes have to end at a word boundary
+        self.assertIsNone(index.longest_prefix("The composers of", 3))
+
+    def test_cache_prefixes(self):
+        sqlite = SqliteCache(os.path.join(self.directory.name, "cache.sqlite"))
+        sqlite.import_cache(self.tarball)
+        shards = LazyShardCache(os.path.join(self.directory.name, "shards"), lambda x: len(x.split()[0]))
+        shards.import_cache(self.tarball)
+
+        for cache in [sqlite, shards]:
+            self.assertEqual(cache.longest_prefix("This capital of England was", 1), "This capital of England")
+            self.assertIsNone(cache.longest_prefix("This capital of England was founded", 1))
+            cache["The capital of France"] = {"guess": "Paris", "confidence": 1.0}
+            self.assertEqual(cache.longest_prefix("The capital of France is", 2), "The capital of France")
+
+    def test_short_prefix_shard(self):
+        # Like GprGuesser.clean_for_shard: the first four letters, padded
+        # with "a", so a short prefix is in a different shard than the
+        # questions that start with it
+        def shard_function(question):
+            letters = "".join(x for x in question.lower() if x.isalpha())[:4]
+            return sum(ord(x) for x in letters.ljust(4, "a"))
+
+        shards = LazyShardCache(os.path.join(self.directory.name, "shards"), shard_function)
+        shards["Mao"] = {"guess": "Mao_Zedong", "confidence": 0.6}
+        self.assertNotEqual(shard_function("Mao"), shard_function("Mao was"))
+        self.assertEqual(shards.longest_prefix("Mao was", 1), "Mao")
+        self.assertIsNone(shards.longest_prefix("Mao was born", 1))
+
+    def test_sqlite_prefix_index(self):
+        import sqlite3
+        # A database from before prefixes were indexed
+        filename = os.path.join(self.directory.name, "old.sqlite")
+        connection = sqlite3.connect(filename)
+        connection.execute("CREATE TABLE cache (question TEXT PRIMARY KEY, result TEXT NOT NULL)")
+        connection.execute("INSERT INTO cache VALUES (?, ?)", ("This capital of  England", '{"guess": "London"}'))
+        connection.commit()
+        connection.close()
+
+        cache = SqliteCache(filename)
+        self.assertEqual(cache.longest_prefix("This capital of England was", 1), "This capital of  England")
+        self.assertIsNone(cache.longest_prefix("This capital", 1))
+        plan = cache._connection.execute("EXPLAIN QUERY PLAN SELECT question FROM cache WHERE collapsed IN (?)",
+                                         ("x",)).fetchall()
+        self.assertIn("cache_collapsed", str(plan))
+
+    def test_write_ahead_log(self):
+        log = WriteAheadLog(os.path.join(self.directory.name, "cache.wal"))
+        self.assertEqual(list(log.replay()), [])
+        log.append("The capital of France", {"guess": "Paris", "confidence": 1.0})
+        log.append("The capital of Spain", {"guess": "Madrid", "confidence": 1.0})
+        # A crash in the middle of a write leaves a partial line
+        with open(log.filename, 'a') as outfile:
+            outfile.write('["The capital of')
+        self.assertEqual([x for x, y in log.replay()], ["The capital of France", "The capital of Spain"])
+        log.clear()
+        self.assertFalse(os.path.exists(log.filename))
+
+    def test_merge_shards(self):
+        prefix = os.path.join(self.directory.name, "gpt_cache.tar.gz")
+        self.assertEqual(merge_shard_file("%s%05i" % (prefix, 7), {"a": 1}), 1)
+        self.assertEqual(merge_shard_file("%s%05i" % (prefix, 7), {"b": 2}), 2)
+        merge_shard_file("%s%05i" % (prefix, 12), {"c": 3})
+        self.assertEqual(shard_files(prefix), ["%s%05i" % (prefix, 7), "%s%05i" % (prefix, 12)])
+        with open("%s%05i" % (prefix, 7)) as infile:
+            self.assertEqual(json.load(infile), {"a": 1, "b": 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,6 +18,8 @@ from baseconv import BaseConverter
 kCACHE_MISS = "CACHE_MISS"
 from nltk.corpus import stopwords
 from guesser import alphanum
+from gpr_cache import LazyShardCache, PrefixIndex, SqliteCache, WriteAheadLog, \
+    merge_shard_file, normalize_question, read_tar_cache, shard_files
 
 class GprGuesser(Guesser):
     """
@@ -26,17 +28,47 @@ class GprGuesser(Guesser):
     reproducability.
     """
 
-    def __init__(self, cache_filename="data/gpt3_cache.json", num_examples=2, num_shards=9999, shard_vocab=ascii_lowercase, shard_prefix_length=5):
+    def __init__(self, cache_filename="data/gpt3_cache.json", num_examples=2, num_shards=9999, shard_vocab=ascii_lowercase, shard_prefix_length=5,
+                 cache_backend="memory", cache_db=None, lru_size=10000, max_shards=64,
+                 prefix_fallback=0, completion=None, load_workers=1):
         """
 
         @param num_examples: How many retrieval results to include in GPT prompt
+        @param cache_backend: "memory" reads the whole cache into a
+        dictionary, "sqlite" looks results up in a database on disk
+        (imported from cache_filename the first time), "shards" only
+        reads the shard a question maps to when it is looked up (split
+        from cache_filename the first time)
+        @param cache_db: The sqlite database (defaults to cache_filename + ".sqlite")
+        @param lru_size: How many sqlite lookups to keep in memory
+        @param max_shards: How many shards to keep in memory with the shards backend
+        @param prefix_fallback: On a cache miss, use the result for the
+        longest cached prefix of the question that drops at most this many
+        trailing words (0 to only use exact matches)
+        @param completion: What fills cache misses (e.g., a
+        completion.CompletionClient), or None to leave them as misses
+        @param load_workers: More than one reads the cache tarball in a
+        background thread (see gpr_cache.read_tar_cache)
         """
+        assert cache_backend in ["memory", "sqlite", "shards"], "Unknown cache backend %s" % cache_backend
         self.retrievers = {}
         self.cache = {}
         self.num_queries = 0
         self.num_shards = num_shards
         self.num_examples = num_examples
         self.cache_filename = cache_filename
+        self.cache_backend = cache_backend
+        self.cache_db = cache_db if cache_db else "%s.sqlite" % cache_filename
+        self.lru_size = lru_size
+        self.max_shards = max_shards
+        self.prefix_fallback = prefix_fallback
+        self.num_prefix_hits = 0
+        self.completion = completion
+        self.load_workers = load_workers
+        self._prefixes = None
+        # New results by shard, not yet compacted into the shard files
+        self._dirty = defaultdict(dict)
+        self._log = WriteAheadLog("%s.wal" % cache_filename)
         self.stopwords = set(stopwords.words("english"))
         for ii in ["one", "man"]:
             self.stopwords.add(ii)
@@ -70,6 +102,17 @@ class GprGuesser(Guesser):
 
         return shard
 
+    def longest_cached_prefix(self, question):
+        """
+        The cached question that is the longest prefix of this one (within
+        prefix_fallback words), or None.
+        """
+        if self.cache_backend != "memory":
+            return self.cache.longest_prefix(question, self.prefix_fallback)
+
+        if self._prefixes is None:
+            self._prefixes = PrefixIndex(self.cache)
+        return self._prefixes.longest_prefix(question, self.prefix_fallback)
               
 
 
@@ -77,18 +120,23 @@ class GprGuesser(Guesser):
         """
         Generate a guess, but grab from the cache first if it's available
         """
-        # Remove non-breaking spaces
-        question = question.replace("\xa0", " ")
+        question = normalize_question(question)
         
         # Check the cache, return it from there if we have it
         if question not in self.cache:
-            result = None
-            while result is None:
-                    result = kCACHE_MISS
-                    print("No cache found for: |%s|" % question)                                
-                    
-            if result != kCACHE_MISS:
-                self.cache[question] = result
+            if self.prefix_fallback > 0:
+                prefix = self.longest_cached_prefix(question)
+                if prefix is not None:
+                    self.num_prefix_hits += 1
+                    return [self.cache[prefix]]
+
+            result = kCACHE_MISS
+            if self.completion is not None:
+                result = self.completion.complete_all([question]).get(question, kCACHE_MISS)
+            if result == kCACHE_MISS:
+                logging.debug("No cache found for: |%s|" % question)
+            else:
+                self.add_result(question, result)
 
         if question in self.cache:
             return [self.cache[question]]
@@ -97,55 +145,98 @@ class GprGuesser(Guesser):
             return [{"guess": "", "confidence": 0.0}]
         
         
-    def save(self, suffix=""):
+    def batch_guess(self, questions, n_guesses=1):
         """
-        Save the API results to a file to save money and time for the future
+        Fill all of the cache misses at once (in parallel, if there is a
+        completion backend) and then answer every question from the cache.
+        """
+        completion = self.completion
+        try:
+            if completion is not None:
+                misses = []
+                for question in dict.fromkeys(normalize_question(x) for x in questions):
+                    if question in self.cache:
+                        continue
+                    if self.prefix_fallback > 0 and self.longest_cached_prefix(question) is not None:
+                        continue
+                    misses.append(question)
+
+                logging.info("Filling %i cache misses for %i questions" % (len(misses), len(questions)))
+                for question, result in completion.complete_all(misses).items():
+                    self.add_result(question, result)
+
+            # Do not ask again, one at a time, for what could not be filled
+            self.completion = None
+            return [self(x, n_guesses) for x in questions]
+        finally:
+            self.completion = completion
+
+    def add_result(self, question, result):
+        """
+        Add a new API result to the cache.  With the memory backend it is
+        also appended to the write-ahead log and its shard is marked dirty.
         """
+        self.num_queries += 1
+        self.cache[question] = result
+        if self._prefixes is not None:
+            self._prefixes.add(question)
+        if self.cache_backend == "memory":
+            self._dirty[self.shard(question)][question] = result
+            self._log.append(question, result)
+
+    def save(self):
+        """
+        Save the API results to a file to save money and time for the future
 
-        if self.num_queries > 0:
-            logging.info("Made %i new queries, saving to %s" % (self.num_queries, self.cache_filename))
-            shards = defaultdict(dict)
-            for ii in self.cache:
-                shard = self.shard(ii)
-                shards[shard][ii] = self.cache[ii]
+        With the memory backend, only the shards with new results are
+        rewritten (merging the new results into the shard file), after which
+        the write-ahead log is no longer needed.
+        """
 
-            for shard in tqdm(shards):
-                filename = "%s%05i%s" % (self.cache_filename, shard, suffix)
-                with open(filename, 'w') as outfile:
-                    json_object = json.dumps(shards[shard], indent=2)
-                    outfile.write(json_object)            
-        
+        if self.cache_backend in ["sqlite", "shards"]:
+            # New results are already in the database or their shard
+            self.cache.commit()
+        elif self._dirty:
+            logging.info("Made %i new queries, saving %i shards to %s" %
+                         (self.num_queries, len(self._dirty), self.cache_filename))
+            for shard, entries in self._dirty.items():
+                merge_shard_file("%s%05i" % (self.cache_filename, shard), entries)
+            self._dirty = defaultdict(dict)
+            self._log.clear()
 
             
+    @staticmethod
+    def artifacts(cache_filename):
+        # The sqlite database, shard directory and log are derived from these
+        return [cache_filename] + shard_files(cache_filename)
+
     def load(self):
         """
         Load the cache of search results from a file
         """
-        import tarfile
-        clean = {}
-
-        tar = tarfile.open(self.cache_filename, 'r:gz')
-        for ii in tar.getmembers():
-            if ii.name.endswith(".pkl") or "/._" in ii.name:
-                logging.debug("Skipping %s" % ii)
-                continue
+        if self.cache_backend in ["sqlite", "shards"]:
+            if self.cache_backend == "sqlite":
+                self.cache = SqliteCache(self.cache_db, self.lru_size)
             else:
-                logging.debug("Reading from %s" % ii)
-            try:
-                with tar.extractfile(ii) as infile:
-                    raw_text = infile.read().decode('utf-8', errors='ignore')
-                    json_object = json.loads(raw_text)
-                    clean = {}
-                    # Deal with non-breaking space issue
-                    for ii in json_object:
-                        clean[ii.replace("\xa0", " ")] = json_object[ii]
-            except (IOError, JSONDecodeError) as e:
-                json_object = {}
-                print("Failed to load cache")
-
-            self.cache.update(json_object)
-            self.cache.update(clean)
-            logging.debug("Reading %09i entries from %s, cache size is now %09i" % (len(json_object), ii, len(self.cache)))
+                self.cache = LazyShardCache("%s.shards" % self.cache_filename, self.shard, self.max_shards)
+            # Results saved by the memory backend (or a newer tarball) are
+            # imported, not just the tarball the first time
+            if not self.cache.imported(self.cache_filename):
+                self.cache.import_cache(self.cache_filename, self.load_workers)
+            return self.cache
+
+        for name, entries in read_tar_cache(self.cache_filename, self.load_workers):
+            self.cache.update(entries)
+            logging.debug("Reading %09i entries from %s, cache size is now %09i" % (len(entries), name, len(self.cache)))
+
+        # Shards compacted since the tarball was made, then results that
+        # were logged but not yet compacted
+        for filename in shard_files(self.cache_filename):
+            with open(filename) as infile:
+                self.cache.update(json.load(infile))
+        for question, result in self._log.replay():
+            self.cache[question] = result
+            self._dirty[self.shard(question)][question] = result
 
         logging.info("%i entries added to cache" % len(self.cache))
         return self.cache
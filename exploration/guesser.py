@@ -8,15 +8,21 @@ import re
 import json
 import logging
 
+from itertools import islice
 from typing import List, Dict, Iterable, Optional, Tuple, NamedTuple
 
 from nltk.tokenize import sent_tokenize, word_tokenize
 
+from tokenization import get_tokenizer
+
 alphanum = re.compile('[^a-zA-Z0-9]')
 
 from params import load_guesser, load_questions, setup_logging
 from params import add_general_params, add_guesser_params, add_general_params, add_question_params
 
+# How many questions split_examples tokenizes at a time
+kSPLIT_BATCH = 10000
+
 kTOY_JSON = [{"text": "capital England", "page": "London"},
              {"text": "capital Russia", "page": "Moscow"},
              {"text": "currency England", "page": "Pound"},
@@ -71,18 +77,29 @@ class Guesser:
         What qualifies as the answer is specified by the "answer_field".  
 
         If split_by_sentence is true, it creates individual questions
-        for each of the sentences in the original question.
+        for each of the sentences in the original question (using the
+        sentence spans that come with the data when they are there).
         """
         from collections import defaultdict
         from tqdm import tqdm
         
         answers_to_questions = defaultdict(set)
         if split_by_sentence:
-            for qq in tqdm(training_data):
-                for ss in sent_tokenize(qq["text"]):
-                    if (min_length < 0 or len(ss) > min_length) and \
-                        (max_length < 0 or len(ss) < max_length):
-                        answers_to_questions[qq[answer_field]].add(ss)
+            # Questions can be an iterator (see load_questions), so tokenize
+            # them a batch at a time
+            progress = tqdm()
+            questions = iter(training_data)
+            batch = list(islice(questions, kSPLIT_BATCH))
+            while batch:
+                sentences = get_tokenizer().sentences(batch)
+                for qq, question_sentences in zip(batch, sentences):
+                    for ss in question_sentences:
+                        if (min_length < 0 or len(ss) > min_length) and \
+                            (max_length < 0 or len(ss) < max_length):
+                            answers_to_questions[qq[answer_field]].add(ss)
+                progress.update(len(batch))
+                batch = list(islice(questions, kSPLIT_BATCH))
+            progress.close()
         else:
             for qq in tqdm(training_data):
                 text = qq["text"]
@@ -146,9 +163,8 @@ class Guesser:
 
         # TODO: it might be good to exclude punctuation here
         sentences = []
-        for qq in self.questions:
-            for ss in sent_tokenize(qq):
-                sentences.append(word_tokenize(ss))
+        for qq in get_tokenizer().words(self.questions):
+            sentences += qq
 
         self.phrase_model = Phrases(sentences, connector_words=ENGLISH_CONNECTOR_WORDS, min_count=30)
 
@@ -175,6 +191,18 @@ class Guesser:
             guesses.append(new_guesses)
         return guesses
 
+    def batch_prefix_guess(self, questions, n_guesses=1):
+        """
+        Given a list of questions, each a list of runs (where every run is a
+        prefix of the next), generate guesses for every run.  Returns one
+        entry per run, in order.
+
+        Guessers that can reuse work between the prefixes of a question
+        should override this; by default it is just batch_guess.
+        """
+        runs = [run for question in questions for run in question]
+        return self.batch_guess(runs, n_guesses)
+
     def save(self):
         """
         Save the Guesser's information to a file.  
@@ -199,6 +227,16 @@ class Guesser:
             self.phrase_model = Phrases.load(filename)
         except FileNotFoundError:
             self.phrase_model = None
+
+    @staticmethod
+    def artifacts(filename):
+        """
+        The files that load() reads a model saved to filename from.  Files
+        that load() creates or updates itself (caches, logs) should not be
+        listed: these decide whether an already loaded guesser is still
+        current.
+        """
+        return []
                 
     def __call__(self, question, n_guesses=1):
         """
@@ -219,7 +257,9 @@ if __name__ == "__main__":
 
     setup_logging(flags)    
     guesser = load_guesser(flags)
-    questions = load_questions(flags)
+    # Guessers that only go through split_examples can read the questions
+    # as they are parsed
+    questions = load_questions(flags, lazy=flags.guesser_type not in ["WikiGuesser", "DanGuesser"])
     # TODO(jbg): Change to use huggingface data, as declared in flags
 
     if flags.guesser_type == 'WikiGuesser':
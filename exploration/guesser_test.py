@@ -0,0 +1,291 @@
+
+import unittest
+import numpy as np
+from tfidf_guesser import TfidfGuesser
+
+class GuesserTest(unittest.TestCase):
+    def setUp(self):
+        self.guesser = TfidfGuesser("data/test_guesser", min_df=0.0, max_df=1.0)
+        self.toy_data = [{'page': 'Maine', 'text': 'For 10 points, name this New England state with capital at Augusta.'},
+                         {'page': 'Massachusetts', 'text': 'For ten points, identify this New England state with capital at Boston.'},
+                         {'page': 'Boston', 'text': 'For 10 points, name this city in New England, the capital of Massachusetts.'},
+                         {'page': 'Jane_Austen', 'text': 'For 10 points, name this author of Pride and Prejudice.'},
+                         {'page': 'Jane_Austen', 'text': 'For 10 points, name this author of Emma and Pride and Prejudice.'},
+                         {'page': 'Wolfgang_Amadeus_Mozart', 'text': 'For 10 points, name this composer of Magic Flute and Don Giovanni.'},
+                         {'page': 'Wolfgang_Amadeus_Mozart', 'text': 'Name this composer who wrote a famous requiem and The Magic Flute.'},
+                         {'page': "Gresham's_law", 'text': 'For 10 points, name this economic principle which states that bad money drives good money out of circulation.'},
+                         {'page': "Gresham's_law", 'text': "This is an example -- for 10 points \\-- of what Scotsman's economic law, which states that bad money drives out good?"},
+                         {'page': "Gresham's_law", 'text': 'FTP name this economic law which, in simplest terms, states that bad money drives out the good.'},
+                         {'page': 'Rhode_Island', 'text': "This colony's Touro Synagogue is the oldest in the United States."},
+                         {'page': 'Lima', 'text': 'It is the site of the National University of San Marcos, the oldest university in South America.'},
+                         {'page': 'College_of_William_&_Mary', 'text': 'For 10 points, identify this oldest public university in the United States, a college in Virginia named for two monarchs.'}]
+
+        self.queries = {"This capital of England": ['Maine', 'Boston'],
+                        "The author of Pride and Prejudice": ['Jane_Austen', 'Jane_Austen'],
+                        "The composer of the Magic Flute": ['Wolfgang_Amadeus_Mozart', 'Wolfgang_Amadeus_Mozart'],
+                        "The economic law that says 'good money drives out bad'": ["Gresham's_law", "Gresham's_law"],
+                        "located outside Boston, the oldest University in the United States": ['College_of_William_&_Mary', 'Rhode_Island']}
+        
+        self.guesser.train(self.toy_data, 'page', False, 0, -1)
+
+    def test_stopwords(self):
+        self.assertTrue("the" not in self.guesser.tfidf_vectorizer.vocabulary_)
+
+    def test_length(self):
+        self.assertEqual(len(self.guesser.answers), 13)
+        
+        new_guesser = TfidfGuesser("data/test_guesser", min_df=0.0, max_df=1.0)
+        new_guesser.train(self.toy_data, min_length=60, max_length=90)
+
+        self.assertEqual(len(new_guesser.answers), 7)
+        
+
+    def test_top_single(self):
+        for query in self.queries:
+            top, second = self.queries[query]
+            guesses = self.guesser(query)
+            self.assertEqual(guesses[0]['guess'], top)
+            self.assertEqual(guesses[1]['guess'], second)
+
+    def test_top_batch(self):
+        questions = list(self.queries.keys())
+        guesses = self.guesser.batch_guess(questions, 2, block_size=3)
+        for query, guesses in zip(questions, guesses):
+            top, second = self.queries[query]
+            self.assertEqual(guesses[0]['guess'], top)
+            self.assertEqual(guesses[1]['guess'], second)
+
+    def test_batch_matches_single(self):
+        questions = list(self.queries.keys())
+        batch = self.guesser.batch_guess(questions, 4, block_size=2)
+        for query, guesses in zip(questions, batch):
+            single = self.guesser(query, 4)
+            self.assertEqual([x['guess'] for x in guesses], [x['guess'] for x in single])
+            for gg, ss in zip(guesses, single):
+                self.assertAlmostEqual(gg['confidence'], ss['confidence'])
+
+    def test_more_guesses_than_sentences(self):
+        guesses = self.guesser("The composer of the Magic Flute", 100)
+        self.assertEqual(len(guesses), len(self.guesser.answers))
+        confidences = [x['confidence'] for x in guesses]
+        self.assertEqual(confidences, sorted(confidences, reverse=True))
+
+    def test_maxscore_matches_matrix(self):
+        self.guesser.backend = "maxscore"
+        for query in self.queries:
+            top, second = self.queries[query]
+            guesses = self.guesser(query, 3)
+            self.assertEqual(guesses[0]['guess'], top)
+            self.assertEqual(guesses[1]['guess'], second)
+
+        self.guesser.backend = "matrix"
+        expected = self.guesser.batch_guess(list(self.queries), 3)
+        self.guesser.backend = "maxscore"
+        for query, reference in zip(self.queries, expected):
+            for gg, rr in zip(self.guesser(query, 3), reference):
+                self.assertAlmostEqual(gg['confidence'], rr['confidence'])
+
+    def test_maxscore_random(self):
+        from scipy.sparse import random as sparse_random
+        from inverted_index import MaxScoreIndex
+
+        docs = sparse_random(500, 50, density=0.05, format='csr', random_state=3)
+        index = MaxScoreIndex(docs)
+        rng = np.random.default_rng(3)
+        for trial in range(20):
+            terms = rng.choice(50, size=4, replace=False)
+            weights = rng.random(4)
+            hits, scores = index.search(terms, weights, 10)
+
+            dense = docs[:, terms].toarray() @ weights
+            self.assertEqual(len(hits), 10)
+            np.testing.assert_allclose(scores, np.sort(dense)[::-1][:10])
+            np.testing.assert_allclose(dense[hits], scores)
+
+    def test_save_load(self):
+        import os
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as directory:
+            self.guesser.filename = os.path.join(directory, "TfidfGuesser")
+            # (Only some versions of sklearn keep the pruned vocabulary)
+            self.guesser.tfidf_vectorizer.stop_words_ = {"pruned"}
+            self.guesser.save()
+            # Saving does not change the model in memory
+            self.assertEqual(self.guesser.tfidf_vectorizer.stop_words_, {"pruned"})
+
+            loaded = TfidfGuesser(self.guesser.filename)
+            loaded.load()
+            self.assertIsNone(loaded.tfidf_vectorizer.stop_words_)
+            # The posting lists are mapped too, not rebuilt from the matrix
+            self.assertIsInstance(loaded.inverted_index().docs, np.memmap)
+            runs = [["The author", "The author of Pride and Prejudice"]]
+            self.assertEqual(loaded.batch_prefix_guess(runs, 2), self.guesser.batch_prefix_guess(runs, 2))
+            self.assertFalse(loaded.tfidf.data.flags.owndata)
+            self.assertEqual(list(loaded.questions), list(self.guesser.questions))
+            self.assertEqual(list(loaded.answers), list(self.guesser.answers))
+
+            questions = list(self.queries.keys())
+            for gg, ll in zip(self.guesser.batch_guess(questions, 3), loaded.batch_guess(questions, 3)):
+                self.assertEqual([x['guess'] for x in gg], [x['guess'] for x in ll])
+                self.assertEqual([x['question'] for x in gg], [x['question'] for x in ll])
+
+    def test_prefix_scorer(self):
+        scorer = self.guesser.prefix_scorer(3)
+        query = "The composer of the Magic Flute and Don Giovanni"
+        # Include a prefix that ends in the middle of a word
+        prefixes = [query[:length] for length in [12, 26, 29, 31, len(query)]]
+        prefixes.append("The economic law that says 'good money drives out bad'")
+        for prefix in prefixes:
+            incremental = scorer.extend(prefix)
+            expected = self.guesser(prefix, 3)
+            self.assertEqual([x['guess'] for x in incremental][:1], [x['guess'] for x in expected][:1])
+            for ii, ee in zip(incremental, expected):
+                self.assertAlmostEqual(ii['confidence'], ee['confidence'])
+
+        # Only the sentences that share a term are candidates, and reset
+        # clears just those
+        self.assertLess(len(scorer.candidates()), len(self.guesser.questions))
+        scorer.reset()
+        self.assertEqual(len(scorer.candidates()), 0)
+        self.assertFalse(scorer.dot.any() or scorer.seen.any())
+        self.assertEqual(scorer.extend(query)[0]['guess'], self.guesser(query, 3)[0]['guess'])
+
+    def test_batch_prefix_guess(self):
+        runs = [["The author", "The author of Pride", "The author of Pride and Prejudice"],
+                ["This capital", "This capital of England"]]
+        flat = [run for question in runs for run in question]
+        expected = self.guesser.batch_guess(flat, 2)
+        guesses = self.guesser.batch_prefix_guess(runs, 2)
+        self.assertEqual(len(guesses), len(flat))
+        for gg, ee in zip(guesses, expected):
+            for ii, jj in zip(gg, ee):
+                self.assertAlmostEqual(ii['confidence'], jj['confidence'])
+
+    def test_page_scoring(self):
+        questions = list(self.queries.keys())
+        for page_scoring in ["max", "sum"]:
+            self.guesser.page_scoring = page_scoring
+            self.guesser.backend = "matrix"
+            expected = self.guesser.batch_guess(questions, 4)
+
+            self.guesser.backend = "maxscore"
+            searched = self.guesser.batch_guess(questions, 4)
+            incremental = [self.guesser.prefix_scorer(4).extend(x) for x in questions]
+
+            for query, ee, ss, ii in zip(questions, expected, searched, incremental):
+                pages = [x['guess'] for x in ee]
+                self.assertEqual(len(set(pages)), 4)
+                self.assertEqual(pages[0], self.queries[query][0])
+                for guesses in [ss, ii]:
+                    self.assertEqual([x['guess'] for x in guesses][:2], pages[:2])
+                    for gg, rr in zip(guesses, ee):
+                        self.assertAlmostEqual(gg['confidence'], rr['confidence'])
+                        self.assertEqual(self.guesser.answers[self.guesser.questions.index(gg['question'])],
+                                         gg['guess'])
+
+        jane = self.guesser("The author of Pride and Prejudice", 2)
+        self.guesser.page_scoring = "max"
+        self.assertGreater(jane[0]['confidence'], self.guesser("The author of Pride and Prejudice", 2)[0]['confidence'])
+
+    def test_sharded(self):
+        import os
+        import tempfile
+
+        questions = list(self.queries.keys())
+        with tempfile.TemporaryDirectory() as directory:
+            for page_scoring in ["sentence", "max"]:
+                self.guesser.page_scoring = page_scoring
+                self.guesser.workers = 1
+                expected = self.guesser.batch_guess(questions, 3)
+
+                # First from shared memory, then mapped from a saved index
+                self.guesser.workers = 3
+                for saved in [False, True]:
+                    if saved:
+                        self.guesser.filename = os.path.join(directory, "TfidfGuesser")
+                        self.guesser.save()
+                    sharded = self.guesser.batch_guess(questions, 3, block_size=2)
+                    for ss, ee in zip(sharded, expected):
+                        self.assertEqual([x['guess'] for x in ss][:2], [x['guess'] for x in ee][:2])
+                        self.assertEqual(ss[0]['question'], ee[0]['question'])
+                        for gg, rr in zip(ss, ee):
+                            self.assertAlmostEqual(gg['confidence'], rr['confidence'])
+
+    def test_sharded_buzzer(self):
+        import tfidf_guesser
+        from buzzer import Buzzer
+
+        blocks = []
+
+        class CountingPool(tfidf_guesser.ShardPool):
+            def top_k(self, queries, k):
+                blocks.append(queries.shape[0])
+                return super().top_k(queries, k)
+
+        questions = [{"qanta_id": ii, "page": page, "first_sentence": "", "text": text}
+                     for ii, (text, page) in enumerate(zip(self.queries, ["England", "Jane_Austen"]))]
+        features = {}
+        original = tfidf_guesser.ShardPool
+        tfidf_guesser.ShardPool = CountingPool
+        try:
+            for workers in [1, 2]:
+                self.guesser.workers = workers
+                buzzer = Buzzer("data/test_buzzer", 10)
+                buzzer.add_guesser("Tfidf", self.guesser, primary_guesser=True)
+                buzzer.add_data([dict(x) for x in questions])
+                features[workers] = buzzer.build_features()
+        finally:
+            tfidf_guesser.ShardPool = original
+
+        # The buzzer's runs were scored by the shards, with the same results
+        self.assertEqual(sum(blocks), len(features[2]))
+        for single, sharded in zip(features[1], features[2]):
+            self.assertEqual(single.keys(), sharded.keys())
+            for key in single:
+                self.assertAlmostEqual(single[key], sharded[key])
+
+    def test_provided_sentences(self):
+        from guesser import Guesser
+        text = "This man wrote Emma. For 10 points, name this author of Pride and Prejudice."
+        question = {"page": "Jane_Austen", "text": text, "qanta_id": 1,
+                    "tokenizations": [[0, 20], [21, len(text)]]}
+        answers_to_questions = Guesser.split_examples([question], "page", True, -1, -1)
+        self.assertEqual(answers_to_questions["Jane_Austen"],
+                         {"This man wrote Emma.", "For 10 points, name this author of Pride and Prejudice."})
+
+
+    def test_tokenization_log(self):
+        import os
+        import tempfile
+        from tokenization import TokenizationCache
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "tokenizations.pkl")
+            cache = TokenizationCache(filename)
+            cache._lookup(["a", "b"], ["one two", "three"], str.split)
+            size = os.path.getsize(filename)
+            # Only the new text is appended, not the whole cache again
+            cache._lookup(["a", "c"], ["one two", "four five"], str.split)
+            self.assertLess(os.path.getsize(filename), 2 * size + 8)
+
+            with open(filename, 'ab') as outfile:
+                outfile.write(b"\x80\x04\x95")
+            reopened = TokenizationCache(filename)
+            self.assertEqual(reopened.cache, {"a": ["one", "two"], "b": ["three"], "c": ["four", "five"]})
+            # The partial batch is compacted away, so what's appended next
+            # can be read back
+            self.assertEqual(TokenizationCache.read(filename), (reopened.cache, 1, False))
+            reopened._lookup(["d"], ["six"], str.split)
+            self.assertEqual(TokenizationCache(filename).cache, reopened.cache)
+
+            # So is a log with too many batches
+            for ii in range(3):
+                reopened._lookup([str(ii)], ["seven"], str.split)
+            self.assertEqual(TokenizationCache.read(filename)[1], 5)
+            compacted = TokenizationCache(filename, max_batches=4)
+            self.assertEqual(TokenizationCache.read(filename), (compacted.cache, 1, False))
+
+            
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+# Jordan Boyd-Graber
+# 2023
+#
+# Term-at-a-time retrieval over posting lists with MaxScore early termination.
+
+import numpy as np
+
+from topk import pad_top_k
+
+
+class MaxScoreIndex:
+    """
+    Inverted index over a (documents x terms) tf-idf matrix.
+
+    Each term keeps a posting list (the documents it appears in, sorted, and
+    their weights) and the largest weight in that list.  A query only touches
+    the posting lists of its own terms, and once the remaining terms cannot
+    lift a new document into the top k, the rest of the lists are only probed
+    for documents that are already candidates.
+    """
+
+    # The arrays that make up an index (see save and load)
+    kARRAYS = ["starts", "docs", "weights", "max_weight"]
+
+    def __init__(self, tfidf=None):
+        """
+        Build the index from a tf-idf matrix (or leave it empty for load).
+        """
+        if tfidf is None:
+            return
+        postings = tfidf.tocsc()
+        postings.sort_indices()
+
+        self.num_docs = postings.shape[0]
+        self.starts = np.asarray(postings.indptr)
+        self.docs = np.asarray(postings.indices)
+        self.weights = np.asarray(postings.data)
+
+        # Upper bound of what each term can add to a document's score
+        self.max_weight = np.zeros(postings.shape[1])
+        nonempty = np.flatnonzero(np.diff(self.starts))
+        if len(nonempty) > 0:
+            self.max_weight[nonempty] = np.maximum.reduceat(self.weights, self.starts[nonempty])
+
+    def save(self, directory, name="postings"):
+        """
+        Write the posting lists to an ArrayDirectory that is being created.
+        """
+        for part in self.kARRAYS:
+            directory.save_array("%s.%s" % (name, part), getattr(self, part))
+        directory.meta["%s.num_docs" % name] = int(self.num_docs)
+
+    @classmethod
+    def load(cls, directory, name="postings", mmap=True):
+        """
+        Read (memory map) the posting lists from an ArrayDirectory, or return
+        None if it does not have them.
+        """
+        if "%s.num_docs" % name not in directory.meta:
+            return None
+        index = cls()
+        index.num_docs = directory.meta["%s.num_docs" % name]
+        for part in cls.kARRAYS:
+            setattr(index, part, directory.load_array("%s.%s" % (name, part), mmap))
+        return index
+
+    def postings(self, term):
+        """
+        Return the documents containing a term and the term's weight in each.
+        """
+        start, stop = self.starts[term], self.starts[term + 1]
+        return self.docs[start:stop], self.weights[start:stop]
+
+    def search(self, terms, query_weights, k):
+        """
+        Find the k documents with the highest dot product with the query.
+
+        Keyword arguments:
+        terms -- Column ids of the terms in the query
+        query_weights -- Weight of each of those terms in the query
+        k -- How many documents to return
+
+        Returns the document ids and scores, best first.
+        """
+        k = min(k, self.num_docs)
+        terms = np.asarray(terms)
+        query_weights = np.asarray(query_weights, dtype=float)
+
+        bounds = query_weights * self.max_weight[terms]
+        order = np.argsort(-bounds, kind="stable")
+        terms, query_weights, bounds = terms[order], query_weights[order], bounds[order]
+        # remaining[i] is the most terms i onward can add to any document
+        remaining = np.append(np.cumsum(bounds[::-1])[::-1], 0.0)
+
+        candidates = np.zeros(0, dtype=self.docs.dtype)
+        scores = np.zeros(0)
+        for ii, (term, weight) in enumerate(zip(terms, query_weights)):
+            docs, doc_weights = self.postings(term)
+            threshold = self._threshold(scores, k)
+
+            if remaining[ii] > threshold:
+                # A document we have not seen yet could still make the top k
+                merged, inverse = np.unique(np.concatenate([candidates, docs]),
+                                            return_inverse=True)
+                scores = np.bincount(inverse, minlength=len(merged),
+                                     weights=np.concatenate([scores, weight * doc_weights]))
+                candidates = merged
+            else:
+                # Only update existing candidates; binary search the posting
+                # list instead of reading all of it
+                position = np.searchsorted(docs, candidates)
+                found = position < len(docs)
+                found[found] = docs[position[found]] == candidates[found]
+                scores[found] += weight * doc_weights[position[found]]
+
+                keep = scores + remaining[ii + 1] >= self._threshold(scores, k)
+                candidates, scores = candidates[keep], scores[keep]
+
+        return self.pad(*self._top(candidates, scores, k), k)
+
+    def score_all(self, terms, query_weights):
+        """
+        Score every document that shares a term with the query, without any
+        pruning.  Returns the document ids (sorted) and their scores.
+        """
+        terms = np.asarray(terms)
+        if len(terms) == 0:
+            return np.zeros(0, dtype=self.docs.dtype), np.zeros(0)
+
+        postings = [self.postings(term) for term in terms]
+        docs = np.concatenate([x[0] for x in postings])
+        weights = np.concatenate([weight * x[1] for weight, x in zip(query_weights, postings)])
+        candidates, inverse = np.unique(docs, return_inverse=True)
+        return candidates, np.bincount(inverse, weights=weights, minlength=len(candidates))
+
+    @staticmethod
+    def _threshold(scores, k):
+        """
+        The k-th best score so far (a lower bound on the final k-th best).
+        """
+        if k <= 0 or len(scores) < k:
+            return 0.0
+        return np.partition(scores, len(scores) - k)[len(scores) - k]
+
+    @staticmethod
+    def _top(candidates, scores, k):
+        if len(scores) > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+            candidates, scores = candidates[best], scores[best]
+        order = np.argsort(-scores, kind="stable")
+        return candidates[order], scores[order]
+
+    def pad(self, candidates, scores, k):
+        """
+        Like the dense scorer, always return k documents: fill with
+        documents that share no terms with the query (score zero).
+        """
+        return pad_top_k(candidates, scores, k, self.num_docs)
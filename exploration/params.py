@@ -8,8 +8,14 @@ import logging
 import argparse
 import json
 import gzip
+import os
+import sys
 
-from pandas import read_csv
+from startup import profile_imports
+
+# Start timing as early as possible (imports before this are not counted)
+if "--profile_startup" in sys.argv:
+    profile_imports()
 
 
 def add_general_params(parser):
@@ -17,24 +23,39 @@ def add_general_params(parser):
     parser.set_defaults(feature=True)
     parser.add_argument('--logging_level', type=int, default=logging.INFO)
     parser.add_argument('--logging_file', type=str, default='qanta.log')
+    parser.add_argument('--profile_startup', action='store_true',
+                        help="Report how long imports took when the program exits (use python -X importtime for imports before params)")
     print("Setting up logging")
 
 def add_question_params(parser):
     parser.add_argument('--limit', type=int, default=-1)
-    parser.add_argument('--question_source', type=str, default='json')
+    parser.add_argument('--question_source', type=str, default='json',
+                        help="json, gzjson, csv, expo, or columnar (a store written by question_store.py)")
     parser.add_argument('--questions', default = "../data/qanta.guesstrain.json",type=str)
     parser.add_argument('--secondary_questions', default = "../data/qanta.guessdev.json",type=str)
     parser.add_argument('--expo_output_root', default="expo/expo", type=str)
+    parser.add_argument('--tokenization_cache', default="models/tokenizations.pkl", type=str,
+                        help="Where to cache sentence and word tokenizations (empty to not persist them)")
+    parser.add_argument('--tokenization_workers', default=1, type=int,
+                        help="How many processes to tokenize questions with")
 
 def add_buzzer_params(parser):
     parser.add_argument('--buzzer_guessers', nargs='+', default = ['TfidfGuesser'], help='Guessers to feed into Buzzer', type=str)
     parser.add_argument('--features', nargs='+', help='Features to feed into Buzzer', type=str,  default=['Length'])    
     parser.add_argument('--buzzer_type', type=str, default="LogisticBuzzer")
     parser.add_argument('--run_length', type=int, default=100)
+    parser.add_argument('--buzzer_history_length', type=int, default=0, help="How many previous runs of a question features can see")
+    parser.add_argument('--buzzer_history_depth', type=int, default=0, help="How many guesses of each previous run features can see")
     parser.add_argument('--LogisticBuzzer_filename', type=str, default="models/LogisticBuzzer")    
     
 def add_guesser_params(parser):
     parser.add_argument('--guesser_type', type=str, default="TfidfGuesser")
+    parser.add_argument('--tfidf_backend', type=str, default="matrix", choices=["matrix", "maxscore"],
+                            help="Score every indexed sentence (matrix) or walk posting lists with early termination (maxscore)")
+    parser.add_argument('--tfidf_page_scoring', type=str, default="sentence", choices=["sentence", "max", "sum"],
+                            help="Return the best sentences, or the best distinct pages by the max or sum of their sentence scores")
+    parser.add_argument('--tfidf_workers', type=int, default=1,
+                            help="How many processes to split the tf-idf matrix across when guessing in batch")
     # TODO (jbg): This is more general than tfidf, make more general (currently being used by DAN guesser as well)
     parser.add_argument('--tfidf_min_length', type=int, help="How long (in characters) must text be before it is indexed?", default=50)
     parser.add_argument('--tfidf_max_length', type=int, help="How long (in characters) must text be to be removed?", default=500)    
@@ -44,6 +65,24 @@ def add_guesser_params(parser):
     parser.add_argument('--TfidfGuesser_filename', type=str, default="models/TfidfGuesser")
     parser.add_argument('--WikiGuesser_filename', type=str, default="models/WikiGuesser")    
     parser.add_argument('--GprGuesser_filename', type=str, default="models/GprGuesser")
+    parser.add_argument('--GprGuesser_cache_backend', type=str, default="memory", choices=["memory", "sqlite", "shards"],
+                        help="Read the whole cache into memory, look results up in a sqlite database, or load cache shards as they are needed")
+    parser.add_argument('--GprGuesser_cache_db', type=str, default="",
+                        help="sqlite database for the cache (defaults to the cache filename + .sqlite)")
+    parser.add_argument('--GprGuesser_lru_size', type=int, default=10000,
+                        help="How many sqlite cache lookups to keep in memory")
+    parser.add_argument('--GprGuesser_max_shards', type=int, default=64,
+                        help="How many cache shards to keep in memory with the shards backend")
+    parser.add_argument('--GprGuesser_prefix_fallback', type=int, default=0,
+                        help="On a cache miss, use the longest cached prefix that drops at most this many trailing words")
+    parser.add_argument('--GprGuesser_completion_url', type=str, default="",
+                        help="Completion service that fills cache misses (e.g., a server started with completion.py)")
+    parser.add_argument('--GprGuesser_concurrency', type=int, default=8,
+                        help="How many completion requests can be in flight at once")
+    parser.add_argument('--GprGuesser_rate', type=float, default=0.0,
+                        help="How many completion requests to start per second (0 for no limit)")
+    parser.add_argument('--GprGuesser_load_workers', type=int, default=1,
+                        help="More than one decompresses the GprGuesser cache tarball in a background thread while it is decoded")
     parser.add_argument('--wiki_zim_filename', type=str, default="data/wikipedia.zim")
     parser.add_argument('--num_guesses', type=int, default=25)
 
@@ -67,22 +106,108 @@ def add_guesser_params(parser):
 def setup_logging(flags):
     logging.basicConfig(level=flags.logging_level, force=True)
     
-def load_questions(flags, secondary=False):
+def stream_json_records(infile, limit=-1, chunk_size=1 << 20):
+    """
+    Generate the records of a text file that is either a top-level json
+    array or json lines (one record per line), parsing as it reads and
+    stopping after limit records (-1 for all of them).  A file that is a
+    single json object is yielded whole.
+
+    When a record does not fit in what has been read, twice as much is read
+    before trying again, so a large record (e.g., an object that wraps all
+    of the questions) is decoded a logarithmic number of times rather than
+    once per chunk.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    in_array = None
+    finished = False
+    count = 0
+    read_size = chunk_size
+    while limit < 0 or count < limit:
+        # Skip whitespace and the separators between records
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if in_array is None and position < len(buffer):
+            in_array = buffer[position] == "["
+            if in_array:
+                position += 1
+                continue
+        if in_array and position < len(buffer) and buffer[position] == "]":
+            return
+
+        try:
+            if position >= len(buffer):
+                raise json.JSONDecodeError("Need more data", buffer, position)
+            record, end = decoder.raw_decode(buffer, position)
+            if end == len(buffer) and not finished:
+                # A number or a record may continue in the next chunk
+                raise json.JSONDecodeError("Need more data", buffer, position)
+        except json.JSONDecodeError:
+            if finished:
+                if buffer[position:].strip():
+                    raise
+                return
+            buffer = buffer[position:]
+            position = 0
+            # A record that started before this read is still incomplete
+            read_size = max(chunk_size, len(buffer))
+            chunk = infile.read(read_size)
+            finished = len(chunk) < read_size
+            buffer += chunk
+            continue
+
+        position = end
+        count += 1
+        yield record
+
+
+def load_questions(flags, secondary=False, lazy=False):
+    """
+    Read the questions (stopping after flags.limit of them).
+
+    lazy -- Return an iterator over json questions rather than a list, so
+      that they do not all have to be in memory at once
+    """
+    # The guessers tokenize the questions with the cache named by the flags
+    if getattr(flags, "tokenization_cache", None) is not None:
+        from tokenization import configure
+        configure(flags.tokenization_cache, flags.tokenization_workers)
+
     question_filename = flags.questions
     if secondary:
         question_filename = flags.secondary_questions
     
     questions = None
-    if flags.question_source == 'gzjson':
+    if flags.question_source in ['gzjson', 'json']:
         logging.info("Loading questions from %s" % question_filename)
-        with gzip.open(question_filename) as infile:
-            questions = json.load(infile)
-    
-    if flags.question_source == 'json':
-        with open(question_filename) as infile:
-            questions = json.load(infile)
+        if flags.question_source == 'gzjson':
+            infile = gzip.open(question_filename, 'rt', encoding='utf-8')
+        else:
+            infile = open(question_filename, encoding='utf-8')
+
+        def records():
+            with infile:
+                yield from stream_json_records(infile, flags.limit)
+
+        if lazy:
+            return records()
+        questions = list(records())
+        if len(questions) == 1 and isinstance(questions[0], dict) and "questions" in questions[0]:
+            # A file that wraps the questions in an object
+            questions = questions[0]
+            if flags.limit > 0:
+                questions["questions"] = questions["questions"][:flags.limit]
+            return questions
             
+    if flags.question_source == 'columnar':
+        from question_store import QuestionStore
+        logging.info("Opening question store %s" % question_filename)
+        questions = QuestionStore(question_filename)
+
     if flags.question_source == 'csv':
+        from pandas import read_csv
         questions = read_csv(question_filename)
 
     if flags.question_source == 'expo':
@@ -101,47 +226,191 @@ def load_questions(flags, secondary=False):
         
     return questions
 
-def instantiate_guesser(guesser_type, flags, load):
+# Factories for each type of guesser, buzzer and feature.  Each imports what
+# it needs when it is called, so a command only pays for the types it uses
+# (e.g., only the DanGuesser needs torch).
+kGUESSERS = {}
+kBUZZERS = {}
+kFEATURES = {}
+
+# Guessers that are trained when they're created, so there is nothing to load
+kTRAINED_ON_CREATION = ["PresidentGuesser"]
+
+
+def register(registry, name, settings=(), artifacts=None):
+    """
+    Add a factory to a registry.  For guessers, settings are the flags
+    (besides the ones named after the type, e.g. TfidfGuesser_filename)
+    that change what the factory builds, and artifacts gives the files a
+    model is loaded from (see instantiate_guesser).
+    """
+    def decorator(factory):
+        factory.settings = settings
+        factory.artifacts = artifacts
+        registry[name] = factory
+        return factory
+    return decorator
+
+
+def _gpr_artifacts(flags):
+    from gpr_guesser import GprGuesser
+    return GprGuesser.artifacts(flags.GprGuesser_filename)
+
+
+def _tfidf_artifacts(flags):
+    from tfidf_guesser import TfidfGuesser
+    return TfidfGuesser.artifacts(flags.TfidfGuesser_filename)
+
+
+@register(kGUESSERS, "GprGuesser", artifacts=_gpr_artifacts)
+def _gpr_guesser(flags):
+    from gpr_guesser import GprGuesser
+    completion = None
+    if flags.GprGuesser_completion_url:
+        from completion import CompletionClient
+        completion = CompletionClient(flags.GprGuesser_completion_url, flags.GprGuesser_concurrency,
+                                      flags.GprGuesser_rate)
+    return GprGuesser(flags.GprGuesser_filename, cache_backend=flags.GprGuesser_cache_backend,
+                      cache_db=flags.GprGuesser_cache_db, lru_size=flags.GprGuesser_lru_size,
+                      max_shards=flags.GprGuesser_max_shards,
+                      prefix_fallback=flags.GprGuesser_prefix_fallback,
+                      completion=completion, load_workers=flags.GprGuesser_load_workers)
+
+
+@register(kGUESSERS, "TfidfGuesser", settings=("tfidf_backend", "tfidf_page_scoring", "tfidf_workers"),
+          artifacts=_tfidf_artifacts)
+def _tfidf_guesser(flags):
+    from tfidf_guesser import TfidfGuesser
+    return TfidfGuesser(flags.TfidfGuesser_filename, backend=flags.tfidf_backend,
+                        page_scoring=flags.tfidf_page_scoring, workers=flags.tfidf_workers)
+
+
+@register(kGUESSERS, "DanGuesser", settings=("guesser_answer_field", "no_cuda"),
+          artifacts=lambda flags: [flags.DanGuesser_filename])
+def _dan_guesser(flags):
     import torch
-    
+    from dan_guesser import DanGuesser
+
     # TODO: Move this to params so that it would apply 
     cuda = not flags.no_cuda and torch.cuda.is_available()
     device = torch.device("cuda" if cuda else "cpu")
     logging.info("Using device '%s' (cuda flag=%s)" % (device, str(flags.no_cuda)))
-    
-    guesser = None
-    logging.info("Initializing guesser of type %s" % guesser_type)
-    if guesser_type == "GprGuesser":
-        from gpr_guesser import GprGuesser
-        logging.info("Loading %s guesser" % guesser_type)
-        guesser = GprGuesser(flags.GprGuesser_filename)
-        if load:
-            guesser.load()
-    if guesser_type == "TfidfGuesser":
-        from tfidf_guesser import TfidfGuesser        
-        guesser = TfidfGuesser(flags.TfidfGuesser_filename)  
-        if load:                                             
-            guesser.load()
-    if guesser_type == "DanGuesser":                                
-        from dan_guesser import DanGuesser                          
-        guesser = DanGuesser(filename=flags.DanGuesser_filename, answer_field=flags.guesser_answer_field, min_token_df=flags.DanGuesser_min_df, max_token_df=flags.DanGuesser_max_df,
-                    min_answer_freq=flags.DanGuesser_min_answer_freq, embedding_dimension=flags.DanGuesser_embedding_dim,
-                    hidden_units=flags.DanGuesser_hidden_units, nn_dropout=flags.DanGuesser_dropout,
-                    grad_clipping=flags.DanGuesser_grad_clipping, unk_drop=flags.DanGuesser_unk_drop,
-                    batch_size=flags.DanGuesser_batch_size,
-                    num_epochs=flags.DanGuesser_num_epochs, num_workers=flags.DanGuesser_num_workers,
-                    device=device)
-        if load:                                                    
-            guesser.load()                                          
-    if guesser_type == "PresidentGuesser":
-        from president_guesser import PresidentGuesser        
-        from president_guesser import training_data
-        guesser = PresidentGuesser()
-        guesser.train(training_data)
 
-            
-    assert guesser is not None, "Guesser (type=%s) not initialized" % guesser_type
+    return DanGuesser(filename=flags.DanGuesser_filename, answer_field=flags.guesser_answer_field, min_token_df=flags.DanGuesser_min_df, max_token_df=flags.DanGuesser_max_df,
+                      min_answer_freq=flags.DanGuesser_min_answer_freq, embedding_dimension=flags.DanGuesser_embedding_dim,
+                      hidden_units=flags.DanGuesser_hidden_units, nn_dropout=flags.DanGuesser_dropout,
+                      grad_clipping=flags.DanGuesser_grad_clipping, unk_drop=flags.DanGuesser_unk_drop,
+                      batch_size=flags.DanGuesser_batch_size,
+                      num_epochs=flags.DanGuesser_num_epochs, num_workers=flags.DanGuesser_num_workers,
+                      device=device)
 
+
+@register(kGUESSERS, "PresidentGuesser")
+def _president_guesser(flags):
+    from president_guesser import PresidentGuesser
+    from president_guesser import training_data
+    guesser = PresidentGuesser()
+    guesser.train(training_data)
+    return guesser
+
+
+@register(kBUZZERS, "LogisticBuzzer")
+def _logistic_buzzer(flags):
+    from logistic_buzzer import LogisticBuzzer
+    return LogisticBuzzer(flags.LogisticBuzzer_filename, flags.run_length, flags.num_guesses,
+                          flags.buzzer_history_length, flags.buzzer_history_depth)
+
+
+######################################################################
+######################################################################
+######################################################################
+######
+######
+######  For the feature engineering homework, here's where you need
+######  to add your features to the buzzer.
+######
+######
+######################################################################
+######################################################################
+######################################################################
+
+@register(kFEATURES, "Length")
+def _length_feature(name, flags):
+    from features import LengthFeature
+    return LengthFeature(name)
+
+
+@register(kFEATURES, "History")
+def _history_feature(name, flags):
+    from features import GuessHistoryFeature
+    return GuessHistoryFeature(name)
+
+
+# Guessers that have been loaded in this process, so that (e.g.) the buzzer
+# and the evaluation share one copy of each model rather than each loading
+# their own.  Maps the type and settings of a guesser (see model_key) to
+# (artifact signature, guesser).
+kLOADED_MODELS = {}
+
+
+def artifact_signature(files):
+    """
+    Summarize the files a model was saved to by their names, sizes and
+    modification times, so a model that is saved again isn't mistaken for
+    the one already loaded.
+    """
+    signature = []
+    for name in sorted(files):
+        if os.path.exists(name):
+            stat = os.stat(name)
+            signature.append((name, stat.st_size, stat.st_mtime_ns))
+    return hash(tuple(signature))
+
+
+def model_key(guesser_type, flags):
+    """
+    What decides which guesser the factory builds: its type, the flags
+    named after it, and the other flags it is registered with.
+    """
+    factory = kGUESSERS[guesser_type]
+    prefix = "%s_" % guesser_type
+    settings = sorted((name, repr(value)) for name, value in vars(flags).items()
+                      if name.startswith(prefix) or name in factory.settings)
+    return (guesser_type, tuple(settings))
+
+
+def model_signature(guesser_type, flags):
+    artifacts = kGUESSERS[guesser_type].artifacts
+    return artifact_signature(artifacts(flags) if artifacts else [])
+
+
+def instantiate_guesser(guesser_type, flags, load):
+    """
+    Create a guesser of the given type.  Loaded guessers are shared: asking
+    for the same model again (with the same settings, while the files it was
+    loaded from haven't changed) returns the instance that is already loaded
+    without building a new one.
+    """
+    assert guesser_type in kGUESSERS, \
+        "Guesser (type=%s) not initialized, known types: %s" % (guesser_type, ", ".join(kGUESSERS))
+
+    if load:
+        key = model_key(guesser_type, flags)
+        if key in kLOADED_MODELS:
+            signature, loaded = kLOADED_MODELS[key]
+            if signature == model_signature(guesser_type, flags):
+                logging.info("Reusing loaded guesser %s" % guesser_type)
+                return loaded
+
+    logging.info("Initializing guesser of type %s" % guesser_type)
+    guesser = kGUESSERS[guesser_type](flags)
+    if not load:
+        return guesser
+
+    if guesser_type not in kTRAINED_ON_CREATION:
+        guesser.load()
+    # After loading, which may have written some of the files itself
+    kLOADED_MODELS[key] = (model_signature(guesser_type, flags), guesser)
     return guesser
 
 def load_guesser(flags, load=False):
@@ -156,42 +425,24 @@ def load_buzzer(flags, load=False):
     """
     
     print("Loading buzzer")
-    buzzer = None
-    if flags.buzzer_type == "LogisticBuzzer":
-        from logistic_buzzer import LogisticBuzzer
-        buzzer = LogisticBuzzer(flags.LogisticBuzzer_filename, flags.run_length, flags.num_guesses)
+    assert flags.buzzer_type in kBUZZERS, "Buzzer (type=%s) not initialized" % flags.buzzer_type
+    buzzer = kBUZZERS[flags.buzzer_type](flags)
 
     if load:
         buzzer.load()
 
-    assert buzzer is not None, "Buzzer (type=%s) not initialized" % flags.buzzer_type
-
-
     for gg in flags.buzzer_guessers:
         guesser = instantiate_guesser(gg, flags, load=True)
-        guesser.load()
         logging.info("Adding %s to Buzzer" % gg)
         buzzer.add_guesser(gg, guesser, gg==flags.guesser_type)
 
     print("Initializing features: %s" % str(flags.features))
     print("dataset: %s" % str(flags.questions))
 
-    ######################################################################
-    ######################################################################
-    ######################################################################
-    ######
-    ######
-    ######  For the feature engineering homework, here's where you need
-    ######  to add your features to the buzzer.
-    ######
-    ######
-    ######################################################################
-    ######################################################################
-    ######################################################################    
-    
+    # See the registered features above for where to add your own
     for ff in flags.features:
-        if ff == "Length":
-            from features import LengthFeature
-            feature = LengthFeature(ff)
-            buzzer.add_feature(feature)
+        if ff in kFEATURES:
+            buzzer.add_feature(kFEATURES[ff](ff, flags))
+        else:
+            logging.warning("Unknown feature %s" % ff)
     return buzzer
@@ -0,0 +1,169 @@
+import io
+import os
+import gzip
+import sys
+import json
+import tempfile
+import subprocess
+import unittest
+from argparse import Namespace
+
+from params import kGUESSERS, kLOADED_MODELS, instantiate_guesser, load_questions, \
+    register, stream_json_records
+from startup import ImportTimer
+
+
+class ParamsTest(unittest.TestCase):
+    def setUp(self):
+        self.questions = [{"qanta_id": x, "text": "Question %i " % x * x, "page": "Page_%i" % x}
+                          for x in range(40)]
+
+    def test_stream(self):
+        for text in [json.dumps(self.questions), json.dumps(self.questions, indent=2),
+                     "\n".join(json.dumps(x) for x in self.questions)]:
+            for chunk_size in [1, 10, 1 << 20]:
+                self.assertEqual(list(stream_json_records(io.StringIO(text), chunk_size=chunk_size)),
+                                 self.questions)
+                self.assertEqual(list(stream_json_records(io.StringIO(text), 3, chunk_size)),
+                                 self.questions[:3])
+        self.assertEqual(list(stream_json_records(io.StringIO(" [ ] "))), [])
+        self.assertEqual(list(stream_json_records(io.StringIO("[1, 22, 333]"), chunk_size=1)), [1, 22, 333])
+        with self.assertRaises(json.JSONDecodeError):
+            list(stream_json_records(io.StringIO('[{"text": "unfinished'), chunk_size=4))
+
+    def test_limit(self):
+        class Unreadable(io.StringIO):
+            # Reading past the first records is an error
+            def read(self, size=-1):
+                assert self.tell() < 1000, "Read too far"
+                return super().read(size)
+
+        infile = Unreadable(json.dumps(self.questions) + "garbage" * 10000)
+        self.assertEqual(len(list(stream_json_records(infile, 2, chunk_size=100))), 2)
+
+    def test_wrapped(self):
+        reads = []
+
+        class CountingReads(io.StringIO):
+            def read(self, size=-1):
+                reads.append(size)
+                return super().read(size)
+
+        text = json.dumps({"questions": self.questions * 50})
+        records = list(stream_json_records(CountingReads(text), chunk_size=100))
+        self.assertEqual(records, [{"questions": self.questions * 50}])
+        # Reads double while the object is incomplete, rather than decoding
+        # it again after every chunk
+        self.assertLess(len(reads), 20)
+        self.assertGreater(len(text), 100 * 2 ** 8)
+
+    def test_load_questions(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "questions.json.gz")
+            with gzip.open(filename, 'wt') as outfile:
+                json.dump(self.questions, outfile)
+
+            flags = Namespace(questions=filename, question_source="gzjson", limit=5)
+            self.assertEqual(load_questions(flags), self.questions[:5])
+            lazy = load_questions(flags, lazy=True)
+            self.assertFalse(isinstance(lazy, list))
+            self.assertEqual(list(lazy), self.questions[:5])
+
+    def test_lazy_imports(self):
+        # Heavy libraries are only imported by the guessers that need them
+        check = "import sys, params; print(sorted(x for x in ['torch', 'pandas'] if x in sys.modules))"
+        result = subprocess.run([sys.executable, "-c", check], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(result.stdout.strip().splitlines()[-1], "[]")
+
+        self.assertIn("DanGuesser", kGUESSERS)
+        with self.assertRaises(AssertionError):
+            instantiate_guesser("NoSuchGuesser", Namespace(), False)
+
+    def test_import_timer(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "timed_module_example.py"), 'w') as outfile:
+                outfile.write("import json\nvalue = 42\n")
+
+            timer = ImportTimer()
+            sys.path.insert(0, directory)
+            sys.meta_path.insert(0, timer)
+            try:
+                import timed_module_example
+            finally:
+                sys.meta_path.remove(timer)
+                sys.path.remove(directory)
+                sys.modules.pop("timed_module_example", None)
+
+        self.assertEqual(timed_module_example.value, 42)
+        self.assertIn("timed_module_example", timer.times)
+        total, own = timer.times["timed_module_example"]
+        self.assertLessEqual(own, total)
+
+        report = io.StringIO()
+        timer.report(outfile=report)
+        self.assertIn("timed_module_example", report.getvalue())
+
+    def test_shared_models(self):
+        loads = []
+        built = []
+
+        class CountingGuesser:
+            def __init__(self, filename):
+                self.filename = filename
+                built.append(self)
+
+            def load(self):
+                loads.append(self)
+                # Loading writes files that share the model's prefix
+                with open(self.filename + ".cache", 'a') as outfile:
+                    outfile.write("loaded")
+
+        register(kGUESSERS, "CountingGuesser", settings=("counting_backend",),
+                 artifacts=lambda flags: [flags.CountingGuesser_filename + ".vectorizer.pkl"])(
+                     lambda flags: CountingGuesser(flags.CountingGuesser_filename))
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                filename = os.path.join(directory, "CountingGuesser")
+                with open(filename + ".vectorizer.pkl", 'w') as outfile:
+                    outfile.write("saved")
+                flags = Namespace(CountingGuesser_filename=filename, counting_backend="memory",
+                                  unrelated_flag=1)
+
+                first = instantiate_guesser("CountingGuesser", flags, True)
+                self.assertIs(instantiate_guesser("CountingGuesser", flags, True), first)
+                self.assertEqual(len(loads), 1)
+                # Reusing a loaded guesser doesn't build a new one
+                self.assertEqual(len(built), 1)
+
+                # Flags that change what gets built give a separate model,
+                # ones that don't are ignored
+                other = Namespace(**vars(flags))
+                other.unrelated_flag = 2
+                self.assertIs(instantiate_guesser("CountingGuesser", other, True), first)
+                other.counting_backend = "disk"
+                self.assertIsNot(instantiate_guesser("CountingGuesser", other, True), first)
+                self.assertIs(instantiate_guesser("CountingGuesser", flags, True), first)
+                self.assertEqual(len(loads), 2)
+
+                # Neither another model with the same prefix nor training
+                # changes the loaded model
+                with open(filename + "2.vectorizer.pkl", 'w') as outfile:
+                    outfile.write("another model")
+                self.assertIs(instantiate_guesser("CountingGuesser", flags, True), first)
+                self.assertIsNot(instantiate_guesser("CountingGuesser", flags, False), first)
+                self.assertEqual(len(loads), 2)
+
+                # Saving the model again means it has to be reloaded
+                with open(filename + ".vectorizer.pkl", 'w') as outfile:
+                    outfile.write("saved again")
+                self.assertIsNot(instantiate_guesser("CountingGuesser", flags, True), first)
+                self.assertEqual(len(loads), 3)
+        finally:
+            for key in [x for x in kLOADED_MODELS if x[0] == "CountingGuesser"]:
+                del kLOADED_MODELS[key]
+            del kGUESSERS["CountingGuesser"]
+
+
+if __name__ == '__main__':
+    unittest.main()
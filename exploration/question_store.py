@@ -0,0 +1,216 @@
+# Jordan Boyd-Graber
+# 2023
+#
+# A binary, column-oriented copy of a question file that can be opened
+# (memory-mapped) in milliseconds rather than parsing json, with random
+# access to a question by its qanta_id.
+#
+# Convert a file with:
+#   python question_store.py ../data/qanta.buzzdev.json.gz ../data/qanta.buzzdev.store
+
+import logging
+
+from collections.abc import Sequence
+
+import numpy as np
+
+from storage import ArrayDirectory
+
+kSTORE_VERSION = 1
+
+# String fields with few distinct values, stored as ids into a table
+kINTERNED = ["answer", "page", "category", "subcategory", "tournament", "difficulty",
+             "dataset", "fold"]
+
+# Field that holds the character spans of each sentence
+kSPANS = "tokenizations"
+
+# How a value can be missing (kept so a question round trips exactly)
+kPRESENT, kNONE, kABSENT = 0, 1, 2
+
+
+def column_kind(name, values):
+    """
+    Decide how to store a field from its (non-missing) values.
+    """
+    if name == kSPANS:
+        return "spans"
+    if all(isinstance(x, bool) for x in values):
+        return "bool"
+    if all(isinstance(x, int) and not isinstance(x, bool) for x in values):
+        return "int"
+    if all(isinstance(x, float) for x in values):
+        return "float"
+    if all(isinstance(x, str) for x in values):
+        return "interned" if name in kINTERNED else "text"
+    # Including numbers that mix ints and floats, which a float column
+    # would not give back as they were
+    return "json"
+
+
+def convert(questions, path):
+    """
+    Write a list of question dictionaries to a question store at path.
+    """
+    import json
+
+    store = ArrayDirectory(path, "QuestionStore", kSTORE_VERSION)
+    store.create()
+
+    names = []
+    for question in questions:
+        for name in question:
+            if name not in names:
+                names.append(name)
+
+    columns = {}
+    for name in names:
+        state = np.array([kABSENT if name not in x else (kNONE if x[name] is None else kPRESENT)
+                          for x in questions], dtype=np.uint8)
+        values = [x[name] for x in questions if x.get(name) is not None]
+        kind = column_kind(name, values)
+        columns[name] = kind
+        if np.any(state != kPRESENT):
+            store.save_array("%s.state" % name, state)
+
+        present = [x[name] if x.get(name) is not None else None for x in questions]
+        if kind == "spans":
+            spans = [x if x is not None else [] for x in present]
+            offsets = np.zeros(len(spans) + 1, dtype=np.int64)
+            np.cumsum([len(x) for x in spans], out=offsets[1:])
+            flat = np.array([span for x in spans for span in x], dtype=np.int64).reshape(-1, 2)
+            store.save_array("%s.spans" % name, flat)
+            store.save_array("%s.offsets" % name, offsets)
+        elif kind == "bool":
+            store.save_array(name, np.array([bool(x) for x in present], dtype=bool))
+        elif kind == "int":
+            store.save_array(name, np.array([x if x is not None else 0 for x in present], dtype=np.int64))
+        elif kind == "float":
+            store.save_array(name, np.array([x if x is not None else 0.0 for x in present], dtype=np.float64))
+        elif kind == "interned":
+            store.save_interned(name, [x if x is not None else "" for x in present])
+        elif kind == "text":
+            store.save_strings(name, [x if x is not None else "" for x in present])
+        else:
+            store.save_strings(name, [json.dumps(x) for x in present])
+
+    if columns.get("qanta_id") == "int":
+        # Sorted ids (and the row of each) to find a question by its id
+        ids = np.array([x.get("qanta_id", -1) for x in questions], dtype=np.int64)
+        order = np.argsort(ids, kind="stable")
+        store.save_array("qanta_id.sorted", ids[order])
+        store.save_array("qanta_id.rows", order)
+
+    store.meta["columns"] = columns
+    store.meta["names"] = names
+    store.meta["num_questions"] = len(questions)
+    store.commit()
+    logging.info("Wrote %i questions with %i fields to %s" % (len(questions), len(names), path))
+
+
+class QuestionStore(Sequence):
+    """
+    A read-only list of questions backed by a (memory-mapped) question
+    store.  Each access builds a new dictionary, just like the one in the
+    original json file; individual columns can be read with column().
+    """
+
+    def __init__(self, path, mmap=True):
+        import os
+
+        self.path = path
+        self._store = ArrayDirectory(path, "QuestionStore", kSTORE_VERSION)
+        self._store.open()
+        self.names = self._store.meta["names"]
+        self.kinds = self._store.meta["columns"]
+        self._num_questions = self._store.meta["num_questions"]
+
+        self._columns = {}
+        self._states = {}
+        for name, kind in self.kinds.items():
+            if kind == "spans":
+                self._columns[name] = (self._store.load_array("%s.spans" % name, mmap),
+                                       self._store.load_array("%s.offsets" % name, mmap))
+            elif kind == "interned":
+                self._columns[name] = self._store.load_interned(name, mmap)
+            elif kind in ["text", "json"]:
+                self._columns[name] = self._store.load_strings(name, mmap)
+            else:
+                self._columns[name] = self._store.load_array(name, mmap)
+            if os.path.exists(self._store.filename("%s.state.npy" % name)):
+                self._states[name] = self._store.load_array("%s.state" % name, mmap)
+
+        self._sorted_ids = None
+        if os.path.exists(self._store.filename("qanta_id.sorted.npy")):
+            self._sorted_ids = self._store.load_array("qanta_id.sorted", mmap)
+            self._id_rows = self._store.load_array("qanta_id.rows", mmap)
+
+    def __len__(self):
+        return self._num_questions
+
+    def column(self, name):
+        """
+        All of the values of a field: a numpy array for numeric fields, a
+        sequence of strings for text fields.
+        """
+        return self._columns[name]
+
+    def value(self, name, row):
+        kind = self.kinds[name]
+        column = self._columns[name]
+        if kind == "spans":
+            spans, offsets = column
+            return spans[offsets[row]:offsets[row + 1]].tolist()
+        if kind == "json":
+            import json
+            return json.loads(column[row])
+        if kind in ["text", "interned"]:
+            return column[row]
+        return column[row].item()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[x] for x in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+
+        question = {}
+        for name in self.names:
+            state = self._states[name][index] if name in self._states else kPRESENT
+            if state == kABSENT:
+                continue
+            question[name] = None if state == kNONE else self.value(name, index)
+        return question
+
+    def row(self, qanta_id):
+        """
+        The row of the question with this qanta_id (binary search over the
+        sorted ids, which are memory-mapped rather than read into a
+        dictionary).
+        """
+        assert self._sorted_ids is not None, "%s has no qanta_id index" % self.path
+        position = np.searchsorted(self._sorted_ids, qanta_id)
+        if position >= len(self._sorted_ids) or self._sorted_ids[position] != qanta_id:
+            raise KeyError(qanta_id)
+        return int(self._id_rows[position])
+
+    def by_id(self, qanta_id):
+        return self[self.row(qanta_id)]
+
+
+if __name__ == "__main__":
+    import sys
+    import gzip
+    import json
+
+    logging.basicConfig(level=logging.INFO)
+    source, destination = sys.argv[1:3]
+    if source.endswith(".gz"):
+        with gzip.open(source) as infile:
+            questions = json.load(infile)
+    else:
+        with open(source) as infile:
+            questions = json.load(infile)
+    convert(questions, destination)
@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+from argparse import Namespace
+
+import numpy as np
+
+from params import load_questions
+from question_store import QuestionStore, convert
+
+
+class QuestionStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.questions = [{"qanta_id": 30, "text": "For 10 points, name this state. Its capital is Augusta.",
+                           "page": "Maine", "category": "Geography", "year": 2010, "gameplay": True,
+                           "tokenizations": [[0, 31], [32, 55]], "difficulty": None, "score": 2010, "weight": 0.5},
+                          {"qanta_id": 12, "text": "Name this author of Emma.", "page": "Jane_Austen",
+                           "category": "Literature", "year": 2012, "gameplay": False,
+                           "tokenizations": [[0, 25]], "difficulty": "College", "extra": {"a": [1, 2]},
+                           "score": 0.25, "weight": 1.0},
+                          {"qanta_id": 7, "text": "Name this composer of the Magic Flute.",
+                           "page": "Wolfgang_Amadeus_Mozart", "category": "Music", "year": 2012,
+                           "gameplay": True, "tokenizations": [], "difficulty": "College"}]
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "questions.store")
+        convert(self.questions, self.path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        store = QuestionStore(self.path)
+        self.assertEqual(len(store), 3)
+        self.assertEqual(list(store), self.questions)
+        self.assertEqual(store[-1], self.questions[-1])
+        self.assertEqual(store.kinds["page"], "interned")
+        self.assertEqual(store.kinds["year"], "int")
+        self.assertEqual(store.kinds["extra"], "json")
+        # Ints mixed with floats stay ints
+        self.assertEqual(store.kinds["weight"], "float")
+        self.assertIsInstance(store[0]["score"], int)
+        self.assertIsInstance(store[1]["score"], float)
+        self.assertTrue(isinstance(store.column("year"), np.memmap))
+
+    def test_by_id(self):
+        store = QuestionStore(self.path)
+        for question in self.questions:
+            self.assertEqual(store.by_id(question["qanta_id"]), question)
+        with self.assertRaises(KeyError):
+            store.by_id(13)
+
+    def test_load_questions(self):
+        flags = Namespace(questions=self.path, question_source="columnar", limit=2)
+        self.assertEqual(load_questions(flags), self.questions[:2])
+
+
+if __name__ == '__main__':
+    unittest.main()
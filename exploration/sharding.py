@@ -0,0 +1,171 @@
+# Jordan Boyd-Graber
+# 2023
+#
+# Score query blocks against row shards of a tf-idf matrix in several worker
+# processes.  Workers never get their own copy of the matrix: they either
+# memory map the saved index directory or attach to shared memory blocks
+# that the parent fills once.
+
+import logging
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from topk import top_k_rows
+
+kCSR_PARTS = ["data", "indices", "indptr"]
+
+# State of a worker process, filled in by _attach
+_WORKER = {}
+
+
+def split_rows(num_rows, num_shards, boundaries=None):
+    """
+    Split num_rows rows into (at most) num_shards contiguous ranges of
+    roughly equal size.  If boundaries (sorted row ids, starting with 0 and
+    ending with num_rows) are given, only split at those rows.
+    """
+    if boundaries is None:
+        boundaries = np.arange(num_rows + 1)
+    boundaries = np.asarray(boundaries)
+    targets = np.linspace(0, num_rows, num_shards + 1)
+    cuts = np.unique(boundaries[np.searchsorted(boundaries, targets)])
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+def _attach(source, shards, page_starts, page_scoring):
+    """
+    Pool initializer: find the matrix arrays (without copying them).
+    """
+    if source["kind"] == "index":
+        from storage import ArrayDirectory
+        index = ArrayDirectory(source["path"], source["index_kind"], source["version"])
+        index.open()
+        arrays = [index.load_array("tfidf.%s" % x) for x in kCSR_PARTS]
+    else:
+        arrays = []
+        _WORKER["memory"] = []
+        for name, dtype, length in source["blocks"]:
+            memory = SharedMemory(name=name)
+            _WORKER["memory"].append(memory)
+            arrays.append(np.ndarray((length,), dtype=dtype, buffer=memory.buf))
+
+    _WORKER["arrays"] = arrays
+    _WORKER["num_columns"] = source["num_columns"]
+    _WORKER["shards"] = shards
+    _WORKER["page_starts"] = page_starts
+    _WORKER["page_scoring"] = page_scoring
+    _WORKER["matrices"] = {}
+
+
+def _shard_matrix(shard):
+    """
+    A csr_matrix over one shard's rows that views the shared arrays.
+    """
+    if shard not in _WORKER["matrices"]:
+        data, indices, indptr = _WORKER["arrays"]
+        lo, hi = _WORKER["shards"][shard]
+        start, stop = indptr[lo], indptr[hi]
+        _WORKER["matrices"][shard] = csr_matrix(
+            (data[start:stop], indices[start:stop], np.asarray(indptr[lo:hi + 1]) - start),
+            shape=(hi - lo, _WORKER["num_columns"]), copy=False)
+    return _WORKER["matrices"][shard]
+
+
+def _shard_top_k(task):
+    """
+    Score a block of queries against one shard, returning (ids, scores,
+    representative rows) of the shard's k best rows (or pages) per query.
+    """
+    shard, queries, k = task
+    lo, hi = _WORKER["shards"][shard]
+    similarities = (queries @ _shard_matrix(shard).T).toarray()
+
+    page_starts = _WORKER["page_starts"]
+    if page_starts is None:
+        top = top_k_rows(similarities, k)
+        scores = np.take_along_axis(similarities, top, axis=1)
+        return top + lo, scores, top + lo
+
+    # Shards are split on page boundaries, so each shard holds whole pages
+    first, last = np.searchsorted(page_starts, [lo, hi])
+    starts = page_starts[first:last + 1] - lo
+    reduce = np.maximum if _WORKER["page_scoring"] == "max" else np.add
+    page_scores = reduce.reduceat(similarities, starts[:-1], axis=1)
+    top = top_k_rows(page_scores, k)
+    scores = np.take_along_axis(page_scores, top, axis=1)
+    representatives = np.zeros(top.shape, dtype=np.int64)
+    for row, pages in enumerate(top):
+        for column, page in enumerate(pages):
+            segment = similarities[row, starts[page]:starts[page + 1]]
+            representatives[row, column] = lo + starts[page] + np.argmax(segment)
+    return top + first, scores, representatives
+
+
+class ShardPool:
+    """
+    A pool of worker processes that each score queries against row shards
+    of a csr matrix.  Use as a context manager so the workers (and any
+    shared memory) are cleaned up.
+
+    matrix -- The csr matrix to shard
+    workers -- How many processes to use
+    index -- An ArrayDirectory holding the matrix (as "tfidf"); workers map
+      it rather than receiving shared memory
+    page_starts -- If rows are grouped by page, where each page starts;
+      shards are then split on page boundaries and return pages
+    page_scoring -- How to combine sentence scores into page scores ("max" or "sum")
+    """
+
+    def __init__(self, matrix, workers, index=None, page_starts=None, page_scoring="max"):
+        self.workers = workers
+        self.page_scoring = page_scoring
+        self.shards = split_rows(matrix.shape[0], workers, page_starts)
+        self.page_starts = page_starts
+        self._memory = []
+
+        if index is not None:
+            self.source = {"kind": "index", "path": index.path, "index_kind": index.kind,
+                           "version": index.version}
+        else:
+            blocks = []
+            for part in kCSR_PARTS:
+                array = np.asarray(getattr(matrix, part))
+                memory = SharedMemory(create=True, size=max(1, array.nbytes))
+                np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)[:] = array
+                self._memory.append(memory)
+                blocks.append((memory.name, array.dtype.str, len(array)))
+            self.source = {"kind": "shared", "blocks": blocks}
+        self.source["num_columns"] = matrix.shape[1]
+
+    def __enter__(self):
+        logging.info("Starting %i workers over %i shards" % (self.workers, len(self.shards)))
+        self._pool = Pool(self.workers, initializer=_attach,
+                          initargs=(self.source, self.shards, self.page_starts, self.page_scoring))
+        return self
+
+    def __exit__(self, *args):
+        self._pool.close()
+        self._pool.join()
+        for memory in self._memory:
+            memory.close()
+            memory.unlink()
+        self._memory = []
+
+    def top_k(self, queries, k):
+        """
+        Score a block of queries on every shard in parallel and merge the
+        shards' top k lists.  Returns, for each query, arrays of the best ids
+        (rows, or pages), their scores and the rows that represent them.
+        """
+        tasks = [(shard, queries, k) for shard in range(len(self.shards))]
+        results = self._pool.map(_shard_top_k, tasks)
+
+        ids = np.concatenate([x[0] for x in results], axis=1)
+        scores = np.concatenate([x[1] for x in results], axis=1)
+        representatives = np.concatenate([x[2] for x in results], axis=1)
+        best = top_k_rows(scores, k)
+        return [(ids[row, top], scores[row, top], representatives[row, top])
+                for row, top in enumerate(best)]
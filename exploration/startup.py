@@ -0,0 +1,96 @@
+# Jordan Boyd-Graber
+# 2023
+#
+# Measure how long imports take, to see what a command pays for at startup
+# (see --profile_startup).  Imports that happen before this is installed
+# are not seen; use python -X importtime for those.
+
+import sys
+import atexit
+import importlib.abc
+
+from time import perf_counter
+
+
+class TimedLoader:
+    """
+    Wraps a module loader to time executing the module.
+    """
+
+    def __init__(self, loader, timer):
+        self._loader = loader
+        self._timer = timer
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        timer = self._timer
+        start = perf_counter()
+        timer.stack.append(0.0)
+        try:
+            self._loader.exec_module(module)
+        finally:
+            elapsed = perf_counter() - start
+            children = timer.stack.pop()
+            # Inclusive time, and time excluding the modules it imported
+            timer.times[module.__name__] = (elapsed, elapsed - children)
+            if timer.stack:
+                timer.stack[-1] += elapsed
+            else:
+                timer.total += elapsed
+
+
+class ImportTimer(importlib.abc.MetaPathFinder):
+    """
+    Records the time spent importing each module after it is installed.
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.stack = []
+        self.total = 0.0
+        self._finding = False
+
+    def find_spec(self, name, path, target=None):
+        if self._finding:
+            return None
+        self._finding = True
+        try:
+            for finder in sys.meta_path:
+                if finder is self or not hasattr(finder, "find_spec"):
+                    continue
+                spec = finder.find_spec(name, path, target)
+                if spec is not None:
+                    if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                        spec.loader = TimedLoader(spec.loader, self)
+                    return spec
+            return None
+        finally:
+            self._finding = False
+
+    def report(self, limit=25, outfile=None):
+        outfile = outfile if outfile else sys.stderr
+        top = sorted(self.times.items(), key=lambda x: -x[1][1])[:limit]
+        print("%-40s %10s %10s" % ("Module", "self (ms)", "total (ms)"), file=outfile)
+        for name, (total, own) in top:
+            print("%-40s %10.1f %10.1f" % (name, own * 1000, total * 1000), file=outfile)
+        print("%i modules imported in %0.1f ms" % (len(self.times), self.total * 1000), file=outfile)
+
+
+_timer = None
+
+
+def profile_imports():
+    """
+    Start timing imports and print a report when the program exits.
+    """
+    global _timer
+    if _timer is None:
+        _timer = ImportTimer()
+        sys.meta_path.insert(0, _timer)
+        atexit.register(_timer.report)
+    return _timer
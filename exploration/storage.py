@@ -0,0 +1,175 @@
+# Jordan Boyd-Graber
+# 2023
+#
+# Flat, memory-mappable storage for the arrays and strings that back our
+# indices.  Everything is written as raw .npy (or small json) files in a
+# directory so that np.load(mmap_mode='r') can share the pages between every
+# process that opens the same index.
+
+import os
+import json
+import shutil
+import logging
+
+from collections.abc import Sequence
+
+import numpy as np
+
+
+class StringBlob(Sequence):
+    """
+    A list of strings stored as one UTF-8 byte array plus the offset where
+    each string starts.  Strings are only decoded when they are accessed.
+    """
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    @staticmethod
+    def encode(strings):
+        """
+        Turn a list of strings into a (blob, offsets) pair of numpy arrays.
+        """
+        encoded = [x.encode('utf-8') for x in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in encoded], out=offsets[1:])
+        blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return blob, offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[x] for x in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        start, stop = self.offsets[index], self.offsets[index + 1]
+        return self.blob[start:stop].tobytes().decode('utf-8')
+
+
+class InternedStrings(Sequence):
+    """
+    A list of (heavily repeated) strings stored as integer ids into a table
+    of the distinct values.
+    """
+
+    def __init__(self, ids, table):
+        self.ids = ids
+        self.table = table
+
+    @staticmethod
+    def intern(strings):
+        """
+        Turn a list of strings into an (ids, table) pair; the table is in
+        order of first appearance.
+        """
+        lookup = {}
+        ids = np.zeros(len(strings), dtype=np.int32)
+        for position, value in enumerate(strings):
+            ids[position] = lookup.setdefault(value, len(lookup))
+        return ids, list(lookup)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.table[x] for x in self.ids[index]]
+        return self.table[self.ids[index]]
+
+
+class ArrayDirectory:
+    """
+    A directory of named arrays, strings and sparse matrices with a
+    versioned json header.
+    """
+
+    def __init__(self, path, kind, version):
+        self.path = path
+        self.kind = kind
+        self.version = version
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, "meta.json"))
+
+    def filename(self, name):
+        return os.path.join(self.path, name)
+
+    # Writing
+
+    def create(self):
+        """
+        Start writing to a temporary directory; commit() moves it into place
+        so a reader never sees a half-written index.
+        """
+        self._final = self.path
+        self.path = "%s.tmp" % self._final
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path)
+        self.meta = {"kind": self.kind, "version": self.version}
+
+    def save_array(self, name, array):
+        np.save(self.filename("%s.npy" % name), np.ascontiguousarray(array))
+
+    def save_strings(self, name, strings):
+        blob, offsets = StringBlob.encode(strings)
+        self.save_array("%s.blob" % name, blob)
+        self.save_array("%s.offsets" % name, offsets)
+
+    def save_interned(self, name, strings):
+        if isinstance(strings, InternedStrings):
+            ids, table = strings.ids, strings.table
+        else:
+            ids, table = InternedStrings.intern(strings)
+        self.save_array("%s.ids" % name, ids)
+        with open(self.filename("%s.table.json" % name), 'w') as outfile:
+            json.dump(table, outfile)
+
+    def save_csr(self, name, matrix):
+        matrix = matrix.tocsr()
+        for part in ["data", "indices", "indptr"]:
+            self.save_array("%s.%s" % (name, part), getattr(matrix, part))
+        self.meta["%s.shape" % name] = list(matrix.shape)
+
+    def commit(self):
+        with open(self.filename("meta.json"), 'w') as outfile:
+            json.dump(self.meta, outfile)
+
+        old = "%s.old" % self._final
+        if os.path.exists(self._final):
+            os.rename(self._final, old)
+        os.rename(self.path, self._final)
+        if os.path.exists(old):
+            shutil.rmtree(old)
+        self.path = self._final
+        logging.info("Wrote %s index to %s" % (self.kind, self.path))
+
+    # Reading
+
+    def open(self):
+        with open(self.filename("meta.json")) as infile:
+            self.meta = json.load(infile)
+        assert self.meta["kind"] == self.kind, \
+            "%s holds a %s index, not %s" % (self.path, self.meta["kind"], self.kind)
+        assert self.meta["version"] == self.version, \
+            "%s has index version %s, expected %s" % (self.path, self.meta["version"], self.version)
+
+    def load_array(self, name, mmap=True):
+        return np.load(self.filename("%s.npy" % name), mmap_mode='r' if mmap else None)
+
+    def load_strings(self, name, mmap=True):
+        return StringBlob(self.load_array("%s.blob" % name, mmap),
+                          self.load_array("%s.offsets" % name, mmap))
+
+    def load_interned(self, name, mmap=True):
+        with open(self.filename("%s.table.json" % name)) as infile:
+            table = json.load(infile)
+        return InternedStrings(self.load_array("%s.ids" % name, mmap), table)
+
+    def load_csr(self, name, mmap=True):
+        from scipy.sparse import csr_matrix
+        parts = [self.load_array("%s.%s" % (name, x), mmap) for x in ["data", "indices", "indptr"]]
+        return csr_matrix(tuple(parts), shape=tuple(self.meta["%s.shape" % name]), copy=False)
@@ -1,5 +1,6 @@
 from typing import List, Optional, Tuple
 from collections import defaultdict
+import copy
 import pickle
 import json
 import argparse
@@ -11,50 +12,199 @@ import logging
 from tqdm import tqdm
 
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.feature_extraction.text import TfidfVectorizer
 
 MODEL_PATH = 'tfidf.pickle'
 INDEX_PATH = 'index.pickle'
 QN_PATH = 'questions.pickle'
 ANS_PATH = 'answers.pickle'
 
+# Bump this whenever the layout of the index directory changes
+kINDEX_VERSION = 1
+
+# Most memory a worker's dense block of similarities should take
+kSHARD_BLOCK_BYTES = 1 << 28
+
 import os
+import re
 
 from nltk.tokenize import sent_tokenize
 from guesser import print_guess, Guesser
+from topk import pad_top_k, top_k_rows, top_k_sparse
+from inverted_index import MaxScoreIndex
+from storage import ArrayDirectory, InternedStrings
+from sharding import ShardPool
+
+kLAST_WORD = re.compile(r'\s\S*$')
 
 
-class DummyVectorizer:
+class PrefixScorer:
     """
-    A dumb vectorizer that only creates a random matrix instead of something real.
+    Scores a question as it is revealed, one prefix at a time.
+
+    Keeps the running term counts of the text seen so far and, for every
+    sentence that shares a term with it, the (unnormalized) dot product with
+    the query.  Extending the text only tokenizes the new words and walks the
+    posting lists of the terms whose counts changed, so the cost of each step
+    is proportional to what was revealed rather than to the whole prefix.
     """
-    def __init__(self, width=50):
-        self.width = width
-        self.vocabulary_ = {}
-    
-    def transform(self, questions):
-        import numpy as np
-        return np.random.rand(len(questions), self.width)
+
+    def __init__(self, guesser, max_n_guesses):
+        self.guesser = guesser
+        self.max_n_guesses = max_n_guesses
+
+        vectorizer = guesser.tfidf_vectorizer
+        self.analyzer = vectorizer.build_analyzer()
+        self.vocabulary = vectorizer.vocabulary_
+        self.idf = vectorizer.idf_ if vectorizer.use_idf else None
+        self.incremental = vectorizer.analyzer == 'word' and \
+            tuple(vectorizer.ngram_range) == (1, 1) and vectorizer.norm in ('l2', None)
+
+        # Allocated once per scorer; reset only clears the touched entries
+        num_docs = guesser.tfidf.shape[0]
+        self.dot = np.zeros(num_docs)
+        self.seen = np.zeros(num_docs, dtype=bool)
+        self.touched = []
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the text seen so far (e.g., to start on a new question).  The
+        cost is proportional to the number of sentences touched since the
+        last reset, not to the size of the index.
+        """
+        for docs in self.touched:
+            self.dot[docs] = 0.0
+            self.seen[docs] = False
+        self.touched = []
+        self.text = ""
+        self.counts = defaultdict(int)
+        self.squared_norm = 0.0
+
+    def candidates(self):
+        """
+        The (sorted) ids of the sentences that share a term with the text.
+        """
+        if len(self.touched) != 1:
+            docs = np.concatenate(self.touched) if self.touched else np.zeros(0, dtype=np.int64)
+            docs.sort()
+            self.touched = [docs]
+        return self.touched[0]
+
+    def weight(self, term, count):
+        """
+        The tf-idf weight (before normalization) of a term that appears count
+        times, following the settings of the guesser's vectorizer.
+        """
+        vectorizer = self.guesser.tfidf_vectorizer
+        if count <= 0:
+            return 0.0
+        if vectorizer.binary:
+            count = 1
+        weight = 1 + math.log(count) if vectorizer.sublinear_tf else float(count)
+        if self.idf is not None:
+            weight *= self.idf[term]
+        return weight
+
+    def extend(self, text):
+        """
+        Update the scores for text, which should extend the text passed to
+        the previous call, and return the top guesses.
+        """
+        if not self.incremental:
+            self.text = text
+            return self.guesser._score_block([text], self.max_n_guesses)[0]
+
+        if not text.startswith(self.text):
+            self.reset()
+
+        # The last word of the old text may continue in the new text, so
+        # retokenize from the start of that word
+        last_word = kLAST_WORD.search(self.text)
+        tail = last_word.start() + 1 if last_word else 0
+
+        delta = defaultdict(int)
+        for token in self.analyzer(self.text[tail:]):
+            delta[token] -= 1
+        for token in self.analyzer(text[tail:]):
+            delta[token] += 1
+        self.text = text
+
+        index = self.guesser.inverted_index()
+        for token, change in delta.items():
+            term = self.vocabulary.get(token)
+            if change == 0 or term is None:
+                continue
+            old = self.weight(term, self.counts[term])
+            self.counts[term] += change
+            new = self.weight(term, self.counts[term])
+
+            docs, doc_weights = index.postings(term)
+            self.dot[docs] += (new - old) * doc_weights
+            unseen = docs[~self.seen[docs]]
+            if len(unseen) > 0:
+                self.seen[unseen] = True
+                self.touched.append(unseen)
+            self.squared_norm += new * new - old * old
+
+        return self.top()
+
+    def top(self):
+        """
+        Return the best guesses for the text seen so far.
+        """
+        norm = math.sqrt(self.squared_norm) if self.guesser.tfidf_vectorizer.norm == 'l2' else 1.0
+        candidates = self.candidates()
+        scores = self.dot[candidates] / norm if norm > 0 else np.zeros(len(candidates))
+
+        if self.guesser.page_scoring != "sentence":
+            return self.guesser._candidate_pages(candidates, scores, self.max_n_guesses)
+
+        best = top_k_rows(scores, self.max_n_guesses)[0]
+        hits, scores = candidates[best], scores[best]
+        hits, scores = self.guesser.inverted_index().pad(hits, scores, self.max_n_guesses)
+        return self.guesser._guess_dicts(hits, scores)
+
+kBACKENDS = ["matrix", "maxscore"]
+kPAGE_SCORING = ["sentence", "max", "sum"]
+
 
 class TfidfGuesser(Guesser):
     """
     Class that, given a query, finds the most similar question to it.
     """
-    def __init__(self, filename, min_df=10, max_df=0.4):
+    def __init__(self, filename, min_df=10, max_df=0.4, backend="matrix", page_scoring="sentence",
+                 workers=1):
         """
         Initializes data structures that will be useful later.
 
         filename -- base of filename we store vectorizer and documents to
         min_df -- we use the sklearn vectorizer parameters, this for min doc freq
         max_df -- we use the sklearn vectorizer parameters, this for max doc freq
+        backend -- "matrix" scores every sentence with a sparse matrix
+          product, "maxscore" only walks the posting lists of the query terms
+        page_scoring -- "sentence" returns the best sentences (which may
+          share a page); "max" or "sum" combine the scores of each page's
+          sentences and return the best distinct pages
+        workers -- How many processes batch_guess splits the matrix across
         """
+        assert backend in kBACKENDS, "Unknown tf-idf backend %s" % backend
+        assert page_scoring in kPAGE_SCORING, "Unknown page scoring %s" % page_scoring
 
-        # You'll need add the vectorizer here and replace this fake vectorizer
-        self.tfidf_vectorizer = DummyVectorizer()
+        self.tfidf_vectorizer = TfidfVectorizer(min_df=min_df, max_df=max_df,
+                                                stop_words='english')
         self.tfidf = None 
         self.questions = None
         self.answers = None
         self.filename = filename
+        self.backend = backend
+        self.page_scoring = page_scoring
+        self.workers = workers
+        self._inverted_index = None
+        # The index directory the matrix is memory mapped from, if any
+        self._mapped_index = None
+        # Where the (contiguous) sentences of each answer id start
+        self._answer_starts = None
 
     def train(self, training_data, answer_field='page', split_by_sentence=True,
                   min_length=-1, max_length=-1, remove_missing_pages=True):
@@ -68,27 +218,102 @@ class TfidfGuesser(Guesser):
 
         Guesser.train(self, training_data, answer_field, split_by_sentence, min_length,
                           max_length, remove_missing_pages)
+        self._group_by_answer()
 
-        self.tfidf = self.tfidf_vectorizer.transform(self.questions)
+        self.tfidf = self.tfidf_vectorizer.fit_transform(self.questions).tocsr()
+        self._inverted_index = None
+        self._mapped_index = None
         logging.info("Creating tf-idf dataframe with %i" % len(self.questions))
         
-    def save(self):
+    def _group_by_answer(self):
         """
-        Save the parameters to disk
+        Intern the answers and sort the index rows by answer id, so that all
+        of the sentences of a page are contiguous and page scores can be
+        computed with segment reductions.
         """
-        
-        path = self.filename
-        with open("%s.vectorizer.pkl" % path, 'wb') as f:
-            pickle.dump(self.tfidf_vectorizer, f)
-        
-        with open("%s.tfidf.pkl" % path, 'wb') as f:
-            pickle.dump(self.tfidf, f)
+        if not isinstance(self.answers, InternedStrings):
+            self.answers = InternedStrings(*InternedStrings.intern(self.answers))
+
+        ids = np.asarray(self.answers.ids)
+        if np.any(ids[1:] < ids[:-1]):
+            logging.info("Sorting %i sentences by answer" % len(ids))
+            order = np.argsort(ids, kind="stable")
+            ids = ids[order]
+            self.questions = [self.questions[x] for x in order]
+            self.answers = InternedStrings(ids, self.answers.table)
+            if self.tfidf is not None:
+                self.tfidf = self.tfidf[order]
+            self._mapped_index = None
+
+        self._answer_starts = np.searchsorted(ids, np.arange(len(self.answers.table) + 1))
+        assert np.all(np.diff(self._answer_starts) > 0), "Answer table has pages without sentences"
+
+    def _reduce_pages(self, scores, starts, axis=-1):
+        if self.page_scoring == "max":
+            return np.maximum.reduceat(scores, starts, axis=axis)
+        else:
+            return np.add.reduceat(scores, starts, axis=axis)
+
+    def _page_dicts(self, pages, scores, representatives):
+        return [{"question": self.questions[rr], "guess": self.answers.table[pp],
+                 "confidence": float(ss)} for pp, ss, rr in zip(pages, scores, representatives)]
+
+    def _candidate_pages(self, docs, scores, k):
+        """
+        Given the scores of some (sorted) sentences, return the k best pages.
+        Each page is represented by its highest scoring sentence; if fewer
+        than k pages have a score, pages that share nothing with the query
+        fill the rest.
+        """
+        pages = np.asarray(self.answers.ids)[docs]
+        starts = np.flatnonzero(np.diff(pages, prepend=-1))
+        stops = np.append(starts[1:], len(docs))
+        if len(docs) > 0:
+            page_scores = self._reduce_pages(scores, starts)
+        else:
+            page_scores = np.zeros(0)
+
+        best = top_k_rows(page_scores, k)[0]
+        representatives = [docs[starts[x] + np.argmax(scores[starts[x]:stops[x]])] for x in best]
+        page_scores = list(page_scores[best])
+        found = pages[starts[best]]
+
+        num_pages = len(self.answers.table)
+        missing = np.setdiff1d(np.arange(min(num_pages, k + len(found))), found)[:k - len(found)]
+        return self._page_dicts(np.concatenate([found, missing]).astype(int),
+                                page_scores + [0.0] * len(missing),
+                                representatives + list(self._answer_starts[missing]))
+
+    def index_directory(self):
+        return ArrayDirectory("%s.index" % self.filename, "TfidfGuesser", kINDEX_VERSION)
 
-        with open("%s.questions.pkl" % path, 'wb') as f:
-            pickle.dump(self.questions, f)
+    def save(self):
+        """
+        Save the parameters to disk.
 
-        with open("%s.answers.pkl" % path, 'wb') as f:
-            pickle.dump(self.answers, f)
+        Everything but the vectorizer is written as flat arrays in the
+        directory FILENAME.index so that load can memory map it: the sparse
+        matrix as its data/indices/indptr arrays, the questions as one UTF-8
+        blob with offsets, and the answers as ids into a table of pages.
+        """
+        index = self.index_directory()
+        index.create()
+
+        # The pruned vocabulary is only kept for introspection, and it can
+        # be much larger than the vocabulary itself; leave it out of a
+        # (shallow) copy so the vectorizer in memory is unchanged
+        vectorizer = copy.copy(self.tfidf_vectorizer)
+        vectorizer.stop_words_ = None
+        with open(index.filename("vectorizer.pkl"), 'wb') as f:
+            pickle.dump(vectorizer, f)
+
+        index.save_csr("tfidf", self.tfidf)
+        # The posting lists too, so loading does not copy the matrix to build them
+        self.inverted_index().save(index)
+        index.save_strings("questions", self.questions)
+        index.save_interned("answers", self.answers)
+        index.commit()
+        self._mapped_index = index
 
     def __call__(self, question, max_n_guesses=4):
         """
@@ -98,31 +323,111 @@ class TfidfGuesser(Guesser):
         question -- Raw text of the question
         max_n_guesses -- How many top guesses to return
         """
-        top_questions = []
-        top_answers = []
-        top_sim = []
+        return self._score_block([question], max_n_guesses)[0]
+
+    def _guess_dicts(self, hits, scores):
+        return [{"question": self.questions[idx], "guess": self.answers[idx],
+                 "confidence": float(score)} for idx, score in zip(hits, scores)]
+
+    def prefix_scorer(self, max_n_guesses=4):
+        """
+        Create a PrefixScorer, which scores a question incrementally as more
+        of it is revealed (e.g., word by word while buzzing).
+        """
+        return PrefixScorer(self, max_n_guesses)
+
+    def batch_prefix_guess(self, questions, n_guesses=1):
+        """
+        Generate guesses for every run of every question, sharing the work
+        between the runs of a question with a PrefixScorer.
+
+        With more than one worker (and the matrix backend), the runs are
+        instead scored as one batch against the shards of the matrix.
+        """
+        if self.workers > 1 and self.backend == "matrix":
+            return Guesser.batch_prefix_guess(self, questions, n_guesses)
+
+        guesses = []
+        scorer = self.prefix_scorer(n_guesses)
+        for runs in tqdm(questions):
+            scorer.reset()
+            for run in runs:
+                guesses.append(scorer.extend(run))
+        return guesses
+
+    def inverted_index(self):
+        """
+        The posting lists used by the maxscore backend and the PrefixScorer:
+        memory mapped from the index directory if they were saved there,
+        otherwise built the first time they are needed.
+        """
+        if self._inverted_index is None:
+            logging.info("Building inverted index over %i sentences" % self.tfidf.shape[0])
+            self._inverted_index = MaxScoreIndex(self.tfidf)
+        return self._inverted_index
+
+    def _score_block(self, block, max_n_guesses):
+        if self.backend == "maxscore":
+            return self._search_block(block, max_n_guesses)
+        else:
+            return self._multiply_block(block, max_n_guesses)
+
+    def _search_block(self, block, max_n_guesses):
+        """
+        Score a list of questions one at a time with the inverted index.  The
+        work for each question depends on how common its terms are, not on
+        how many sentences are indexed.
+        """
+        index = self.inverted_index()
+        block_tfidf = self.tfidf_vectorizer.transform(block).tocsr()
 
-        # Compute the cosine similarity
-        question_tfidf = self.tfidf_vectorizer.transform([question])
-        cosine_similarities = cosine_similarity(question_tfidf, self.tfidf)
-        cos = cosine_similarities[0]
-        indices = cos.argsort()[::-1]
         guesses = []
-        for i in range(max_n_guesses):
-            # The line below is wrong but lets the code run for the homework.
-            # Remove it or fix it!
-            idx = i
-            guess =  {"question": self.questions[idx], "guess": self.answers[idx],
-                      "confidence": cos[idx]}
-            guesses.append(guess)
+        for row in range(block_tfidf.shape[0]):
+            start, stop = block_tfidf.indptr[row], block_tfidf.indptr[row + 1]
+            terms, weights = block_tfidf.indices[start:stop], block_tfidf.data[start:stop]
+            if self.page_scoring == "sentence":
+                hits, scores = index.search(terms, weights, max_n_guesses)
+                guesses.append(self._guess_dicts(hits, scores))
+            else:
+                # Early termination is per sentence, so it cannot rank pages
+                docs, scores = index.score_all(terms, weights)
+                guesses.append(self._candidate_pages(docs, scores, max_n_guesses))
+        return guesses
+
+    def _multiply_block(self, block, max_n_guesses):
+        """
+        Score a list of questions against every indexed sentence at once.
+
+        The tf-idf rows are L2 normalized, so the cosine similarity is just
+        the dot product: one sparse matrix multiplication scores the whole
+        block.  The product stays sparse (only sentences that share a term
+        with a question are stored), so the memory for a block does not grow
+        with the number of sentences, and the best sentences (or pages) are
+        selected from each row's stored scores.
+        """
+        block_tfidf = self.tfidf_vectorizer.transform(block)
+        similarities = (block_tfidf @ self.tfidf.T).tocsr()
+        similarities.sort_indices()
+
+        guesses = []
+        if self.page_scoring == "sentence":
+            for hits, scores in top_k_sparse(similarities, max_n_guesses):
+                hits, scores = pad_top_k(hits, scores, max_n_guesses, self.tfidf.shape[0])
+                guesses.append(self._guess_dicts(hits, scores))
+            return guesses
+
+        for row in range(similarities.shape[0]):
+            start, stop = similarities.indptr[row], similarities.indptr[row + 1]
+            guesses.append(self._candidate_pages(similarities.indices[start:stop],
+                                                 similarities.data[start:stop], max_n_guesses))
         return guesses
 
     def batch_guess(self, questions, max_n_guesses, block_size=1024):
         """
         The batch_guess function allows you to find the search
-        results for multiple questions at once.  This is more efficient
+        results for multiple questions at once.  This is more efficient
         than running the retriever for each question, finding the
-        largest elements, and returning them individually.  
+        largest elements, and returning them individually.  
 
         To understand why, remember that the similarity operation for an
         individual query and the corpus is a dot product, but if we do
@@ -132,46 +437,97 @@ class TfidfGuesser(Guesser):
 
         The most complicated part is sorting the resulting similarities,
         which is a good use of the argpartition function from numpy.
-        """
 
-        # IMPORTANT NOTE FOR HOMEWORK: you do not need to complete
-        # batch_guess.  If you're having trouble with this, just
-        # delete the function, and the parent class will emulate the
-        # functionality one row at a time.
-        
-        from math import floor
-    
+        Keyword arguments:
+        questions -- Raw text of the questions
+        max_n_guesses -- How many top guesses to return for each question
+        block_size -- How many questions to score with one matrix multiplication
+        """
         all_guesses = []
 
         logging.info("Querying matrix of size %i with block size %i" %
                      (len(questions), block_size))
 
-        # The next line of code is bogus, this needs to be fixed
-        # to give you a real answer.
-        top_hits = np.array([list(range(max_n_guesses-1, -1, -1))]*block_size)
+        if self.workers > 1 and self.backend == "matrix":
+            return self._sharded_batch_guess(questions, max_n_guesses, block_size)
+
         for start in tqdm(range(0, len(questions), block_size)):
             stop = start+block_size
             block = questions[start:stop]
             logging.info("Block %i to %i (%i elements)" % (start, stop, len(block)))
-            
-            
-
-            for question in range(len(block)):
-                guesses = []
-                for idx in list(top_hits[question]):
-                    score = 0.0
-                    guesses.append({"guess": self.answers[idx], "confidence": score, "question": self.questions[idx]})
-                all_guesses.append(guesses)
+            all_guesses += self._score_block(block, max_n_guesses)
 
         assert len(all_guesses) == len(questions), "Guesses (%i) != questions (%i)" % (len(all_guesses), len(questions))
         return all_guesses
     
+    def _sharded_batch_guess(self, questions, max_n_guesses, block_size):
+        """
+        Like batch_guess, but split the rows of the matrix (on page
+        boundaries) across worker processes.  Each worker scores every block
+        against its shard, and the shards' top guesses are merged.
+        """
+        page_starts = None if self.page_scoring == "sentence" else self._answer_starts
+
+        # Each worker scores a block against its shard as a dense matrix, so
+        # keep that matrix within a memory budget
+        shard_rows = -(-self.tfidf.shape[0] // self.workers)
+        block_size = max(1, min(block_size, kSHARD_BLOCK_BYTES // (8 * shard_rows)))
+
+        all_guesses = []
+        with ShardPool(self.tfidf, self.workers, self._mapped_index, page_starts,
+                       self.page_scoring) as pool:
+            for start in tqdm(range(0, len(questions), block_size)):
+                block = questions[start:start + block_size]
+                block_tfidf = self.tfidf_vectorizer.transform(block).tocsr()
+                for ids, scores, representatives in pool.top_k(block_tfidf, max_n_guesses):
+                    if page_starts is None:
+                        all_guesses.append(self._guess_dicts(ids, scores))
+                    else:
+                        all_guesses.append(self._page_dicts(ids, scores, representatives))
+
+        assert len(all_guesses) == len(questions), "Guesses (%i) != questions (%i)" % (len(all_guesses), len(questions))
+        return all_guesses
+
     def load(self):
         """
-        Load the tf-idf guesser from a file
+        Load the tf-idf guesser from a file.
+
+        The index arrays are memory mapped rather than read, so loading is
+        nearly instant and processes that load the same index share its
+        memory.  Falls back to the older format of four pickles if there is
+        no index directory.
         """
-        
+        index = self.index_directory()
+        if index.exists():
+            index.open()
+            with open(index.filename("vectorizer.pkl"), 'rb') as f:
+                self.tfidf_vectorizer = pickle.load(f)
+            self.tfidf = index.load_csr("tfidf")
+            self.questions = index.load_strings("questions")
+            self.answers = index.load_interned("answers")
+            self._mapped_index = index
+        else:
+            self._load_pickles()
+            self._mapped_index = None
+
+        self._group_by_answer()
+        self._inverted_index = None
+        if self._mapped_index is not None:
+            # Older index directories do not have the posting lists; then
+            # they are built (in memory) when they are first needed
+            self._inverted_index = MaxScoreIndex.load(self._mapped_index)
+
+    @staticmethod
+    def artifacts(filename):
+        index = ArrayDirectory("%s.index" % filename, "TfidfGuesser", kINDEX_VERSION)
+        if index.exists():
+            # meta.json is written last, whenever the index is saved
+            return [index.filename("meta.json"), index.filename("vectorizer.pkl")]
+        return ["%s.%s.pkl" % (filename, x) for x in ["vectorizer", "tfidf", "questions", "answers"]]
+
+    def _load_pickles(self):
         path = self.filename
+        logging.info("No index at %s, reading pickles" % self.index_directory().path)
         with open("%s.vectorizer.pkl" % path, 'rb') as f:
             self.tfidf_vectorizer = pickle.load(f)
         
@@ -0,0 +1,170 @@
+# Jordan Boyd-Graber
+# 2023
+#
+# Sentence and word tokenization of questions, reusing the sentence spans
+# that ship with the qanta data and caching what we have to compute with
+# NLTK so that retraining does not tokenize the same questions again.
+
+import os
+import pickle
+import hashlib
+import logging
+
+from multiprocessing import Pool
+
+from nltk.tokenize import sent_tokenize, word_tokenize
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def provided_sentences(question):
+    """
+    Return the sentences of a question from its "tokenizations" field
+    (character spans), or None if the question does not have them.
+    """
+    spans = question.get("tokenizations")
+    if not spans:
+        return None
+    text = question["text"]
+    sentences = [text[start:stop] for start, stop in spans]
+    return [x for x in sentences if x.strip()]
+
+
+def _tokenize_words(text):
+    return [word_tokenize(x) for x in sent_tokenize(text)]
+
+
+class TokenizationCache:
+    """
+    Splits questions into sentences and words.
+
+    Sentence spans provided with a question are used as is.  Everything else
+    is tokenized with NLTK (in parallel when there are workers) and cached on
+    disk, keyed by qanta_id and a hash of the text, so a changed question is
+    tokenized again.  The file is a log: each batch of new tokenizations is
+    appended to it, so saving costs what was added rather than the whole
+    cache.  When it is opened with more than max_batches batches (or with a
+    batch cut short) the log is compacted into one.
+    """
+
+    def __init__(self, filename="", workers=1, max_batches=100):
+        """
+        filename -- Where to persist the cache ("" to only cache in memory)
+        workers -- How many processes to tokenize with
+        max_batches -- How many batches the file can have before it is compacted
+        """
+        self.filename = filename
+        self.workers = workers
+        self.cache = {}
+        if filename and os.path.exists(filename):
+            self.cache, batches, partial = self.read(filename)
+            logging.info("Read %i tokenizations from %s" % (len(self.cache), filename))
+            # Batches appended after a partial one could not be read back
+            if partial or batches > max_batches:
+                self.save()
+
+    @staticmethod
+    def read(filename):
+        """
+        Read every batch appended to a cache file, returning the cache, the
+        number of batches and whether the last one was cut short (by a crash
+        while appending), in which case it is ignored.
+        """
+        cache = {}
+        batches = 0
+        partial = False
+        with open(filename, 'rb') as infile:
+            while True:
+                try:
+                    cache.update(pickle.load(infile))
+                    batches += 1
+                except EOFError:
+                    break
+                except pickle.UnpicklingError:
+                    logging.warning("Ignoring a partial batch at the end of %s" % filename)
+                    partial = True
+                    break
+        return cache, batches, partial
+
+    def _tokenize(self, function, texts):
+        if self.workers > 1 and len(texts) > self.workers:
+            with Pool(self.workers) as pool:
+                return pool.map(function, texts, chunksize=max(1, len(texts) // (4 * self.workers)))
+        return [function(x) for x in texts]
+
+    def _lookup(self, keys, texts, function):
+        missing = [ii for ii, key in enumerate(keys) if key not in self.cache]
+        if missing:
+            logging.info("Tokenizing %i of %i texts" % (len(missing), len(keys)))
+            added = {}
+            for ii, result in zip(missing, self._tokenize(function, [texts[x] for x in missing])):
+                added[keys[ii]] = result
+            self.cache.update(added)
+            self.append(added)
+        return [self.cache[x] for x in keys]
+
+    def sentences(self, questions):
+        """
+        Return a list of sentences for each question.
+        """
+        result = [provided_sentences(x) for x in questions]
+        needed = [ii for ii, sentences in enumerate(result) if sentences is None]
+        if needed:
+            texts = [questions[x]["text"] for x in needed]
+            keys = [("sentences", questions[x].get("qanta_id"), text_hash(text))
+                    for x, text in zip(needed, texts)]
+            for ii, sentences in zip(needed, self._lookup(keys, texts, sent_tokenize)):
+                result[ii] = sentences
+        return result
+
+    def words(self, texts):
+        """
+        Return, for each text, a list of its sentences as lists of words.
+        """
+        keys = [("words", text_hash(x)) for x in texts]
+        return self._lookup(keys, texts, _tokenize_words)
+
+    def append(self, entries):
+        """
+        Add a batch of new tokenizations to the end of the cache file.
+        """
+        if not self.filename or not entries:
+            return
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.filename, 'ab') as outfile:
+            pickle.dump(entries, outfile)
+        logging.debug("Appended %i tokenizations to %s" % (len(entries), self.filename))
+
+    def save(self):
+        """
+        Rewrite the cache file as a single batch (dropping entries that were
+        appended more than once).
+        """
+        if not self.filename:
+            return
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open("%s.tmp" % self.filename, 'wb') as outfile:
+            pickle.dump(self.cache, outfile)
+        os.replace("%s.tmp" % self.filename, self.filename)
+        logging.info("Wrote %i tokenizations to %s" % (len(self.cache), self.filename))
+
+
+# The cache used by the guessers; replace it with configure()
+_tokenizer = TokenizationCache()
+
+
+def configure(filename, workers=1):
+    global _tokenizer
+    if _tokenizer.filename != filename or _tokenizer.workers != workers:
+        _tokenizer = TokenizationCache(filename, workers)
+    return _tokenizer
+
+
+def get_tokenizer():
+    return _tokenizer
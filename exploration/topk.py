@@ -0,0 +1,88 @@
+# Jordan Boyd-Graber
+# 2023
+#
+# Helpers for selecting the highest scoring entries of a similarity matrix
+# without sorting every row.
+
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+
+
+def top_k_rows(scores, k):
+    """
+    Given a dense matrix of scores (one row per query), return a matrix of
+    column indices of the k highest scores in each row, best first.
+
+    Only the k selected columns are sorted; argpartition finds them in linear
+    time.
+    """
+    scores = np.atleast_2d(scores)
+    num_columns = scores.shape[1]
+    k = min(k, num_columns)
+    if k <= 0:
+        return np.zeros((scores.shape[0], 0), dtype=np.int64)
+
+    if k < num_columns:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        top = np.tile(np.arange(num_columns), (scores.shape[0], 1))
+
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    return np.take_along_axis(top, order, axis=1)
+
+
+def top_k_sparse(matrix, k):
+    """
+    Given a sparse matrix of scores, return for each row a pair of arrays:
+    the columns of its k highest stored scores (best first) and those
+    scores.  Only the stored (nonzero) entries of a row are considered, so
+    a row with fewer than k of them returns fewer.
+    """
+    matrix = csr_matrix(matrix)
+    result = []
+    for row in range(matrix.shape[0]):
+        start, stop = matrix.indptr[row], matrix.indptr[row + 1]
+        data = matrix.data[start:stop]
+        if len(data) > k > 0:
+            top = np.argpartition(-data, k - 1)[:k]
+        else:
+            top = np.arange(min(len(data), max(k, 0)))
+        top = top[np.argsort(-data[top], kind="stable")]
+        result.append((matrix.indices[start:stop][top], data[top]))
+    return result
+
+
+def pad_top_k(columns, scores, k, num_columns):
+    """
+    Fill a row's top k (from top_k_sparse) up to k entries with the first
+    columns that have no stored score (they score zero), as the dense
+    selection would.
+    """
+    if len(columns) >= k:
+        return columns, scores
+    unseen = np.setdiff1d(np.arange(min(num_columns, k + len(columns))), columns)
+    filler = unseen[:k - len(columns)]
+    return np.concatenate([columns, filler]), np.concatenate([scores, np.zeros(len(filler))])
+
+
+def top_k_similar(queries, documents, k, block_size=1024):
+    """
+    For each row of queries (e.g. tf-idf vectors of many first sentences),
+    find the k rows of documents with the highest dot product: a list of
+    (document indices, similarities) pairs, best first.
+
+    Queries are multiplied against the documents a block at a time; sparse
+    products only keep the documents that share a term with the query.
+    """
+    result = []
+    for start in range(0, queries.shape[0], block_size):
+        block = queries[start:start + block_size]
+        similarity = block @ documents.T
+        if issparse(similarity):
+            result += top_k_sparse(similarity, k)
+        else:
+            similarity = np.atleast_2d(similarity)
+            top = top_k_rows(similarity, k)
+            result += [(x, y[x]) for x, y in zip(top, similarity)]
+    return result